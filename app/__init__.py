@@ -1,30 +1,16 @@
+import click
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from .extensions import db, migrate
+from .extensions import db
+from . import database, logging_setup, request_metrics, tracing
+from .jwks import key_store
+from .token_cache import token_cache
+from .rbac import rbac
+from .audit import audit
+from .user_status_cache import user_status_cache
+from .services.stripe_service import stripe_service
+from .health import health_prober
 from flask_cors import CORS
 from config import Config
-import os
-import sentry_sdk
-from sentry_sdk.integrations.flask import FlaskIntegration
-
-# 1. Initialize Sentry before your app runs
-sentry_sdk.init(
-    # 2. Get the DSN from an environment variable
-    dsn=os.environ.get("SENTRY_DSN"),
-    
-    # 3. Add the FlaskIntegration to automatically capture errors
-    integrations=[
-        FlaskIntegration(),
-    ],
-
-    # 4. Set the environment (e.g., 'production', 'staging')
-    environment=os.environ.get("SENTRY_ENVIRONMENT"),
-    enable_logs=True,
-
-    # Set traces_sample_rate to 1.0 to capture 100%
-    # of transactions for performance monitoring.
-    traces_sample_rate=1.0
-)
 
 def create_app(config_class=Config):
     """
@@ -33,9 +19,31 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    # Initialize Sentry before anything else runs
+    tracing.init_app(app)
+
+    # Only the flask CLI needs the migrations (flask db ...). Flask-Migrate pulls
+    # in alembic, which logs as it loads: import it before logging is set up
+    if click.get_current_context(silent=True) is not None:
+        from flask_migrate import Migrate
+        Migrate(app, db)
+
+    # Configure logging first, so everything below logs through the queue
+    logging_setup.init_app(app)
+
     # Initialize extensions with the app instance
+    # The pool settings have to be in place before db.init_app creates the engine
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', database.engine_options(app.config))
     db.init_app(app)
-    migrate.init_app(app, db)
+    database.init_app(app)
+    request_metrics.init_app(app)
+    key_store.init_app(app)
+    token_cache.init_app(app)
+    rbac.init_app(app)
+    audit.init_app(app)
+    user_status_cache.init_app(app)
+    stripe_service.init_app(app)
+    health_prober.init_app(app)
     CORS(app) # Enable Cross-Origin Resource Sharing
 
     # Import models here to ensure they are registered with SQLAlchemy
@@ -46,4 +54,12 @@ def create_app(config_class=Config):
     from .routes import main as main_blueprint
     app.register_blueprint(main_blueprint)
 
+    # Register the maintenance commands (flask audit ...)
+    from .commands import audit_cli, startup_cli, stripe_inbox_cli, subscriptions_cli, users_cli
+    app.cli.add_command(audit_cli)
+    app.cli.add_command(startup_cli)
+    app.cli.add_command(stripe_inbox_cli)
+    app.cli.add_command(subscriptions_cli)
+    app.cli.add_command(users_cli)
+
     return app
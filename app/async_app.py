@@ -0,0 +1,94 @@
+# async_app.py
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from quart import Quart, current_app, request
+
+from . import create_app, request_metrics, startup, tracing
+from .async_database import async_db
+from .health import health_prober
+from .user_status_cache import user_status_cache
+from config import Config
+
+# Request bodies the Flask routes accept when served through the async app
+WSGI_MAX_BODY_SIZE = 2 ** 20
+
+
+class WSGIFallback:
+    """
+    ASGI middleware that lets the async app serve the paths it has routes
+    for and hands every other HTTP request to the Flask app, which runs
+    on the event loop's thread pool.
+    """
+
+    def __init__(self, asgi_app, async_app, wsgi_app):
+        self.asgi_app = asgi_app
+        self.async_app = async_app
+        self.wsgi_app = AsyncioWSGIMiddleware(wsgi_app, max_body_size=WSGI_MAX_BODY_SIZE)
+        self._paths = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] not in self.paths:
+            return await self.wsgi_app(scope, receive, send)
+        return await self.asgi_app(scope, receive, send)
+
+    @property
+    def paths(self):
+        # Read on first use, once every blueprint is registered
+        if self._paths is None:
+            self._paths = frozenset(rule.rule for rule in self.async_app.url_map.iter_rules())
+        return self._paths
+
+
+async def _begin_request():
+    request_metrics.begin_request(request.endpoint)
+
+
+async def _check_request(response):
+    request_metrics.check_query_budget(current_app.view_functions.get(request.endpoint),
+                                       request_metrics.query_budget_strict(current_app))
+    return response
+
+
+async def _observe_request(exception=None):
+    request_metrics.end_request(request.endpoint or 'unmatched')
+
+
+def create_async_app(config_class=Config):
+    """
+    The application factory of the async serving mode (see asgi.py).
+
+    Builds the Flask app as create_app does, so every extension is set up
+    once, and puts a Quart app in front of it that serves the I/O-bound
+    routes from async_routes.py. Everything else falls through to Flask.
+    """
+    flask_app = create_app(config_class)
+
+    app = Quart(__name__, static_folder=None)
+    app.config.from_mapping(flask_app.config)
+
+    # Trace the async handlers too; the Flask integration keeps covering the rest
+    integrations = []
+    if app.config['SENTRY_DSN']:
+        from sentry_sdk.integrations.quart import QuartIntegration
+        integrations.append(QuartIntegration(transaction_style='url'))
+    tracing.init_app(app, integrations=integrations)
+
+    async_db.init_app(app)
+    health_prober.watch_pool('async', lambda: async_db.engine and async_db.engine.sync_engine)
+    app.before_request(_begin_request)
+    app.after_request(_check_request)
+    app.teardown_request(_observe_request)
+
+    @app.before_serving
+    async def start_listener():
+        # Connects with psycopg2 through the Flask app's engine
+        with flask_app.app_context():
+            user_status_cache.start()
+        health_prober.start()
+        startup.warm_up()
+
+    from .async_routes import main as main_blueprint
+    app.register_blueprint(main_blueprint)
+
+    app.asgi_app = WSGIFallback(app.asgi_app, app, flask_app.wsgi_app)
+    app.extensions['wsgi_app'] = flask_app
+    return app
@@ -0,0 +1,88 @@
+# async_database.py
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from . import request_metrics
+
+# The async handlers (app/async_routes.py) reach Postgres through asyncpg
+# instead of psycopg2. They use the same models as the rest of the app,
+# with SQLAlchemy's AsyncSession in place of Flask-SQLAlchemy's db.session.
+#
+# The engine is created when the server starts serving: asyncpg connections
+# belong to the event loop they were opened on.
+
+
+def async_database_uri(uri):
+    """The asyncpg URL of the database at the (psycopg2) SQLALCHEMY_DATABASE_URI."""
+    url = make_url(uri)
+    if url.get_backend_name() != 'postgresql':
+        return uri
+    return url.set(drivername='postgresql+asyncpg').render_as_string(hide_password=False)
+
+
+def _check_connection(dbapi_connection, connection_record, connection_proxy):
+    # asyncpg knows without asking Postgres whether the socket was closed;
+    # raising this makes the pool replace the connection and try again
+    if dbapi_connection.driver_connection.is_closed():
+        raise DisconnectionError()
+
+
+class AsyncDatabase:
+    """
+    The async app's engine and session factory. Sized by the same DB_*
+    settings as the sync pool (see app/database.py), so one ASGI process
+    opens at most DB_POOL_SIZE + DB_MAX_OVERFLOW connections.
+    """
+
+    def __init__(self, app=None):
+        self.engine = None
+        self._sessions = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        config.setdefault('ASYNC_DATABASE_URI', async_database_uri(config['SQLALCHEMY_DATABASE_URI']))
+        self.config = config
+
+        app.before_serving(self.connect)
+        app.after_serving(self.dispose)
+        app.extensions['async_db'] = self
+
+    async def connect(self):
+        config = self.config
+        connect_args = {}
+        # asyncpg takes Postgres settings as server_settings, not libpq's 'options'
+        if config['DB_STATEMENT_TIMEOUT_MS']:
+            connect_args['server_settings'] = {'statement_timeout': str(config['DB_STATEMENT_TIMEOUT_MS'])}
+
+        self.engine = create_async_engine(
+            config['ASYNC_DATABASE_URI'],
+            pool_size=config['DB_POOL_SIZE'],
+            max_overflow=config['DB_MAX_OVERFLOW'],
+            pool_timeout=config['DB_POOL_TIMEOUT'],
+            pool_recycle=config['DB_POOL_RECYCLE'],
+            # With asyncpg a pre-ping takes three round trips (BEGIN, ping,
+            # ROLLBACK); _check_connection below costs none
+            pool_pre_ping=False,
+            connect_args=connect_args,
+        )
+        if config['DB_POOL_PRE_PING']:
+            event.listen(self.engine.sync_engine, 'checkout', _check_connection)
+        request_metrics.instrument_engine(self.engine.sync_engine)
+        # Objects stay readable after commit, as the handlers return them afterwards
+        self._sessions = async_sessionmaker(self.engine, autoflush=False, expire_on_commit=False)
+
+    async def dispose(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+
+    def session(self):
+        """A new AsyncSession, to be used as `async with async_db.session() as session:`."""
+        return self._sessions()
+
+
+async_db = AsyncDatabase()
@@ -0,0 +1,214 @@
+from quart import Blueprint, jsonify, g, current_app, request
+from functools import wraps
+import logging
+import os
+import time
+from sqlalchemy import select
+from .async_database import async_db
+from .jwks import key_store
+from . import models
+from .health import health_prober
+from .rbac import rbac
+from .request_metrics import add_phase_time, query_budget
+from .services import stripe_session_cache, user_service
+from .services.stripe_service import StripeUnavailable
+from .token_cache import token_cache, TOKEN_VERIFICATION_SECONDS
+from .user_status_cache import user_status_cache
+from .utils import AuthError, decode_jwt, get_token_kid, parse_auth_header
+
+# The async counterparts of the I/O-bound routes in routes.py, served by
+# the async app (app/async_app.py). They behave the same, but wait for
+# Auth0, Postgres and Stripe on the event loop instead of holding a thread.
+# Every other route is still served by the Flask app.
+
+main = Blueprint('main', __name__)
+
+
+def requires_auth(f):
+    """utils.requires_auth for async handlers: fetches signing keys without blocking."""
+    @wraps(f)
+    async def decorated(*args, **kwargs):
+        try:
+            token = parse_auth_header(request.headers.get('Authorization', None))
+
+            started = time.perf_counter()
+            payload = token_cache.get(token)
+            if payload is not None:
+                TOKEN_VERIFICATION_SECONDS.labels(path='cached').observe(time.perf_counter() - started)
+            else:
+                try:
+                    payload = decode_jwt(token, await key_store.get_key_async(get_token_kid(token)))
+                finally:
+                    add_phase_time('auth', time.perf_counter() - started)
+                token_cache.put(token, payload)
+                TOKEN_VERIFICATION_SECONDS.labels(path='full').observe(time.perf_counter() - started)
+
+            g.current_user = payload
+
+        except AuthError as e:
+            return jsonify(e.error), e.status_code
+
+        return await f(*args, **kwargs)
+
+    return decorated
+
+
+async def _find_user(session, auth0_user_id):
+    return (await session.execute(
+        select(models.User).where(models.User.auth0_user_id == auth0_user_id)
+    )).scalar()
+
+
+@main.route('/')
+async def me():
+    logging.info("Main page has been accessed.")
+    return "Welcome!"
+
+@main.route('/health')
+@main.route('/health/live')
+@query_budget(0)
+async def health_check():
+    return jsonify({"status": "healthy"}), 200
+
+@main.route('/health/ready')
+@query_budget(0)
+async def readiness_check():
+    # Only reads the report; the prober was started before serving
+    report, ready = health_prober.report()
+    return jsonify(report), 200 if ready else 503
+
+@main.route('/api/user/onboard', methods=['POST'])
+@query_budget(2)
+@requires_auth
+async def sync_user():
+    """
+    Handles user onboarding after successful Auth0 login, as routes.sync_user.
+    """
+    payload = g.current_user
+    auth0_user_id = payload.get('sub')
+    email = payload.get('https://my-template-app.com/email')
+
+    if not auth0_user_id or not email:
+        return jsonify({
+            "code": "bad_request",
+            "description": "Auth0 token payload is missing 'sub' or 'email'."
+        }), 400
+
+    async with async_db.session() as session:
+        try:
+            new_user_id = await user_service.onboard_user_async(session, auth0_user_id, email)
+            await session.commit()
+        except user_service.DefaultRoleMissing:
+            await session.rollback()
+            current_app.logger.critical("Default role 'user' not found in the database.")
+            return jsonify({
+                "code": "server_error",
+                "description": "Server configuration error: default role missing."
+            }), 500
+        except Exception as e:
+            await session.rollback()
+            current_app.logger.error(f"An error occurred during user onboarding: {e}")
+            return jsonify({
+                "code": "server_error",
+                "description": "An unexpected error occurred."
+            }), 500
+
+    # Roles were assigned with a Core INSERT, which the ORM hooks don't see
+    rbac.invalidate_user(auth0_user_id)
+
+    if new_user_id is None:
+        return jsonify({
+            "status": "success",
+            "message": "User already exists."
+        }), 200
+
+    return jsonify({
+        "status": "success",
+        "message": "New user created and assigned default role."
+    }), 201
+
+@main.route('/api/user/status')
+@query_budget(1)
+@requires_auth
+async def user_status():
+    """
+    Returns the subscription status of the authenticated user.
+    """
+    try:
+        auth0_user_id = g.current_user.get('sub')
+        async with async_db.session() as session:
+            entry = await user_status_cache.get_async(auth0_user_id, session)
+
+        if entry is None:
+            return jsonify({"error": "User not found"}), 404
+
+        status, etag = entry
+        response = jsonify(status)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return await response.make_conditional(request)
+
+    except Exception as e:
+        current_app.logger.error(f"Failed to fetch user status: {e}")
+        return jsonify(error="Server error"), 500
+
+@main.route('/api/create-checkout-session', methods=['POST'])
+@query_budget(3)
+@requires_auth
+async def create_checkout_session():
+    """
+    Creates a Stripe Checkout session for the authenticated user.
+    """
+    try:
+        async with async_db.session() as session:
+            user = await _find_user(session, g.current_user.get('sub'))
+            if not user:
+                return jsonify({"error": "User not found"}), 404
+
+            frontend_url = os.getenv('NEXT_PUBLIC_APP_URL')
+            checkout_url = await stripe_session_cache.checkout_url_async(
+                session, user,
+                price_id=os.getenv('STRIPE_PRICE_ID'),
+                success_url=f'{frontend_url}/dashboard?success=true',
+                cancel_url=f'{frontend_url}/dashboard?canceled=true',
+                config=current_app.config
+            )
+
+        return jsonify({'url': checkout_url})
+
+    except StripeUnavailable as e:
+        current_app.logger.error(f"Stripe session creation failed: {e}")
+        return jsonify(error="Payments are temporarily unavailable, please try again shortly."), 503
+    except Exception as e:
+        current_app.logger.error(f"Stripe session creation failed: {e}")
+        return jsonify(error=str(e)), 500
+
+@main.route('/api/create-portal-session', methods=['POST'])
+@query_budget(3)
+@requires_auth
+async def create_portal_session():
+    """
+    Creates a Stripe Customer Portal session for the authenticated user.
+    """
+    try:
+        async with async_db.session() as session:
+            user = await _find_user(session, g.current_user.get('sub'))
+            if not user or not user.stripe_customer_id:
+                return jsonify({"error": "User not found or is not a Stripe customer"}), 404
+
+            frontend_url = os.getenv('NEXT_PUBLIC_APP_URL')
+            if not frontend_url:
+                raise ValueError("NEXT_PUBLIC_APP_URL environment variable not set.")
+
+            portal_url = await stripe_session_cache.portal_url_async(
+                session, user, return_url=f'{frontend_url}/dashboard', config=current_app.config
+            )
+
+        return jsonify({'url': portal_url})
+
+    except StripeUnavailable as e:
+        current_app.logger.error(f"Stripe portal session creation failed: {e}")
+        return jsonify(error="Payments are temporarily unavailable, please try again shortly."), 503
+    except Exception as e:
+        current_app.logger.error(f"Stripe portal session creation failed: {e}")
+        return jsonify(error=str(e)), 500
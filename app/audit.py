@@ -0,0 +1,227 @@
+# audit.py
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import insert
+
+from .extensions import db, metrics
+from .models import AuditLog
+
+logger = logging.getLogger(__name__)
+
+# --- Audit Metrics ---
+AUDIT_QUEUE_DEPTH = Gauge(
+    'audit_queue_depth',
+    'Audit events waiting to be written by the background flusher.',
+    registry=metrics.registry,
+    multiprocess_mode='livesum'
+)
+AUDIT_EVENTS = Counter(
+    'audit_events_total',
+    'Audit events by how they were written (queued, sync, overflow) and outcome.',
+    ['mode', 'outcome'],
+    registry=metrics.registry
+)
+AUDIT_FLUSH_SECONDS = Histogram(
+    'audit_flush_seconds',
+    'Time taken to write one batch of audit events.',
+    registry=metrics.registry
+)
+AUDIT_FLUSH_BATCH_SIZE = Histogram(
+    'audit_flush_batch_size',
+    'Number of audit events written per batch.',
+    registry=metrics.registry,
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+
+
+class AuditWriter:
+    """
+    Writes AuditLog rows in the background, in batches.
+
+    - `record()` puts the event on an in-memory queue and returns right away.
+    - A flusher thread writes queued events with one multi-row INSERT as soon as
+      AUDIT_BATCH_SIZE events are waiting or AUDIT_FLUSH_INTERVAL seconds
+      have passed since the first one arrived.
+    - When the queue is full, `record()` waits up to AUDIT_ENQUEUE_TIMEOUT
+      seconds for space and then writes the event itself, so a slow database
+      pushes back on the request instead of losing events.
+    - Whatever is still queued is written when the process exits.
+
+    Events that must commit or roll back together with the request's own
+    changes should use `record(..., sync=True)`, which adds the row to
+    db.session instead.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.batch_size = 100
+        self.flush_interval = 1.0
+        self.queue_size = 10000
+        self.enqueue_timeout = 0.05
+
+        self._app = None
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Reads the audit settings from the app config."""
+        app.config.setdefault('AUDIT_ASYNC_ENABLED', self.enabled)
+        app.config.setdefault('AUDIT_BATCH_SIZE', self.batch_size)
+        app.config.setdefault('AUDIT_FLUSH_INTERVAL', self.flush_interval)
+        app.config.setdefault('AUDIT_QUEUE_SIZE', self.queue_size)
+        app.config.setdefault('AUDIT_ENQUEUE_TIMEOUT', self.enqueue_timeout)
+
+        self.enabled = app.config['AUDIT_ASYNC_ENABLED']
+        self.batch_size = app.config['AUDIT_BATCH_SIZE']
+        self.flush_interval = app.config['AUDIT_FLUSH_INTERVAL']
+        self.queue_size = app.config['AUDIT_QUEUE_SIZE']
+        self.enqueue_timeout = app.config['AUDIT_ENQUEUE_TIMEOUT']
+        self._app = app
+
+        app.extensions['audit'] = self
+
+    # --- Public API ---
+
+    def record(self, action, user_id=None, details=None, sync=False):
+        """
+        Records an audit event.
+
+        :param action: what happened, e.g. 'subscription.canceled'
+        :param user_id: the internal users.id the event is about, if any
+        :param details: a JSON-serializable dict stored in the JSONB column
+        :param sync: add the row to db.session, so it is committed (or rolled
+            back) with the rest of the request's transaction
+        """
+        row = {
+            'id': uuid.uuid4(),
+            'user_id': user_id,
+            'action': action,
+            'details': details,
+            # Stamp the time of the event, not the time of the flush
+            'created_at': datetime.now(timezone.utc).replace(tzinfo=None),
+        }
+
+        if sync or not self.enabled:
+            db.session.add(AuditLog(**row))
+            AUDIT_EVENTS.labels(mode='sync', outcome='added').inc()
+            return
+
+        self._ensure_started()
+        try:
+            self._queue.put(row, timeout=self.enqueue_timeout)
+            AUDIT_EVENTS.labels(mode='queued', outcome='queued').inc()
+        except queue.Full:
+            # Backpressure: the flusher can't keep up, so this request pays for the write
+            self._write([row], mode='overflow')
+
+    def flush(self, timeout=None):
+        """Blocks until every event queued so far has been written."""
+        if self._queue is None or self._pid != os.getpid():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def shutdown(self, timeout=10):
+        """Stops the flusher after it has written everything still queued."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._queue.put(None)
+        self._thread.join(timeout)
+        # Events recorded after this start a new flusher
+        self._pid = None
+
+    # --- Background flusher ---
+
+    def _ensure_started(self):
+        # Threads don't survive fork(), so every worker process starts its own
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='audit-flusher', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        batch = []
+        waiters = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None if self._stopping.is_set() else False
+            # Set here rather than read at scrape time, which multiprocess mode can't do
+            AUDIT_QUEUE_DEPTH.set(self._queue.qsize())
+
+            if isinstance(item, dict):
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if len(batch) < self.batch_size:
+                    continue
+            elif isinstance(item, threading.Event):
+                waiters.append(item)
+
+            # Batch is full, the interval has passed, flush() was called or we're stopping
+            if batch:
+                self._write(batch, mode='queued')
+                batch = []
+            deadline = None
+            for waiter in waiters:
+                waiter.set()
+            waiters = []
+
+            if item is None and self._queue.empty():
+                return
+
+    def _write(self, rows, mode, attempts=3):
+        started = time.perf_counter()
+        for attempt in range(1, attempts + 1):
+            try:
+                with self._app.app_context():
+                    with db.engine.begin() as connection:
+                        # executemany is sent as multi-row INSERT ... VALUES batches
+                        connection.execute(insert(AuditLog.__table__), rows)
+                break
+            except Exception as e:
+                if attempt == attempts:
+                    AUDIT_EVENTS.labels(mode=mode, outcome='failed').inc(len(rows))
+                    # Keep the events in the logs so they can be replayed by hand
+                    logger.error(
+                        "Dropping audit events after repeated write failures.",
+                        extra={'error_message': str(e), 'events': json.dumps(rows, default=str)}
+                    )
+                    return
+                time.sleep(0.1 * 2 ** attempt)
+
+        AUDIT_FLUSH_SECONDS.observe(time.perf_counter() - started)
+        AUDIT_FLUSH_BATCH_SIZE.observe(len(rows))
+        AUDIT_EVENTS.labels(mode=mode, outcome='written').inc(len(rows))
+
+
+audit = AuditWriter()
+
+# Drain whatever is still queued when the worker exits
+atexit.register(audit.shutdown)
@@ -0,0 +1,159 @@
+# audit_partitions.py
+import gzip
+import logging
+import os
+import re
+from datetime import date, datetime, timezone
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# audit_logs is range-partitioned by created_at into one table per month,
+# named audit_logs_pYYYY_MM (created by migration 8cb2a65a8e40).
+PARENT_TABLE = 'audit_logs'
+PARTITION_NAME = re.compile(r'^audit_logs_p(\d{4})_(\d{2})$')
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f'{PARENT_TABLE}_p{month:%Y_%m}'
+
+
+def _parse_month(name):
+    match = PARTITION_NAME.match(name)
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def _today():
+    return datetime.now(timezone.utc).date()
+
+
+def list_partitions(connection):
+    """
+    Returns (attached, detached) lists of (month, table name), oldest first.
+    Detached tables are left over from an archive run that didn't finish.
+    """
+    attached_names = connection.execute(text("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        WHERE parent.relname = :parent
+    """), {'parent': PARENT_TABLE}).scalars().all()
+
+    all_names = connection.execute(text("""
+        SELECT tablename FROM pg_tables
+        WHERE schemaname = current_schema() AND tablename LIKE :pattern
+    """), {'pattern': f'{PARENT_TABLE}\\_p%'}).scalars().all()
+
+    def by_month(names):
+        parsed = [(_parse_month(name), name) for name in names]
+        return sorted((month, name) for month, name in parsed if month)
+
+    return by_month(attached_names), by_month(set(all_names) - set(attached_names))
+
+
+def missing_partitions(connection, months_ahead, today=None):
+    """Lists the (month, name) partitions from this month to `months_ahead` months out that don't exist yet."""
+    current = month_start(today or _today())
+    attached, _ = list_partitions(connection)
+    existing = {name for _, name in attached}
+    months = [add_months(current, offset) for offset in range(months_ahead + 1)]
+    return [(month, partition_name(month)) for month in months if partition_name(month) not in existing]
+
+
+def create_future_partitions(connection, months_ahead, today=None):
+    """
+    Makes sure partitions exist from the current month up to `months_ahead`
+    months from now, so inserts never hit a month without a partition.
+    Returns the names of the partitions it created.
+    """
+    created = []
+    for month, name in missing_partitions(connection, months_ahead, today):
+        connection.execute(text(
+            f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF {PARENT_TABLE} '
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+        ))
+        created.append(name)
+    return created
+
+
+def expired_partitions(connection, keep_months, today=None):
+    """
+    Lists partitions whose whole month is older than `keep_months` months,
+    plus any detached leftovers of an earlier run.
+    """
+    cutoff = add_months(month_start(today or _today()), -keep_months)
+    attached, detached = list_partitions(connection)
+    return [(month, name, True) for month, name in attached if month < cutoff] + \
+        [(month, name, False) for month, name in detached]
+
+
+def archive_partition(engine, name, attached, archive_dir):
+    """
+    Detaches a partition, dumps it to <archive_dir>/<name>.csv.gz with COPY
+    and drops it. Each step is safe to repeat if a previous run died halfway.
+    """
+    # 1. Detaching is a metadata-only change; the rows stay in the table
+    if attached:
+        with engine.begin() as connection:
+            connection.execute(text(f'ALTER TABLE {PARENT_TABLE} DETACH PARTITION "{name}"'))
+
+    # 2. Stream the rows to a compressed file, in constant memory
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f'{name}.csv.gz')
+    partial_path = f'{path}.partial'
+
+    raw_connection = engine.raw_connection()
+    try:
+        with gzip.open(partial_path, 'wb') as archive:
+            cursor = raw_connection.cursor()
+            cursor.copy_expert(f'COPY "{name}" TO STDOUT WITH (FORMAT csv, HEADER)', archive)
+            cursor.close()
+        raw_connection.commit()
+    finally:
+        raw_connection.close()
+
+    with open(partial_path, 'rb') as archive:
+        os.fsync(archive.fileno())
+    os.replace(partial_path, path)
+
+    # 3. Only drop the table once its archive is safely on disk
+    with engine.begin() as connection:
+        connection.execute(text(f'DROP TABLE "{name}"'))
+
+    return path
+
+
+def run_retention(engine, keep_months, archive_dir, months_ahead, dry_run=False, today=None):
+    """
+    The scheduled maintenance job: creates upcoming partitions, then archives
+    and drops every partition past the retention period.
+    Returns a summary dict.
+    """
+    with engine.begin() as connection:
+        if dry_run:
+            to_create = [name for _, name in missing_partitions(connection, months_ahead, today)]
+        else:
+            to_create = create_future_partitions(connection, months_ahead, today)
+        expired = expired_partitions(connection, keep_months, today)
+
+    archived = []
+    for month, name, attached in expired:
+        if dry_run:
+            archived.append({'partition': name, 'month': month.isoformat()})
+            continue
+        path = archive_partition(engine, name, attached, archive_dir)
+        logger.info("Archived audit log partition.", extra={'partition': name, 'archive_path': path})
+        archived.append({'partition': name, 'month': month.isoformat(), 'archive_path': path})
+
+    return {'created': to_create, 'archived': archived, 'dry_run': dry_run}
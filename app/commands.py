@@ -0,0 +1,216 @@
+# commands.py
+import json
+import signal
+import threading
+from datetime import timedelta, timezone
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import update
+
+from .extensions import db
+from .models import StripeEvent
+from .services import stripe_service, subscription_reconciler, user_import
+from . import audit_partitions, startup, webhook_inbox
+
+# --- flask audit ... ---
+audit_cli = AppGroup('audit', help='Maintain the partitioned audit_logs table.')
+
+
+@audit_cli.command('create-partitions')
+@click.option('--months-ahead', type=int, default=None,
+              help='Months past the current one to create (default: AUDIT_PARTITION_MONTHS_AHEAD).')
+def create_partitions(months_ahead):
+    """Creates any missing monthly audit_logs partitions."""
+    if months_ahead is None:
+        months_ahead = current_app.config['AUDIT_PARTITION_MONTHS_AHEAD']
+    with db.engine.begin() as connection:
+        created = audit_partitions.create_future_partitions(connection, months_ahead)
+    click.echo(json.dumps({'created': created}))
+
+
+@audit_cli.command('retention')
+@click.option('--keep-months', type=int, default=None,
+              help='Full months of audit history to keep (default: AUDIT_RETENTION_MONTHS).')
+@click.option('--archive-dir', default=None,
+              help='Where archived partitions are written (default: AUDIT_ARCHIVE_DIR).')
+@click.option('--dry-run', is_flag=True, help='Only report what would be created and archived.')
+def retention(keep_months, archive_dir, dry_run):
+    """
+    Creates upcoming partitions, then detaches every partition older than the
+    retention period, dumps it to a gzipped CSV and drops it.
+    Meant to run daily from cron.
+    """
+    config = current_app.config
+    summary = audit_partitions.run_retention(
+        db.engine,
+        keep_months=config['AUDIT_RETENTION_MONTHS'] if keep_months is None else keep_months,
+        archive_dir=archive_dir or config['AUDIT_ARCHIVE_DIR'],
+        months_ahead=config['AUDIT_PARTITION_MONTHS_AHEAD'],
+        dry_run=dry_run,
+    )
+    click.echo(json.dumps(summary, indent=2))
+
+
+# --- flask stripe-inbox ... ---
+stripe_inbox_cli = AppGroup('stripe-inbox', help='Apply Stripe webhook events stored in the inbox.')
+
+
+@stripe_inbox_cli.command('work')
+@click.option('--threads', type=int, default=None,
+              help='Worker threads (default: STRIPE_INBOX_WORKER_THREADS).')
+def work(threads):
+    """
+    Applies pending Stripe events until interrupted.
+    Any number of these processes can run side by side.
+    """
+    app = current_app._get_current_object()
+    threads = threads or app.config['STRIPE_INBOX_WORKER_THREADS']
+    stop_event = threading.Event()
+    # docker stop sends SIGTERM; finish the event in hand, then exit
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    click.echo(f'Starting {threads} Stripe inbox workers.')
+    try:
+        webhook_inbox.run_workers(app, threads, stop_event)
+    except KeyboardInterrupt:
+        stop_event.set()
+
+
+@stripe_inbox_cli.command('retry-failed')
+@click.argument('event_ids', nargs=-1)
+def retry_failed(event_ids):
+    """Puts failed events (all of them, or the given ids) back in the queue."""
+    statement = (
+        update(StripeEvent)
+        .where(StripeEvent.status == 'failed')
+        .values(status='pending', attempts=0, next_attempt_at=db.func.now())
+    )
+    if event_ids:
+        statement = statement.where(StripeEvent.id.in_(event_ids))
+    count = db.session.execute(statement).rowcount
+    db.session.commit()
+    click.echo(json.dumps({'requeued': count}))
+
+
+# --- flask subscriptions ... ---
+RECONCILE_CHANGES_SHOWN = 100
+subscriptions_cli = AppGroup('subscriptions', help='Keep subscription plans in line with Stripe.')
+
+
+@subscriptions_cli.command('reconcile')
+@click.option('--dry-run', is_flag=True, help='Only report the plans that would change.')
+@click.option('--resume', is_flag=True, help='Continue the last run from its checkpoints.')
+@click.option('--since', type=click.DateTime(), default=None,
+              help='Oldest subscription creation time (UTC) to list (default: a day before the oldest paying user).')
+@click.option('--concurrency', type=int, default=None,
+              help='Stripe list calls in flight at once (default: STRIPE_RECONCILE_CONCURRENCY).')
+@click.option('--window-days', type=int, default=None,
+              help='Days of subscription creation time per listing window (default: STRIPE_RECONCILE_WINDOW_DAYS).')
+def reconcile(dry_run, resume, since, concurrency, window_days):
+    """
+    Lists every Stripe subscription and fixes users.subscription_plan for
+    every user whose plan drifted, e.g. because a webhook was missed.
+    """
+    import stripe
+
+    config = current_app.config
+    try:
+        summary = subscription_reconciler.reconcile(
+            current_app._get_current_object(),
+            resume=resume,
+            since=since.replace(tzinfo=timezone.utc) if since else None,
+            window=timedelta(days=window_days or config['STRIPE_RECONCILE_WINDOW_DAYS']),
+            concurrency=concurrency or config['STRIPE_RECONCILE_CONCURRENCY'],
+            batch_size=config['STRIPE_RECONCILE_BATCH_SIZE'],
+            update_batch_size=config['STRIPE_RECONCILE_UPDATE_BATCH_SIZE'],
+            dry_run=dry_run,
+        )
+    except subscription_reconciler.NothingToResume:
+        raise click.ClickException('There is no interrupted run to resume.')
+    except (stripe_service.StripeUnavailable, stripe.error.StripeError) as e:
+        raise click.ClickException(f'Listing subscriptions failed: {e} Run again with --resume to continue.')
+
+    # The full list can be long; the counts are what matters
+    changes = summary.pop('changes')
+    summary['changes'] = changes[:RECONCILE_CHANGES_SHOWN]
+    summary['changes_not_shown'] = max(0, len(changes) - RECONCILE_CHANGES_SHOWN)
+    click.echo(json.dumps(summary, indent=2))
+
+
+# --- flask users ... ---
+users_cli = AppGroup('users', help='Manage users in bulk.')
+
+
+@users_cli.command('import')
+@click.argument('export_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', type=int, default=None,
+              help='Lines copied and merged per transaction (default: USER_IMPORT_BATCH_SIZE).')
+@click.option('--resume', is_flag=True, help='Continue the last unfinished import of this file.')
+def import_users(export_file, batch_size, resume):
+    """
+    Onboards every user in an Auth0 user export (JSON lines, may be
+    gzipped), as /api/user/onboard would one at a time. Users that already
+    exist are skipped, so an export can be imported again safely. New users
+    whose email belongs to another user are reported, not imported.
+    """
+    def progress(summary):
+        click.echo(f"{summary['lines']} lines: {summary['created']} created, {summary['skipped']} skipped, "
+                   f"{summary['email_conflicts']} email conflicts, {summary['invalid']} invalid "
+                   f"({summary['seconds']} s)", err=True)
+
+    try:
+        summary = user_import.import_users(
+            export_file,
+            batch_size=batch_size or current_app.config['USER_IMPORT_BATCH_SIZE'],
+            resume=resume,
+            progress=progress,
+        )
+    except user_import.NothingToResume:
+        raise click.ClickException('There is no unfinished import of this file to resume.')
+    click.echo(json.dumps(summary, indent=2))
+
+
+# --- flask startup ... ---
+startup_cli = AppGroup('startup', help='Measure how long a new process takes to serve.')
+
+
+@startup_cli.command('profile')
+@click.option('--path', default='/health', help='Path of the first request (default: /health).')
+@click.option('--top', type=int, default=25, help='Modules and packages listed (default: 25).')
+@click.option('--json', 'as_json', is_flag=True, help='Print the full report as JSON.')
+@click.option('--budget-ms', type=float, default=None,
+              help='Fail when importing, create_app and the first request take longer than this.')
+def profile(path, top, as_json, budget_ms):
+    """
+    Imports the app in a new interpreter under `python -X importtime`, runs
+    create_app and serves one request, and reports what each step and each
+    imported module cost.
+    """
+    try:
+        report = startup.profile(path=path, top=top)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+    else:
+        click.echo(f"import app       {report['import_ms']:9.1f} ms")
+        click.echo(f"create_app       {report['create_app_ms']:9.1f} ms")
+        click.echo(f"first request    {report['first_request_ms']:9.1f} ms  "
+                   f"({path}: {report['first_request_status']})")
+        click.echo(f"total            {report['total_ms']:9.1f} ms  "
+                   f"({report['modules_imported']} modules imported)")
+        click.echo('\nBy package (self ms, modules):')
+        for entry in report['packages']:
+            click.echo(f"  {entry['self_ms']:9.1f}  {entry['modules']:5d}  {entry['package']}")
+        click.echo('\nBy module, top-level imports (cumulative ms):')
+        for module in report['modules_by_cumulative']:
+            click.echo(f"  {module['cumulative_ms']:9.1f}  {module['module']}")
+        click.echo('\nBy module (self ms):')
+        for module in report['modules_by_self']:
+            click.echo(f"  {module['self_ms']:9.1f}  {module['module']}")
+
+    if budget_ms is not None and report['total_ms'] > budget_ms:
+        raise click.ClickException(
+            f"Startup took {report['total_ms']:.0f} ms, over the budget of {budget_ms:.0f} ms.")
@@ -1,7 +1,20 @@
 # extensions.py
+import os
+
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_flask_exporter.multiprocess import GunicornInternalPrometheusMetrics
 
 # Create the SQLAlchemy instance but don't attach it to an app yet
-db = SQLAlchemy()
-migrate = Migrate()
\ No newline at end of file
+# Sessions don't autoflush; routes flush explicitly when they need generated ids.
+db = SQLAlchemy(session_options={'autoflush': False})
+
+# The Prometheus exporter is attached to the 'main' blueprint in routes.py.
+# Creating it here lets other modules register their own metrics in its registry.
+# Under gunicorn, PROMETHEUS_MULTIPROC_DIR is set (see entrypoint.sh): every
+# worker then writes its metrics there and /metrics, whichever worker serves
+# it, reports them summed over all workers.
+if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    metrics = GunicornInternalPrometheusMetrics.for_app_factory()
+else:
+    metrics = PrometheusMetrics.for_app_factory()
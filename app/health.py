@@ -0,0 +1,197 @@
+# health.py
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from prometheus_client import Gauge
+
+from . import database
+from .extensions import db, metrics
+from .jwks import key_store
+from .services.stripe_service import CIRCUIT_OPEN, stripe_service
+
+logger = logging.getLogger(__name__)
+
+# --- Health Metrics ---
+HEALTH_CHECK_UP = Gauge(
+    'health_check_up',
+    'Result of the last readiness check of each dependency (1 up, 0 down).',
+    ['check'],
+    registry=metrics.registry,
+    multiprocess_mode='livemin'
+)
+
+
+class HealthProber:
+    """
+    Checks this process's dependencies on a background thread every
+    HEALTH_PROBE_INTERVAL seconds and keeps the result, so a readiness
+    probe only reads it: however many probes arrive, Postgres sees one
+    `SELECT 1` per interval and process.
+
+    - database: `SELECT 1` on a connection of the prober's own, outside
+      the request pool, plus the state of the pools. Required.
+    - jwks: the cached signing keys. Required, as no token can be verified
+      without them. The prober also fetches them when they are missing or
+      due for a refresh, so a new process has keys before its first request.
+    - stripe: the circuit breaker. An open circuit only degrades the
+      process, since every route but the payment ones still works.
+
+    A report older than HEALTH_REPORT_MAX_AGE seconds (the prober is stuck)
+    counts as not ready.
+    """
+
+    def __init__(self, app=None):
+        self.interval = 5.0
+        self.db_timeout = 2
+        self.max_age = 15.0
+        self._app = None
+        self._pools = {}
+        self._report = None
+        self._reported_at = None
+        self._first_report = threading.Event()
+        self._connection = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('HEALTH_PROBE_INTERVAL', self.interval)
+        app.config.setdefault('HEALTH_DB_TIMEOUT', self.db_timeout)
+        app.config.setdefault('HEALTH_REPORT_MAX_AGE', self.max_age)
+
+        self.interval = app.config['HEALTH_PROBE_INTERVAL']
+        self.db_timeout = app.config['HEALTH_DB_TIMEOUT']
+        self.max_age = app.config['HEALTH_REPORT_MAX_AGE']
+        self._app = app
+        self._pools = {'default': lambda: db.engine}
+
+        app.extensions['health'] = self
+
+    def watch_pool(self, name, get_engine):
+        """Adds the pool of the engine `get_engine()` returns (or None) to the report."""
+        self._pools[name] = get_engine
+
+    def start(self):
+        """Starts this process's prober ahead of the first probe."""
+        self._ensure_running()
+
+    def report(self):
+        """Returns (report, ready) from the last round of checks."""
+        if self._ensure_running():
+            # A new process: give the first round a moment to finish
+            self._first_report.wait(1.0)
+
+        report, reported_at = self._report, self._reported_at
+        if report is None:
+            return {'status': 'starting'}, False
+        age = time.monotonic() - reported_at
+        if age > self.max_age:
+            return dict(report, status='stale', age_seconds=age), False
+        return dict(report, age_seconds=age), report['status'] != 'not_ready'
+
+    def _ensure_running(self):
+        # Threads don't survive fork(), so every worker process starts its own
+        if self._pid == os.getpid():
+            return False
+        with self._lock:
+            if self._pid == os.getpid():
+                return False
+            # Inherited from the parent: dropped, not closed, as it is the parent's
+            self._connection = None
+            self._report = self._reported_at = None
+            self._first_report.clear()
+            threading.Thread(target=self._run, name='health-prober', daemon=True).start()
+            self._pid = os.getpid()
+        return True
+
+    def _run(self):
+        with self._app.app_context():
+            while True:
+                started = time.monotonic()
+                try:
+                    self.probe()
+                except Exception:
+                    logger.exception("Health probe failed.")
+                time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def probe(self):
+        """Runs every check once and stores the report."""
+        checks = {
+            'database': self._check_database(),
+            'jwks': self._check_jwks(),
+            'stripe': self._check_stripe(),
+        }
+        for name, check in checks.items():
+            HEALTH_CHECK_UP.labels(check=name).set(1 if check['up'] else 0)
+
+        if not (checks['database']['up'] and checks['jwks']['up']):
+            status = 'not_ready'
+        elif not checks['stripe']['up']:
+            status = 'degraded'
+        else:
+            status = 'ready'
+        self._report = {
+            'status': status,
+            'checked_at': datetime.now(timezone.utc).isoformat(),
+            'checks': checks,
+        }
+        self._reported_at = time.monotonic()
+        self._first_report.set()
+
+    def _check_database(self):
+        started = time.perf_counter()
+        try:
+            if self._connection is None:
+                self._connection = self._connect()
+            with self._connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            check = {'up': True, 'latency_ms': (time.perf_counter() - started) * 1000}
+        except Exception as e:
+            self._disconnect()
+            check = {'up': False, 'error': str(e)}
+
+        check['pools'] = {}
+        for name, get_engine in self._pools.items():
+            engine = get_engine()
+            if engine is not None:
+                check['pools'][name] = database.pool_state(engine)
+        return check
+
+    def _connect(self):
+        engine = db.engine
+        dialect = engine.dialect
+        cargs, cparams = dialect.create_connect_args(engine.url)
+        # A probe mustn't hang on an unreachable or stuck database
+        cparams['connect_timeout'] = self.db_timeout
+        cparams['options'] = f'-c statement_timeout={int(self.db_timeout * 1000)}'
+        connection = dialect.connect(*cargs, **cparams)
+        connection.autocommit = True
+        return connection
+
+    def _disconnect(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+    @staticmethod
+    def _check_jwks():
+        key_store.prefetch()
+        status = key_store.status()
+        return dict(status, up=status['keys'] > 0)
+
+    @staticmethod
+    def _check_stripe():
+        state = stripe_service.breaker.state
+        # Half-open lets calls through to find out whether Stripe is back
+        return {'up': state != CIRCUIT_OPEN, 'circuit': state}
+
+
+health_prober = HealthProber()
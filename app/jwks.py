@@ -0,0 +1,296 @@
+# jwks.py
+import asyncio
+import contextvars
+import json
+import logging
+import threading
+import time
+from urllib.request import urlopen
+
+from prometheus_client import Counter
+
+from .extensions import metrics
+from .request_metrics import phase
+
+logger = logging.getLogger(__name__)
+
+# --- JWKS Metrics ---
+# These live in the registry of the shared PrometheusMetrics instance,
+# so they are served from the same /metrics endpoint as the HTTP metrics.
+JWKS_CACHE_HITS = Counter(
+    'jwks_cache_hits_total',
+    'Signing key lookups answered from the in-process JWKS key store.',
+    registry=metrics.registry
+)
+JWKS_CACHE_MISSES = Counter(
+    'jwks_cache_misses_total',
+    'Signing key lookups that found no key for the requested kid.',
+    registry=metrics.registry
+)
+JWKS_REFRESHES = Counter(
+    'jwks_refresh_total',
+    'Fetches of the JWKS document from Auth0.',
+    ['trigger', 'outcome'],
+    registry=metrics.registry
+)
+
+
+class JWKSKeyStore:
+    """
+    Caches the Auth0 signing keys as parsed key objects indexed by 'kid'.
+
+    - Keys are considered fresh for JWKS_CACHE_TTL seconds.
+    - Within JWKS_REFRESH_AHEAD seconds of expiry, a lookup kicks off a
+      refresh on a background thread and keeps serving the current keys.
+    - An unknown 'kid' (e.g. after a key rotation) triggers one synchronous
+      refetch, at most once every JWKS_MIN_REFETCH_INTERVAL seconds, so forged
+      kids can't turn every request into a call to Auth0.
+    - If Auth0 can't be reached, the last known keys keep being served.
+
+    The async handlers (app/async_routes.py) use `get_key_async`, which
+    follows the same policy but fetches on the event loop.
+    """
+
+    def __init__(self, app=None):
+        self.jwks_url = None
+        # The claims tokens signed with these keys must carry
+        self.issuer = None
+        self.audience = None
+        self.ttl = 600
+        self.refresh_ahead = 60
+        self.min_refetch_interval = 30
+        self.fetch_timeout = 5
+
+        self._keys = {}
+        self._fetched_at = None  # monotonic time of the last successful fetch
+        self._last_attempt = None  # monotonic time of the last fetch, successful or not
+        self._fetch_lock = threading.Lock()  # only one fetch runs at a time
+        self._background_lock = threading.Lock()
+        self._background_pending = False
+        # The same, for fetches on the event loop. Made on first use by
+        # _async_lock(): made here, it would belong to whatever loop is
+        # current at import time, not the one serving requests
+        self._async_fetch_lock = None
+        self._async_fetch_loop = None
+        self._background_task = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Reads the key store settings from the app config."""
+        app.config.setdefault('JWKS_CACHE_TTL', self.ttl)
+        app.config.setdefault('JWKS_REFRESH_AHEAD', self.refresh_ahead)
+        app.config.setdefault('JWKS_MIN_REFETCH_INTERVAL', self.min_refetch_interval)
+        app.config.setdefault('JWKS_FETCH_TIMEOUT', self.fetch_timeout)
+
+        self.jwks_url = app.config.get('AUTH0_JWKS_URL') or \
+            f"https://{app.config['AUTH0_DOMAIN']}/.well-known/jwks.json"
+        self.issuer = f"https://{app.config['AUTH0_DOMAIN']}/"
+        self.audience = app.config['AUTH0_AUDIENCE']
+        self.ttl = app.config['JWKS_CACHE_TTL']
+        self.refresh_ahead = app.config['JWKS_REFRESH_AHEAD']
+        self.min_refetch_interval = app.config['JWKS_MIN_REFETCH_INTERVAL']
+        self.fetch_timeout = app.config['JWKS_FETCH_TIMEOUT']
+
+        self.clear()
+
+        app.extensions['jwks'] = self
+
+    def get_key(self, kid):
+        """
+        Returns the parsed signing key for the given 'kid', or None if
+        Auth0 doesn't publish a key with that id.
+        """
+        now = time.monotonic()
+
+        if self._fetched_at is None or now - self._fetched_at >= self.ttl:
+            # Nothing cached yet, or the cached keys have expired
+            if self._may_fetch(now):
+                self._refresh('expired')
+            elif self._fetched_at is None:
+                # Another thread is fetching the first key set; wait for it
+                # rather than rejecting the token for want of keys
+                with self._fetch_lock:
+                    pass
+        elif now - self._fetched_at >= self.ttl - self.refresh_ahead:
+            # Still fresh, but close to expiry: refresh without blocking the request
+            if self._may_fetch(now):
+                self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and self._may_fetch(time.monotonic()):
+            # Auth0 may have rotated its keys since our last fetch
+            self._refresh('unknown_kid')
+            key = self._keys.get(kid)
+
+        return self._count_lookup(key)
+
+    async def get_key_async(self, kid):
+        """get_key for async handlers: waits for Auth0 without blocking the event loop."""
+        now = time.monotonic()
+
+        if self._fetched_at is None or now - self._fetched_at >= self.ttl:
+            if self._may_fetch(now):
+                await self._refresh_async('expired')
+            elif self._fetched_at is None:
+                async with self._async_lock():
+                    pass
+        elif now - self._fetched_at >= self.ttl - self.refresh_ahead:
+            if self._may_fetch(now) and (self._background_task is None or self._background_task.done()):
+                # A fresh context, so the fetch isn't counted against this request
+                self._background_task = asyncio.get_running_loop().create_task(
+                    self._refresh_async('background'), context=contextvars.Context()
+                )
+
+        key = self._keys.get(kid)
+        if key is None and self._may_fetch(time.monotonic()):
+            await self._refresh_async('unknown_kid')
+            key = self._keys.get(kid)
+
+        return self._count_lookup(key)
+
+    @staticmethod
+    def _count_lookup(key):
+        if key is None:
+            JWKS_CACHE_MISSES.inc()
+        else:
+            JWKS_CACHE_HITS.inc()
+        return key
+
+    def clear(self):
+        """Forgets all cached keys, so the next lookup fetches the JWKS again."""
+        with self._fetch_lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+
+    def prefetch(self):
+        """
+        Fetches the keys when none are cached or they are due for a refresh,
+        so requests find them fresh. Called by the health prober.
+        """
+        now = time.monotonic()
+        if self._fetched_at is None or now - self._fetched_at >= self.ttl - self.refresh_ahead:
+            if self._may_fetch(now):
+                self._refresh('prefetch')
+
+    def status(self):
+        """How many keys are cached and how old they are, without fetching."""
+        fetched_at = self._fetched_at
+        age = None if fetched_at is None else time.monotonic() - fetched_at
+        return {
+            'keys': len(self._keys),
+            'age_seconds': age,
+            'fresh': age is not None and age < self.ttl,
+        }
+
+    def has_key(self, kid):
+        """Checks the cached key set without triggering a fetch."""
+        return kid in self._keys
+
+    def _may_fetch(self, now):
+        """Rate limits fetches so a failing or abused endpoint isn't hammered."""
+        return self._last_attempt is None or now - self._last_attempt >= self.min_refetch_interval
+
+    def _refresh_in_background(self):
+        with self._background_lock:
+            if self._background_pending:
+                return
+            self._background_pending = True
+
+        def run():
+            try:
+                self._refresh('background')
+            finally:
+                with self._background_lock:
+                    self._background_pending = False
+
+        threading.Thread(target=run, name='jwks-refresh', daemon=True).start()
+
+    def _refresh(self, trigger):
+        requested_at = time.monotonic()
+        with self._fetch_lock:
+            # Another thread fetched while we were waiting for the lock
+            if self._last_attempt is not None and self._last_attempt >= requested_at:
+                return
+
+            self._last_attempt = time.monotonic()
+            try:
+                # Only counted when a request is waiting for it
+                with phase('jwks_fetch'):
+                    keys = self._fetch()
+            except Exception as e:
+                self._fetch_failed(trigger, e)
+                return
+            self._store(trigger, keys)
+
+    def _async_lock(self):
+        """The lock for fetches on the running event loop, made on that loop on first use."""
+        loop = asyncio.get_running_loop()
+        if self._async_fetch_loop is not loop:
+            self._async_fetch_lock = asyncio.Lock()
+            self._async_fetch_loop = loop
+        return self._async_fetch_lock
+
+    async def _refresh_async(self, trigger):
+        requested_at = time.monotonic()
+        async with self._async_lock():
+            if self._last_attempt is not None and self._last_attempt >= requested_at:
+                return
+
+            self._last_attempt = time.monotonic()
+            try:
+                with phase('jwks_fetch'):
+                    keys = await self._fetch_async()
+            except Exception as e:
+                self._fetch_failed(trigger, e)
+                return
+            self._store(trigger, keys)
+
+    def _store(self, trigger, keys):
+        # Swap the whole dict so readers never see a half-built key set
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+        JWKS_REFRESHES.labels(trigger=trigger, outcome='success').inc()
+
+    def _fetch_failed(self, trigger, error):
+        JWKS_REFRESHES.labels(trigger=trigger, outcome='failure').inc()
+        logger.warning(
+            "JWKS fetch failed, serving cached keys.",
+            extra={'trigger': trigger, 'error_message': str(error), 'cached_keys': len(self._keys)}
+        )
+
+    def _fetch(self):
+        """Downloads the JWKS document and parses every RSA key in it."""
+        with urlopen(self.jwks_url, timeout=self.fetch_timeout) as response:
+            return self._parse(json.loads(response.read()))
+
+    async def _fetch_async(self):
+        import httpx
+
+        async with httpx.AsyncClient(timeout=self.fetch_timeout) as client:
+            response = await client.get(self.jwks_url)
+            response.raise_for_status()
+            return self._parse(response.json())
+
+    @staticmethod
+    def _parse(jwks):
+        from jose import jwk
+
+        keys = {}
+        for key in jwks['keys']:
+            if key.get('kty') != 'RSA' or 'kid' not in key:
+                continue
+            rsa_key = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use'),
+                'n': key['n'],
+                'e': key['e']
+            }
+            keys[key['kid']] = jwk.construct(rsa_key, algorithm='RS256')
+        return keys
+
+
+key_store = JWKSKeyStore()
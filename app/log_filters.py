@@ -0,0 +1,152 @@
+# log_filters.py
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from flask import has_request_context, request
+from prometheus_client import Counter
+
+from .extensions import metrics
+
+# Records at this level or above are never sampled or rate limited
+ALWAYS_LOGGED_LEVEL = logging.ERROR
+
+# --- Log Filter Metrics ---
+LOG_RECORDS_SUPPRESSED = Counter(
+    'log_records_suppressed_total',
+    'Log records dropped by sampling or rate limiting, by level.',
+    ['level'],
+    registry=metrics.registry
+)
+
+
+class _Bucket:
+    __slots__ = ('tokens', 'updated', 'suppressed', 'record')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.suppressed = 0
+        # The last suppressed record, the template for the aggregate one
+        self.record = None
+
+
+class LogLimiter(logging.Filter):
+    """
+    Samples and rate limits log records before they are queued, so the
+    log volume of a route stays constant however much traffic it gets.
+
+    Records are grouped by message key: the Flask endpoint serving the
+    request (if any), the logger, the level and the unformatted message.
+    A record is first kept with the rule's `sample` probability, then
+    needs a token from its key's bucket, which holds `burst` tokens and
+    refills at `rate` per second. Errors always pass.
+
+    Rules are looked up by '<endpoint>:<LEVEL>', then '<endpoint>', then
+    '*:<LEVEL>', falling back to the default rule. Every `report_interval`
+    seconds one "suppressed N similar log records" record is emitted
+    through `emit` for each key that lost records: from `filter` while
+    records come in, else from whoever calls `report_due` (the logging
+    pipeline's listener, when its queue is idle).
+    """
+
+    def __init__(self, emit, rules=None, default_rate=10.0, default_burst=20,
+                 report_interval=60.0, max_keys=10000):
+        super().__init__()
+        self.emit = emit
+        self.default_rule = {'sample': 1.0, 'rate': default_rate, 'burst': default_burst}
+        self.rules = {key: dict(self.default_rule, **rule) for key, rule in (rules or {}).items()}
+        self.report_interval = report_interval
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_report = time.monotonic() + report_interval
+
+    def _rule(self, endpoint, level_name):
+        rules = self.rules
+        if endpoint is not None:
+            rule = rules.get(f'{endpoint}:{level_name}') or rules.get(endpoint)
+            if rule is not None:
+                return rule
+        return rules.get(f'*:{level_name}') or self.default_rule
+
+    def filter(self, record):
+        if record.levelno >= ALWAYS_LOGGED_LEVEL:
+            return True
+
+        endpoint = request.endpoint if has_request_context() else None
+        rule = self._rule(endpoint, record.levelname)
+        now = time.monotonic()
+        key = (endpoint, record.name, record.levelno, record.msg)
+
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = _Bucket(rule['burst'], now)
+                if len(self._buckets) > self.max_keys:
+                    self._evict()
+            else:
+                self._buckets.move_to_end(key)
+                bucket.tokens = min(rule['burst'], bucket.tokens + (now - bucket.updated) * rule['rate'])
+                bucket.updated = now
+
+            keep = rule['sample'] >= 1 or random.random() < rule['sample']
+            if keep and bucket.tokens >= 1:
+                bucket.tokens -= 1
+            else:
+                keep = False
+                bucket.suppressed += 1
+                bucket.record = record
+
+            due = now >= self._next_report
+            if due:
+                self._next_report = now + self.report_interval
+
+        if not keep:
+            LOG_RECORDS_SUPPRESSED.labels(level=record.levelname).inc()
+        if due:
+            self.report()
+        return keep
+
+    def report_due(self):
+        """Reports if `report_interval` has passed since the last report. Returns whether it did."""
+        now = time.monotonic()
+        with self._lock:
+            due = now >= self._next_report
+            if due:
+                self._next_report = now + self.report_interval
+        if due:
+            self.report()
+        return due
+
+    def _evict(self):
+        # Drops the least recently logged key, reporting what it suppressed
+        key, bucket = self._buckets.popitem(last=False)
+        if bucket.suppressed:
+            self.emit(self._aggregate(key, bucket))
+
+    def report(self):
+        """Emits one aggregate record per key that suppressed records since the last report."""
+        aggregates = []
+        with self._lock:
+            for key, bucket in self._buckets.items():
+                if bucket.suppressed:
+                    aggregates.append(self._aggregate(key, bucket))
+                    bucket.suppressed, bucket.record = 0, None
+        for aggregate in aggregates:
+            self.emit(aggregate)
+
+    @staticmethod
+    def _aggregate(key, bucket):
+        record = bucket.record
+        aggregate = logging.LogRecord(
+            record.name, record.levelno, record.pathname, record.lineno,
+            "Suppressed %d similar log records.", (bucket.suppressed,), None, record.funcName
+        )
+        aggregate.suppressed = bucket.suppressed
+        aggregate.suppressed_message = str(record.msg)
+        if key[0] is not None:
+            aggregate.endpoint = key[0]
+        return aggregate
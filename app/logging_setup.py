@@ -0,0 +1,267 @@
+# logging_setup.py
+import atexit
+import fcntl
+import logging
+import os
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from prometheus_client import Counter, Gauge
+from pythonjsonlogger import jsonlogger
+
+from .extensions import metrics
+from .log_filters import LogLimiter
+
+# Logging is asynchronous: every logger hands its records to a QueueHandler
+# on the root logger, which only puts them on an in-memory queue. A listener
+# thread per process takes them off the queue, formats them as JSON and
+# writes them to stderr and to a rotating log file of the process's own.
+# Before a record is queued, LogLimiter samples and rate limits it.
+
+LOG_FORMAT = '%(asctime)s %(name)s %(levelname)s %(message)s'
+
+# --- Logging Metrics ---
+LOG_RECORDS_DROPPED = Counter(
+    'log_records_dropped_total',
+    'Log records dropped because the logging queue was full.',
+    registry=metrics.registry
+)
+LOG_QUEUE_DEPTH = Gauge(
+    'log_queue_depth',
+    'Log records waiting to be written.',
+    registry=metrics.registry,
+    multiprocess_mode='max'
+)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    A QueueHandler that never blocks the thread that logs.
+
+    The record stays in this process, so unlike the stdlib handler it isn't
+    formatted here: only the message is merged with its args, and the JSON
+    formatting (including any traceback) happens on the listener thread.
+    When the queue is full the record is dropped and counted, and once
+    the queue has drained again a warning says how many were lost.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._reported_drops = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            # Reported once the queue has drained to half, not on every free slot
+            if self.dropped != self._reported_drops and self.queue.qsize() * 2 < self.queue.maxsize:
+                self.queue.put_nowait(self._drop_report())
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            LOG_RECORDS_DROPPED.inc()
+
+    def _drop_report(self):
+        dropped, self._reported_drops = self.dropped - self._reported_drops, self.dropped
+        record = logging.LogRecord(
+            __name__, logging.WARNING, __file__, 0,
+            "Dropped log records because the logging queue was full.", None, None
+        )
+        record.dropped = dropped
+        return record
+
+
+class _Listener(QueueListener):
+    # While no records come in, `on_idle` is called this often
+    idle_interval = 1.0
+
+    def __init__(self, queue, *handlers, respect_handler_level=False, on_idle=None):
+        super().__init__(queue, *handlers, respect_handler_level=respect_handler_level)
+        self.on_idle = on_idle
+
+    def dequeue(self, block):
+        while True:
+            try:
+                record = self.queue.get(block, timeout=self.idle_interval if self.on_idle else None)
+                break
+            except queue.Empty:
+                if not block or self.on_idle is None:
+                    raise
+                self.on_idle()
+        # Set here rather than read at scrape time, which multiprocess mode can't do
+        LOG_QUEUE_DEPTH.set(self.queue.qsize())
+        return record
+
+
+class LoggingPipeline:
+    """Owns the queue, the handler on the root logger and the listener thread."""
+
+    def __init__(self):
+        self.handler = None
+        self.listener = None
+        self.limiter = None
+        self._settings = None
+        self._lock = threading.Lock()
+        # This process's log file slot, held by a lock on the open file
+        self._slot = None
+        self._slot_lock = None
+
+    def configure(self, level='INFO', log_file=None, per_process_file=True,
+                  max_bytes=10000000, backup_count=5, queue_size=10000, limits=None):
+        """
+        (Re)configures the root logger. Safe to call more than once.
+        `limits` are the keyword arguments of the LogLimiter, or None for no limits.
+        """
+        with self._lock:
+            self._settings = dict(level=level, log_file=log_file, per_process_file=per_process_file,
+                                  max_bytes=max_bytes, backup_count=backup_count, queue_size=queue_size,
+                                  limits=limits)
+            self._start()
+
+    def _start(self):
+        self._stop()
+        settings = self._settings
+
+        formatter = jsonlogger.JsonFormatter(LOG_FORMAT)
+        handlers = [logging.StreamHandler(sys.stderr)]
+        if settings['log_file']:
+            handlers.append(RotatingFileHandler(
+                self._file_path(), maxBytes=settings['max_bytes'], backupCount=settings['backup_count'],
+                # Don't create the file until the first record is written
+                delay=True
+            ))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        log_queue = queue.Queue(maxsize=settings['queue_size'])
+        self.handler = NonBlockingQueueHandler(log_queue)
+        if settings['limits'] is not None:
+            self.limiter = LogLimiter(self._emit_unfiltered, **settings['limits'])
+            self.handler.addFilter(self.limiter)
+        # Suppressed records are reported on time even when nothing else is logged
+        self.listener = _Listener(log_queue, *handlers, respect_handler_level=True,
+                                  on_idle=self.limiter.report_due if self.limiter else None)
+        self.listener.start()
+
+        root = logging.getLogger()
+        root.setLevel(settings['level'])
+        root.addHandler(self.handler)
+
+    def _emit_unfiltered(self, record):
+        handler = self.handler
+        if handler is not None:
+            handler.enqueue(handler.prepare(record))
+
+    def _stop(self):
+        if self.limiter is not None:
+            # Says what was suppressed since the last report
+            self.limiter.report()
+            self.limiter = None
+        if self.handler is not None:
+            logging.getLogger().removeHandler(self.handler)
+        if self.listener is not None:
+            listener, self.listener = self.listener, None
+            try:
+                # Writes out whatever is still queued
+                listener.stop()
+            except Exception:
+                pass
+            for handler in listener.handlers:
+                handler.close()
+        self.handler = None
+
+    def _file_path(self):
+        """
+        With per_process_file, every process writes (and rotates) a file of
+        its own, so gunicorn workers never race on one. The files are named
+        by slot, not pid, e.g. logs/app.2.log: a process takes the lowest
+        slot no live process holds, so a restarted worker carries on with
+        the file of the one it replaced and the files don't pile up.
+        """
+        path = self._settings['log_file']
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if not self._settings['per_process_file']:
+            return path
+        stem, extension = os.path.splitext(path)
+        if self._slot is None:
+            self._slot = self._claim_slot(f'{stem}.{{}}{extension}.lock')
+        return f'{stem}.{self._slot}{extension}'
+
+    def _claim_slot(self, lock_path):
+        # The kernel releases a flock when its process exits, however it exits
+        slot = 0
+        while True:
+            lock = open(lock_path.format(slot), 'a')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                slot += 1
+                continue
+            self._slot_lock = lock
+            return slot
+
+    def after_fork(self):
+        # The listener thread doesn't survive fork(): a worker forked from a
+        # configured parent starts its own, writing to its own file
+        if self._settings is None:
+            return
+        self.listener = None
+        self.limiter = None
+        self._lock = threading.Lock()
+        if self._slot_lock is not None:
+            # Closing our copy leaves the parent's lock (and slot) in place
+            self._slot_lock.close()
+            self._slot = self._slot_lock = None
+        self._start()
+
+    def shutdown(self):
+        with self._lock:
+            self._stop()
+
+
+pipeline = LoggingPipeline()
+atexit.register(pipeline.shutdown)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=pipeline.after_fork)
+
+
+def init_app(app):
+    """Configures logging for the process from the LOG_* settings in Config."""
+    config = app.config
+    config.setdefault('LOG_LEVEL', 'INFO')
+    config.setdefault('LOG_FILE', None)
+    config.setdefault('LOG_FILE_PER_PROCESS', True)
+    config.setdefault('LOG_FILE_MAX_BYTES', 10000000)
+    config.setdefault('LOG_FILE_BACKUP_COUNT', 5)
+    config.setdefault('LOG_QUEUE_SIZE', 10000)
+    config.setdefault('LOG_LIMITS_ENABLED', True)
+    config.setdefault('LOG_LIMIT_RULES', {})
+    config.setdefault('LOG_RATE_LIMIT', 10.0)
+    config.setdefault('LOG_RATE_LIMIT_BURST', 20)
+    config.setdefault('LOG_SUPPRESSED_REPORT_INTERVAL', 60.0)
+
+    limits = None
+    if config['LOG_LIMITS_ENABLED']:
+        limits = {
+            'rules': config['LOG_LIMIT_RULES'],
+            'default_rate': config['LOG_RATE_LIMIT'],
+            'default_burst': config['LOG_RATE_LIMIT_BURST'],
+            'report_interval': config['LOG_SUPPRESSED_REPORT_INTERVAL'],
+        }
+
+    pipeline.configure(
+        level=config['LOG_LEVEL'],
+        log_file=config['LOG_FILE'],
+        per_process_file=config['LOG_FILE_PER_PROCESS'],
+        max_bytes=config['LOG_FILE_MAX_BYTES'],
+        backup_count=config['LOG_FILE_BACKUP_COUNT'],
+        queue_size=config['LOG_QUEUE_SIZE'],
+        limits=limits,
+    )
@@ -65,15 +65,119 @@ class Permission(db.Model):
         return self.name
 
 class AuditLog(db.Model):
+    # Range-partitioned by month on created_at (see app/audit_partitions.py),
+    # which is why created_at is part of the primary key.
     __tablename__ = 'audit_logs'
+    __table_args__ = (
+        db.Index('ix_audit_logs_user_id_created_at', 'user_id', 'created_at'),
+        db.Index('ix_audit_logs_created_at_id', 'created_at', 'id'),
+    )
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     # This foreign key correctly points to your local user ID
     user_id = db.Column(UUID(as_uuid=True), db.ForeignKey('users.id'), nullable=True) # Nullable for system actions
     action = db.Column(db.String(255), nullable=False)
     details = db.Column(JSONB)
-    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    created_at = db.Column(db.DateTime, primary_key=True, server_default=db.func.now())
 
     user = db.relationship('User', backref='audit_logs')
 
     def __repr__(self):
-        return f'<AuditLog {self.action} by User {self.user_id}>'
\ No newline at end of file
+        return f'<AuditLog {self.action} by User {self.user_id}>'
+
+class StripeEvent(db.Model):
+    # Inbox of Stripe webhook events, keyed by Stripe's event id.
+    # The webhook endpoint only inserts here; app/webhook_inbox.py applies them.
+    __tablename__ = 'stripe_events'
+    __table_args__ = (
+        db.Index('ix_stripe_events_pending', 'stripe_created', 'id',
+                 postgresql_where=db.text("status = 'pending'")),
+        db.Index('ix_stripe_events_pending_customer', 'customer_key', 'stripe_created', 'id',
+                 postgresql_where=db.text("status = 'pending'")),
+    )
+    id = db.Column(db.String(255), primary_key=True) # e.g. 'evt_1Nv...'
+    type = db.Column(db.String(255), nullable=False)
+    # Events for the same customer are applied in order; events without a customer use their own id
+    customer_key = db.Column(db.String(255), nullable=False)
+    stripe_created = db.Column(db.BigInteger, nullable=False) # Stripe's 'created' (unix seconds)
+    payload = db.Column(JSONB, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending', server_default='pending') # pending, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_error = db.Column(db.Text)
+    received_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+    next_attempt_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+    processed_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<StripeEvent {self.id} {self.type} {self.status}>'
+
+class StripeSubscriptionSnapshot(db.Model):
+    # Subscriptions as listed by `flask subscriptions reconcile`, one row per
+    # Stripe subscription. Rebuilt from scratch by every new reconciliation run.
+    __tablename__ = 'stripe_subscription_snapshot'
+    __table_args__ = (
+        db.Index('ix_stripe_subscription_snapshot_customer_id', 'customer_id'),
+    )
+    id = db.Column(db.String(255), primary_key=True) # e.g. 'sub_1Nv...'
+    customer_id = db.Column(db.String(255), nullable=False)
+    status = db.Column(db.String(50), nullable=False)
+    created = db.Column(db.BigInteger, nullable=False) # Stripe's 'created' (unix seconds)
+    # The subscription's metadata.user_id, set at checkout: links it to a
+    # user whose checkout.session.completed never arrived
+    user_id = db.Column(db.String(255), nullable=True)
+
+    def __repr__(self):
+        return f'<StripeSubscriptionSnapshot {self.id} {self.status}>'
+
+class SubscriptionSyncWindow(db.Model):
+    # Checkpoints of a reconciliation run: the subscriptions are listed in
+    # windows of creation time, and each window remembers the last subscription
+    # stored so an interrupted run picks up where it stopped.
+    __tablename__ = 'subscription_sync_windows'
+    created_from = db.Column(db.BigInteger, primary_key=True) # inclusive, unix seconds
+    created_to = db.Column(db.BigInteger, nullable=False) # exclusive
+    last_subscription_id = db.Column(db.String(255))
+    fetched = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    completed = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    run_started_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+
+    def __repr__(self):
+        return f'<SubscriptionSyncWindow {self.created_from}-{self.created_to}>'
+
+class UserImport(db.Model):
+    # Checkpoints of `flask users import` (see app/services/user_import.py):
+    # how far into its export each import got, so an interrupted one can be
+    # resumed. Every batch moves the checkpoint in the transaction that
+    # merges it.
+    __tablename__ = 'user_imports'
+    id = db.Column(db.Integer, primary_key=True)
+    source = db.Column(db.Text, nullable=False) # path of the export file
+    position = db.Column(db.BigInteger, nullable=False, default=0, server_default='0') # bytes read
+    lines = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    created = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    skipped = db.Column(db.BigInteger, nullable=False, default=0, server_default='0') # already onboarded
+    # new users whose email already belongs to another user, which onboarding rejects
+    email_conflicts = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    invalid = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    started_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+    updated_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<UserImport {self.id} {self.source} at {self.lines}>'
+
+class StripeSessionCache(db.Model):
+    # The last Checkout / Billing Portal session handed to each user, reused
+    # until it expires (see app/services/stripe_session_cache.py). UNLOGGED:
+    # it is only a cache, so it skips the WAL and may be emptied by a crash.
+    __tablename__ = 'stripe_session_cache'
+    __table_args__ = {'prefixes': ['UNLOGGED']}
+    user_id = db.Column(UUID(as_uuid=True), db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    operation = db.Column(db.String(20), primary_key=True) # 'checkout' or 'portal'
+    # Hash of the parameters the session was created with; a change makes the entry stale
+    fingerprint = db.Column(db.String(64), nullable=False)
+    session_id = db.Column(db.String(255), nullable=False)
+    url = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<StripeSessionCache {self.operation} for User {self.user_id}>'
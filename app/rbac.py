@@ -0,0 +1,179 @@
+# rbac.py
+import threading
+import time
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from .cache import TTLCache
+from .extensions import db
+from .models import Permission, Role, User, role_permissions, user_roles
+
+
+class PermissionGraph:
+    """
+    An immutable snapshot of the role -> permission graph.
+
+    Each role's permissions are kept as a frozenset of names, and the union
+    for every combination of roles a user can hold is computed once and
+    memoized, so a permission check is a single set membership test no
+    matter how many roles or permissions exist.
+    """
+
+    # Caps the memo of role combinations; real users share a handful of them
+    MAX_COMBINATIONS = 4096
+
+    def __init__(self, rows):
+        """:param rows: iterable of (role_id, permission_name) pairs."""
+        role_sets = {}
+        for role_id, permission in rows:
+            role_sets.setdefault(role_id, set()).add(permission)
+
+        self.role_permissions = {role_id: frozenset(names) for role_id, names in role_sets.items()}
+        self._combinations = {}
+
+    def permissions_for(self, role_ids):
+        """Returns the effective permissions of a frozenset of role ids."""
+        permissions = self._combinations.get(role_ids)
+        if permissions is None:
+            permissions = frozenset().union(
+                *(self.role_permissions.get(role_id, ()) for role_id in role_ids)
+            )
+            if len(self._combinations) >= self.MAX_COMBINATIONS:
+                self._combinations.clear()
+            self._combinations[role_ids] = permissions
+        return permissions
+
+    def has_permission(self, role_ids, permission):
+        return permission in self.permissions_for(role_ids)
+
+
+class RBACEngine:
+    """
+    Resolves a user's permissions from the roles, permissions, user_roles and
+    role_permissions tables without querying them on every request.
+
+    - The whole role -> permission graph is loaded into a PermissionGraph on
+      first use and reloaded after RBAC_GRAPH_TTL seconds, or right away when
+      this process commits a change to a Role, a Permission or a user's roles.
+    - Each user's role ids are fetched with one query and cached for
+      RBAC_USER_CACHE_TTL seconds, keyed by Auth0 'sub'.
+
+    Other workers pick up role changes once their TTLs run out.
+    """
+
+    def __init__(self, app=None):
+        self.graph_ttl = 300
+        self.user_cache_ttl = 60
+        self.user_cache_size = 10000
+
+        self._graph = None
+        self._graph_loaded_at = None
+        self._graph_lock = threading.Lock()
+        self._user_roles = TTLCache(self.user_cache_size, self.user_cache_ttl)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Reads the RBAC settings from the app config."""
+        app.config.setdefault('RBAC_GRAPH_TTL', self.graph_ttl)
+        app.config.setdefault('RBAC_USER_CACHE_TTL', self.user_cache_ttl)
+        app.config.setdefault('RBAC_USER_CACHE_SIZE', self.user_cache_size)
+
+        self.graph_ttl = app.config['RBAC_GRAPH_TTL']
+        self.user_cache_ttl = app.config['RBAC_USER_CACHE_TTL']
+        self.user_cache_size = app.config['RBAC_USER_CACHE_SIZE']
+        self._user_roles = TTLCache(self.user_cache_size, self.user_cache_ttl)
+        self._graph = None
+
+        app.extensions['rbac'] = self
+
+    # --- Loading ---
+
+    def load_graph(self):
+        """Reads every (role_id, permission_name) edge in one query."""
+        rows = db.session.execute(
+            select(role_permissions.c.role_id, Permission.name)
+            .join(Permission, Permission.id == role_permissions.c.permission_id)
+        ).all()
+        return PermissionGraph(rows)
+
+    def load_user_roles(self, auth0_user_id):
+        """Reads the role ids assigned to a user in one query."""
+        role_ids = db.session.execute(
+            select(user_roles.c.role_id)
+            .join(User, User.id == user_roles.c.user_id)
+            .where(User.auth0_user_id == auth0_user_id)
+        ).scalars()
+        return frozenset(role_ids)
+
+    @property
+    def graph(self):
+        now = time.monotonic()
+        graph = self._graph
+        if graph is None or now - self._graph_loaded_at >= self.graph_ttl:
+            with self._graph_lock:
+                if self._graph is graph:
+                    self._graph = self.load_graph()
+                    self._graph_loaded_at = time.monotonic()
+                graph = self._graph
+        return graph
+
+    # --- Lookups ---
+
+    def role_ids_for(self, auth0_user_id):
+        role_ids = self._user_roles.get(auth0_user_id)
+        if role_ids is None:
+            role_ids = self.load_user_roles(auth0_user_id)
+            self._user_roles.set(auth0_user_id, role_ids)
+        return role_ids
+
+    def permissions_for(self, auth0_user_id):
+        """Returns the user's effective permissions as a frozenset of names."""
+        return self.graph.permissions_for(self.role_ids_for(auth0_user_id))
+
+    def has_permission(self, auth0_user_id, permission):
+        return self.graph.has_permission(self.role_ids_for(auth0_user_id), permission)
+
+    # --- Invalidation ---
+
+    def invalidate(self):
+        """Drops the cached graph and every cached user, e.g. after roles were edited."""
+        with self._graph_lock:
+            self._graph = None
+        self._user_roles.clear()
+
+    def invalidate_user(self, auth0_user_id):
+        """Drops one user's cached roles, e.g. after a role was assigned to them."""
+        self._user_roles.delete(auth0_user_id)
+
+
+rbac = RBACEngine()
+
+
+# --- ORM change tracking ---
+# Flushes that touch roles or permissions are noted on the session,
+# and the caches are only invalidated once that transaction commits.
+
+@event.listens_for(Session, 'after_flush')
+def _track_rbac_changes(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, (Role, Permission)):
+            session.info['rbac_graph_changed'] = True
+        elif isinstance(obj, User) and inspect(obj).attrs.roles.history.has_changes():
+            session.info.setdefault('rbac_changed_users', set()).add(obj.auth0_user_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_rbac_invalidation(session):
+    if session.info.pop('rbac_graph_changed', False):
+        rbac.invalidate()
+    for auth0_user_id in session.info.pop('rbac_changed_users', ()):
+        rbac.invalidate_user(auth0_user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_rbac_changes(session):
+    session.info.pop('rbac_graph_changed', None)
+    session.info.pop('rbac_changed_users', None)
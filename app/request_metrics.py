@@ -0,0 +1,289 @@
+# request_metrics.py
+import logging
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import current_app, request
+from prometheus_client import Counter, Histogram
+from sqlalchemy import event
+
+from .extensions import db, metrics
+
+# Breaks each request's time down into phases, per endpoint:
+#   auth        verifying the bearer token in requires_auth (includes jwks_fetch)
+#   jwks_fetch  downloading Auth0's signing keys while the request waits
+#   db          executing SQL statements (not waiting for a pooled connection,
+#               see db_pool_checkout_wait_seconds)
+#   stripe      Stripe API calls, including retries and backoff
+# Phases a request didn't go through aren't observed for it.
+#
+# The running request's times live in a context variable rather than on `g`,
+# so the same hooks work for the Flask app and the async app (app/async_app.py).
+#
+# The same engine events also watch the SQL itself:
+#   - statements slower than DB_SLOW_QUERY_MS are logged, with their
+#     normalized SQL and the shape (names and types) of their parameters,
+#     never the values
+#   - a statement run DB_REPEATED_QUERY_THRESHOLD times or more in one
+#     request is logged as a probable N+1, e.g. a relationship lazy-loaded
+#     in a loop (User.roles, Role.permissions or a lazy='dynamic' backref)
+#   - a route declared with @query_budget(n) that runs more than n
+#     statements is logged, or fails with QueryBudgetExceeded when the app
+#     is testing or DB_QUERY_BUDGET_STRICT is set
+
+logger = logging.getLogger(__name__)
+
+PHASE_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+# --- Request Phase Metrics ---
+REQUEST_PHASE_SECONDS = Histogram(
+    'request_phase_seconds',
+    'Time a request spent in each phase (auth, jwks_fetch, db, stripe), by endpoint.',
+    ['endpoint', 'phase'],
+    registry=metrics.registry,
+    buckets=PHASE_BUCKETS
+)
+REQUEST_DB_QUERIES = Histogram(
+    'request_db_queries',
+    'SQL statements executed per request, by endpoint.',
+    ['endpoint'],
+    registry=metrics.registry,
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+)
+DB_QUERY_SECONDS = Histogram(
+    'db_query_seconds',
+    'Time to execute one SQL statement, in and outside of requests.',
+    registry=metrics.registry,
+    buckets=PHASE_BUCKETS
+)
+DB_SLOW_QUERIES = Counter(
+    'db_slow_queries_total',
+    'SQL statements slower than DB_SLOW_QUERY_MS, by endpoint (none outside of requests).',
+    ['endpoint'],
+    registry=metrics.registry
+)
+DB_REPEATED_QUERIES = Counter(
+    'db_repeated_queries_total',
+    'Statements run DB_REPEATED_QUERY_THRESHOLD times or more in one request (probable N+1), by endpoint.',
+    ['endpoint'],
+    registry=metrics.registry
+)
+DB_QUERY_BUDGET_EXCEEDED = Counter(
+    'db_query_budget_exceeded_total',
+    'Requests that ran more SQL statements than their route\'s query_budget, by endpoint.',
+    ['endpoint'],
+    registry=metrics.registry
+)
+
+# Set from the app's config by init_app
+settings = {
+    'slow_query_seconds': 0.1,
+    'repeated_query_threshold': 5,
+}
+
+# Longest normalized SQL that is logged
+MAX_LOGGED_SQL = 2000
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised when a route runs more SQL statements than its declared query_budget."""
+
+
+class RequestPhases:
+    """The phase times and SQL statements of one request."""
+
+    __slots__ = ('endpoint', 'seconds', 'queries', 'statements')
+
+    def __init__(self, endpoint=None):
+        self.endpoint = endpoint
+        self.seconds = {}
+        self.queries = 0
+        # How many times each statement (by its SQL text) ran
+        self.statements = {}
+
+
+_current = ContextVar('request_phases', default=None)
+
+
+def begin_request(endpoint=None):
+    """Starts collecting phase times for the request (to `endpoint`) running in this context."""
+    _current.set(RequestPhases(endpoint))
+
+
+def end_request(endpoint):
+    """Observes the current request's phases under `endpoint` and stops collecting."""
+    phases = _current.get()
+    if phases is None:
+        return
+    _current.set(None)
+    for name, seconds in phases.seconds.items():
+        REQUEST_PHASE_SECONDS.labels(endpoint=endpoint, phase=name).observe(seconds)
+    REQUEST_DB_QUERIES.labels(endpoint=endpoint).observe(phases.queries)
+
+    threshold = settings['repeated_query_threshold']
+    for statement, count in phases.statements.items():
+        if count >= threshold:
+            DB_REPEATED_QUERIES.labels(endpoint=endpoint).inc()
+            logger.warning("Repeated SQL statement, probably an N+1 query.", extra={
+                'endpoint': endpoint, 'sql': normalize_sql(statement), 'executions': count,
+            })
+
+
+def query_budget(max_queries):
+    """
+    Declares that the decorated route runs at most `max_queries` SQL
+    statements per request. Put it right below @route, on Flask and async
+    routes alike.
+    """
+    def decorator(f):
+        f.query_budget = max_queries
+        return f
+    return decorator
+
+
+def check_query_budget(view, strict):
+    """
+    Enforces the query_budget of `view`, the running request's route:
+    raises QueryBudgetExceeded if `strict`, logs otherwise. Statements run
+    while a streamed response is sent come afterwards and aren't counted.
+    """
+    phases = _current.get()
+    budget = getattr(view, 'query_budget', None)
+    if phases is None or budget is None or phases.queries <= budget:
+        return
+
+    endpoint = phases.endpoint
+    DB_QUERY_BUDGET_EXCEEDED.labels(endpoint=endpoint).inc()
+    statements = sorted(phases.statements.items(), key=lambda item: item[1], reverse=True)
+    if strict:
+        listing = '\n'.join(f'  {count} x {normalize_sql(statement)}' for statement, count in statements)
+        raise QueryBudgetExceeded(
+            f"{endpoint} ran {phases.queries} SQL statements, over its budget of {budget}:\n{listing}"
+        )
+    logger.warning("Route ran more SQL statements than its query budget.", extra={
+        'endpoint': endpoint, 'queries': phases.queries, 'query_budget': budget,
+        'statements': [{'sql': normalize_sql(statement), 'executions': count} for statement, count in statements[:10]],
+    })
+
+
+def query_budget_strict(app):
+    return app.testing or app.config['DB_QUERY_BUDGET_STRICT']
+
+
+def add_phase_time(phase, seconds):
+    """Adds `seconds` to the current request's `phase`. Does nothing outside of requests."""
+    phases = _current.get()
+    if phases is not None:
+        phases.seconds[phase] = phases.seconds.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def phase(name):
+    """Times the block as part of the current request's `name` phase."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase_time(name, time.perf_counter() - started)
+
+
+_WHITESPACE = re.compile(r'\s+')
+# Quoted strings and numbers, but not the digits of a name or of a $1 placeholder
+_LITERAL = re.compile(r"'(?:[^']|'')*'|(?<![\w$])\d+(?:\.\d+)?\b")
+# An IN list of bound parameters, whose length varies with its values
+_PLACEHOLDER = r'(?:%\(\w+\)s|%s|\$\d+|\?|:\w+)'
+_PLACEHOLDER_LIST = re.compile(rf'\(\s*{_PLACEHOLDER}(?:\s*,\s*{_PLACEHOLDER})+\s*\)')
+
+
+def normalize_sql(statement):
+    """
+    `statement` on one line, with literals replaced by ? and lists of
+    bound parameters by (...), so statements differing only in their
+    values read the same.
+    """
+    statement = _PLACEHOLDER_LIST.sub('(...)', statement)
+    statement = _LITERAL.sub('?', statement)
+    statement = _WHITESPACE.sub(' ', statement).strip()
+    if len(statement) > MAX_LOGGED_SQL:
+        statement = statement[:MAX_LOGGED_SQL] + '...'
+    return statement
+
+
+def parameters_shape(parameters, executemany=False):
+    """The names (or positions) and types of a statement's parameters, without their values."""
+    if executemany:
+        return {'rows': len(parameters), 'row': parameters_shape(parameters[0]) if parameters else None}
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['query_started'].pop()
+    DB_QUERY_SECONDS.observe(seconds)
+    phases = _current.get()
+    if phases is not None:
+        phases.seconds['db'] = phases.seconds.get('db', 0.0) + seconds
+        phases.queries += 1
+        phases.statements[statement] = phases.statements.get(statement, 0) + 1
+
+    if seconds >= settings['slow_query_seconds']:
+        endpoint = phases.endpoint if phases is not None else None
+        if endpoint is not None:
+            DB_SLOW_QUERIES.labels(endpoint=endpoint).inc()
+        logger.warning("Slow SQL statement.", extra={
+            'endpoint': endpoint, 'duration_ms': round(seconds * 1000, 1),
+            'sql': normalize_sql(statement), 'parameters': parameters_shape(parameters, executemany),
+        })
+
+
+def _handle_error(exception_context):
+    # after_cursor_execute doesn't run for failed statements
+    started = exception_context.connection.info.get('query_started') if exception_context.connection else None
+    if started:
+        started.pop()
+
+
+def _begin_request():
+    begin_request(request.endpoint)
+
+
+def _check_request(response):
+    check_query_budget(current_app.view_functions.get(request.endpoint), query_budget_strict(current_app))
+    return response
+
+
+def _observe_request(exception=None):
+    end_request(request.endpoint or 'unmatched')
+
+
+def instrument_engine(engine):
+    """Times every SQL statement `engine` runs (for an AsyncEngine, pass its sync_engine)."""
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(engine, 'handle_error', _handle_error)
+
+
+def init_app(app):
+    """Times the app's SQL statements and reports every request's phases when it ends."""
+    app.config.setdefault('DB_SLOW_QUERY_MS', settings['slow_query_seconds'] * 1000)
+    app.config.setdefault('DB_REPEATED_QUERY_THRESHOLD', settings['repeated_query_threshold'])
+    app.config.setdefault('DB_QUERY_BUDGET_STRICT', False)
+    settings['slow_query_seconds'] = app.config['DB_SLOW_QUERY_MS'] / 1000
+    settings['repeated_query_threshold'] = app.config['DB_REPEATED_QUERY_THRESHOLD']
+
+    with app.app_context():
+        instrument_engine(db.engine)
+
+    app.before_request(_begin_request)
+    app.after_request(_check_request)
+    app.teardown_request(_observe_request)
@@ -1,46 +1,23 @@
-from flask import Blueprint, jsonify, g, current_app, request
+from flask import Blueprint, Response, jsonify, g, current_app, request, stream_with_context
 import logging
 import os
-import stripe
-from prometheus_flask_exporter import PrometheusMetrics
-from logging.handlers import RotatingFileHandler
-from pythonjsonlogger import jsonlogger
-from .utils import requires_auth
-from . import models, database
-from sqlalchemy.orm import Session
-
-# --- Setup Prometheus Metrics ---
-
-# --- Setup Logging ---
-# Create a logger
-log_directory = os.path.dirname(os.path.abspath(__file__))
-log_file_path = os.path.join(log_directory, '..', 'app.log') # Assumes this code is in the 'app' directory
-
-# 2. Create a logger
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-
-# 3. Create a handler to write to a file
-# Using RotatingFileHandler is a good practice
-logHandler = RotatingFileHandler(log_file_path, maxBytes=1000000, backupCount=5)
-
-# 4. Create a JSON formatter
-formatter = jsonlogger.JsonFormatter('%(asctime)s %(name)s %(levelname)s %(message)s')
-
-consoleHandler = logging.StreamHandler() 
-consoleHandler.setFormatter(formatter) # Use the same JSON formatter
-logger.addHandler(consoleHandler)
-
-# 5. Set the formatter and add the handler
-logHandler.setFormatter(formatter)
-logger.addHandler(logHandler)
-# --- End Logging Setup ---
+from .utils import requires_auth, requires_permission
+from .request_metrics import query_budget
+from .extensions import db, metrics
+from . import models
+from .services import audit_service, stripe_session_cache, user_service
+from .services.stripe_service import StripeUnavailable
+from .audit import audit
+from .health import health_prober
+from .rbac import rbac
+from .user_status_cache import user_status_cache
+from . import webhook_inbox
+
+# Logging is configured once per process in create_app (see app/logging_setup.py)
 
 # 1. Create a Blueprint object
 main = Blueprint('main', __name__)
-metrics = PrometheusMetrics(main)
-stripe.api_key = os.getenv('STRIPE_API_KEY')
+metrics.init_app(main)
 
 @main.route('/')
 def me():
@@ -48,20 +25,33 @@ def me():
     return "Welcome!"
 
 # 2. Define the route on the Blueprint, not on 'app'
+# Probes arrive every few seconds from every pod: they neither log nor touch the database
 @main.route('/health')
+@main.route('/health/live')
+@query_budget(0)
 def health_check():
-    print(f"Health check endpoint was called.")
-    logging.info(" check endpoint was called.")
+    """Liveness: the process is up and serving requests."""
     return jsonify({"status": "healthy"}), 200
 
+@main.route('/health/ready')
+@query_budget(0)
+def readiness_check():
+    """
+    Readiness: the dependency checks last run by the health prober
+    (see app/health.py). 503 while the process can't serve requests.
+    """
+    report, ready = health_prober.report()
+    return jsonify(report), 200 if ready else 503
+
 @main.route('/api/user/onboard', methods=['POST'])
+@query_budget(2)
 @requires_auth # This decorator validates the JWT and attaches the payload
 def sync_user():
     """
     Handles user onboarding after successful Auth0 login.
-    - Checks if a user exists based on their Auth0 ID ('sub' claim).
-    - If not, creates a new user, assigns a default role, and logs the action.
-    - If the user exists, it does nothing.
+    - Creates the user keyed by their Auth0 ID ('sub' claim), assigns a
+      default role and logs the action, all in a single statement.
+    - If the user exists, it does nothing (concurrent onboards are no-ops).
     """
     # 1. Get user info from the validated Auth0 token payload
     logging.info(f"An error occurred during user onboarding:")
@@ -76,83 +66,52 @@ def sync_user():
             "description": "Auth0 token payload is missing 'sub' or 'email'."
         }), 400
 
-    db: Session = database.SessionLocal()
     try:
-        # 2. Check if the user already exists in our database
-        existing_user = db.query(models.User).filter(
-            models.User.auth0_user_id == auth0_user_id
-        ).first()
-
-        if existing_user:
+        # 2. Create the user, assign the default role and write the audit log
+        # in one round trip. If the user already exists this is a no-op.
+        new_user_id = user_service.onboard_user(auth0_user_id, email)
+        db.session.commit()
+        # Roles were assigned with a Core INSERT, which the ORM hooks don't see
+        rbac.invalidate_user(auth0_user_id)
+
+        if new_user_id is None:
             return jsonify({
                 "status": "success", 
                 "message": "User already exists."
             }), 200
 
-        # --- User does not exist, proceed with creation ---
-
-        # 3. Find the default role to assign to the new user
-        # This assumes you have a 'user' role seeded in your database.
-        default_role = db.query(models.Role).filter(models.Role.name == 'user').first()
-        if not default_role:
-            # This is a server configuration error, so we should log it and fail.
-            print("CRITICAL: Default role 'user' not found in the database.")
-            return jsonify({
-                "code": "server_error",
-                "description": "Server configuration error: default role missing."
-            }), 500
-
-        # 4. Create the new user instance
-        new_user = models.User(
-            auth0_user_id=auth0_user_id,
-            email=email
-            # subscription_plan defaults to 'free' as per the model
-        )
-        
-        # 5. Assign the default role
-        new_user.roles.append(default_role)
-        db.add(new_user)
-        
-        # We must flush the session to get the generated UUID for the new_user.id
-        # This is necessary before creating the audit log entry that references it.
-        db.flush()
-
-        # 6. Create an audit log for the user creation event
-        audit_log_entry = models.AuditLog(
-            user_id=new_user.id,
-            action='user.created',
-            details={"source": "auth0_onboarding", "assigned_roles": ["user"]}
-        )
-        db.add(audit_log_entry)
-
-        # 7. Commit all changes to the database
-        db.commit()
-        
         return jsonify({
             "status": "success",
             "message": "New user created and assigned default role."
         }), 201
 
+    except user_service.DefaultRoleMissing:
+        # This is a server configuration error, so we should log it and fail.
+        db.session.rollback()
+        print("CRITICAL: Default role 'user' not found in the database.")
+        return jsonify({
+            "code": "server_error",
+            "description": "Server configuration error: default role missing."
+        }), 500
+
     except Exception as e:
-        db.rollback()
+        db.session.rollback()
         print(f"An error occurred during user onboarding: {e}")
         return jsonify({
             "code": "server_error",
             "description": "An unexpected error occurred."
         }), 500
-    finally:
-        db.close()
 
 @main.route('/api/create-checkout-session', methods=['POST'])
+@query_budget(3)
 @requires_auth # Ensures only a logged-in user can start a checkout
 def create_checkout_session():
     """
     Creates a Stripe Checkout session for the authenticated user.
     """
-    db: Session = database.SessionLocal()
     try:
         auth0_user_id = g.current_user.get('sub')
-        user = db.query(models.User).filter(models.User.auth0_user_id == auth0_user_id).first()
+        user = db.session.query(models.User).filter(models.User.auth0_user_id == auth0_user_id).first()
 
         if not user:
             return jsonify({"error": "User not found"}), 404
@@ -160,38 +119,34 @@ def create_checkout_session():
         price_id = os.getenv('STRIPE_PRICE_ID')
         frontend_url = os.getenv('NEXT_PUBLIC_APP_URL')
 
-        # Create a new checkout session
-        checkout_session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[
-                {
-                    'price': price_id,
-                    'quantity': 1,
-                },
-            ],
-            mode='subscription',
+        # Reuse the user's open checkout session, or create a new one
+        checkout_url = stripe_session_cache.checkout_url(
+            user,
+            price_id=price_id,
             # These are the URLs Stripe will redirect to after the checkout
             success_url=f'{frontend_url}/dashboard?success=true',
-            cancel_url=f'{frontend_url}/dashboard?canceled=true',
-            # CRITICAL: This securely links the Stripe session to your internal user ID
-            client_reference_id=str(user.id)
+            cancel_url=f'{frontend_url}/dashboard?canceled=true'
         )
         
         # Return the session URL to the frontend
-        return jsonify({'url': checkout_session.url})
+        return jsonify({'url': checkout_url})
 
+    except StripeUnavailable as e:
+        current_app.logger.error(f"Stripe session creation failed: {e}")
+        return jsonify(error="Payments are temporarily unavailable, please try again shortly."), 503
     except Exception as e:
         current_app.logger.error(f"Stripe session creation failed: {e}")
         return jsonify(error=str(e)), 500
-    finally:
-        db.close()
 
 @main.route('/stripe-webhook', methods=['POST'])
+@query_budget(1)
 def stripe_webhook():
     """
     Handles incoming webhook events from Stripe to fulfill orders.
     This endpoint is public but secured by verifying the Stripe signature.
     """
+    import stripe  # imported on first use, see app/startup.py
+
     payload = request.data
     sig_header = request.headers.get('Stripe-Signature')
     endpoint_secret = os.getenv('STRIPE_WEBHOOK_SECRET')
@@ -209,49 +164,16 @@ def stripe_webhook():
         # Invalid signature
         return 'Invalid signature', 400
 
+    # Store the event and acknowledge it straight away; the stripe-inbox
+    # workers apply it (see app/webhook_inbox.py). Stripe redelivers
+    # anything we don't acknowledge with a 2xx, so a failed insert is safe.
     try:
-        # Handle the 'checkout.session.completed' event
-        if event['type'] == 'checkout.session.completed':
-            session = event['data']['object']
-            
-            # Retrieve our internal user ID from the session metadata
-            user_id = session.get('client_reference_id')
-            stripe_customer_id = session.get('customer')
-
-            if not user_id or not stripe_customer_id:
-                return "Webhook Error: Missing required data in session.", 400
-
-            db: Session = database.SessionLocal()
-            # Find the user and update their subscription status in our database
-            user = db.query(models.User).filter(models.User.id == user_id).first()
-            if user:
-                user.subscription_plan = 'premium'
-                user.stripe_customer_id = stripe_customer_id
-                db.commit()
-                current_app.logger.info(f"User {user.email} subscription updated to premium.")
-        elif event['type'] == 'customer.subscription.deleted':
-            # --- This handles CANCELLATIONS ---
-            session = event['data']['object']
-            
-            # Retrieve our internal user ID from the session metadata
-            stripe_customer_id = session.get('customer')
-            if not stripe_customer_id:
-                return "Webhook Error: Missing required data in session.", 400
-            
-            db: Session = database.SessionLocal()
-            # Find the user and update their subscription status in our database
-            user = db.query(models.User).filter(models.User.stripe_customer_id == stripe_customer_id).first()
-            if user:
-                user.subscription_plan = 'free'
-                db.commit()
-                current_app.logger.info(f"User {user.email} plan canceled, set to 'free'.")
-        # Add handling for other event types as needed
+        webhook_inbox.store_event(event, payload)
+        db.session.commit()
     except Exception as e:
-            db.rollback()
-            current_app.logger.error(f"Webhook DB update failed: {e}")
-            return "Server error during DB update", 500
-    finally:
-        db.close()
+        db.session.rollback()
+        current_app.logger.error(f"Storing webhook event failed: {e}")
+        return "Server error while storing event", 500
 
     return 'Success', 200
 
@@ -282,42 +204,43 @@ def trigger_error():
     
 
 @main.route('/api/user/status')
+@query_budget(1)
 @requires_auth # Ensures only authenticated users can access this endpoint
 def user_status():
     """
     Returns the subscription status of the authenticated user.
     """
-    db: Session = database.SessionLocal()
     try:
         auth0_user_id = g.current_user.get('sub')
-        user = db.query(models.User).filter(models.User.auth0_user_id == auth0_user_id).first()
+        # Served from the per-worker cache, which is invalidated on every plan change
+        entry = user_status_cache.get(auth0_user_id)
 
-        if not user:
+        if entry is None:
             return jsonify({"error": "User not found"}), 404
 
-        return jsonify({
-            "email": user.email,
-            "subscription_plan": user.subscription_plan
-        })
+        status, etag = entry
+        response = jsonify(status)
+        response.set_etag(etag)
+        # The browser revalidates on every poll; an unchanged status costs a 304
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
 
     except Exception as e:
         current_app.logger.error(f"Failed to fetch user status: {e}")
         return jsonify(error="Server error"), 500
-    finally:
-        db.close()
 
 @main.route('/api/create-portal-session', methods=['POST'])
+@query_budget(3)
 @requires_auth # Ensures only an authenticated user can access this
 def create_portal_session():
     """
     Creates a Stripe Customer Portal session for the authenticated user,
     allowing them to manage their billing and subscription details.
     """
-    db: Session = database.SessionLocal()
     try:
         # 1. Identify the user from the validated Auth0 JWT
         auth0_user_id = g.current_user.get('sub')
-        user = db.query(models.User).filter(models.User.auth0_user_id == auth0_user_id).first()
+        user = db.session.query(models.User).filter(models.User.auth0_user_id == auth0_user_id).first()
 
         # 2. CRITICAL: Validate that the user is an existing Stripe customer.
         # A user who has never subscribed will not have a stripe_customer_id.
@@ -329,20 +252,72 @@ def create_portal_session():
         if not frontend_url:
              raise ValueError("NEXT_PUBLIC_APP_URL environment variable not set.")
 
-        # 4. Create a Billing Portal Session on Stripe's servers
-        portal_session = stripe.billing_portal.Session.create(
-            customer=user.stripe_customer_id,
-            return_url=f'{frontend_url}/dashboard',
-        )
+        # 4. Reuse the user's open Billing Portal session, or create one on Stripe's servers
+        portal_url = stripe_session_cache.portal_url(user, return_url=f'{frontend_url}/dashboard')
 
         # 5. Return the unique session URL to the frontend
-        return jsonify({'url': portal_session.url})
+        return jsonify({'url': portal_url})
 
+    except StripeUnavailable as e:
+        current_app.logger.error(f"Stripe portal session creation failed: {e}")
+        return jsonify(error="Payments are temporarily unavailable, please try again shortly."), 503
     except Exception as e:
         current_app.logger.error(f"Stripe portal session creation failed: {e}")
         return jsonify(error=str(e)), 500
-    finally:
-        db.close()
+
+@main.route('/api/audit-logs')
+@query_budget(3)
+@requires_auth
+@requires_permission('read:audit_logs')
+def list_audit_logs():
+    """
+    Returns audit log entries, newest first, one page at a time.
+    Filters: user_id, action, since, until (ISO 8601). Paging: limit, cursor.
+    Pass the returned 'next_cursor' back as 'cursor' to get the next page.
+    """
+    try:
+        filters = audit_service.parse_filters(request.args)
+        limit = int(request.args.get('limit', audit_service.DEFAULT_PAGE_SIZE))
+        if not 1 <= limit <= audit_service.MAX_PAGE_SIZE:
+            raise audit_service.InvalidAuditQuery(
+                f"'limit' must be between 1 and {audit_service.MAX_PAGE_SIZE}."
+            )
+        items, next_cursor = audit_service.get_page(filters, request.args.get('cursor'), limit)
+    except ValueError as e:
+        return jsonify({"code": "bad_request", "description": str(e)}), 400
+
+    return jsonify({"items": items, "next_cursor": next_cursor})
+
+@main.route('/api/audit-logs/export')
+@query_budget(2)
+@requires_auth
+@requires_permission('read:audit_logs')
+def export_audit_logs():
+    """
+    Streams every audit log entry matching the filters as NDJSON
+    (one JSON object per line), newest first. Takes the same filters as
+    /api/audit-logs and runs in constant memory regardless of size.
+    """
+    try:
+        filters = audit_service.parse_filters(request.args)
+    except ValueError as e:
+        return jsonify({"code": "bad_request", "description": str(e)}), 400
+
+    # Queued: the export's own transaction is only ever rolled back
+    audit.record('audit_logs.exported', details={
+        'auth0_user_id': g.current_user.get('sub'),
+        'filters': request.args.to_dict(),
+    })
+    lines = audit_service.export_ndjson(
+        filters,
+        batch_size=current_app.config['AUDIT_EXPORT_BATCH_SIZE'],
+        statement_timeout_ms=current_app.config['AUDIT_EXPORT_STATEMENT_TIMEOUT_MS']
+    )
+    return Response(
+        stream_with_context(lines),
+        mimetype='application/x-ndjson',
+        headers={'Content-Disposition': 'attachment; filename=audit-logs.ndjson'}
+    )
 
 # You can add all your other API routes to this file
 # For example:
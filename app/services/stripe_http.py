@@ -0,0 +1,28 @@
+# stripe_http.py
+# Imported by StripeService.client on first use, see stripe_service.py
+import time
+
+import stripe
+
+from .stripe_service import call_context
+
+
+class DeadlineRequestsClient(stripe.RequestsClient):
+    """
+    stripe's requests-based HTTP client, with each request's timeouts
+    capped at the time left before the current call's deadline.
+    """
+
+    @property
+    def _timeout(self):
+        connect_timeout, read_timeout = self._timeouts
+        deadline = getattr(call_context, 'deadline', None)
+        if deadline is None:
+            return connect_timeout, read_timeout
+        remaining = max(0.001, deadline - time.monotonic())
+        return min(connect_timeout, remaining), min(read_timeout, remaining)
+
+    @_timeout.setter
+    def _timeout(self, value):
+        # Set by RequestsClient.__init__
+        self._timeouts = value
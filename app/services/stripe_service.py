@@ -0,0 +1,432 @@
+# stripe_service.py
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from ..extensions import metrics
+from ..request_metrics import add_phase_time
+
+# The stripe package (with requests and httpx) takes longer to import than
+# the rest of the app together, so it is imported where it is first used.
+# app/startup.py imports it ahead of the first request.
+
+logger = logging.getLogger(__name__)
+
+# --- Stripe Client Metrics ---
+STRIPE_REQUESTS = Counter(
+    'stripe_requests_total',
+    'Stripe API calls by operation and outcome (one per attempt).',
+    ['operation', 'outcome'],
+    registry=metrics.registry
+)
+STRIPE_REQUEST_SECONDS = Histogram(
+    'stripe_request_seconds',
+    'Latency of a single Stripe API attempt.',
+    ['operation'],
+    registry=metrics.registry,
+    buckets=(.05, .1, .25, .5, .75, 1, 1.5, 2.5, 5, 10, 30)
+)
+STRIPE_RETRIES = Counter(
+    'stripe_retries_total',
+    'Stripe API calls that were retried, by operation.',
+    ['operation'],
+    registry=metrics.registry
+)
+STRIPE_CIRCUIT_STATE = Gauge(
+    'stripe_circuit_state',
+    'State of the Stripe circuit breaker (0 closed, 1 half-open, 2 open).',
+    registry=metrics.registry,
+    multiprocess_mode='max'
+)
+
+CIRCUIT_CLOSED, CIRCUIT_HALF_OPEN, CIRCUIT_OPEN = 'closed', 'half_open', 'open'
+CIRCUIT_STATE_VALUES = {CIRCUIT_CLOSED: 0, CIRCUIT_HALF_OPEN: 1, CIRCUIT_OPEN: 2}
+
+# The deadline of the call running on this thread, read by the HTTP client
+call_context = threading.local()
+
+
+class StripeUnavailable(Exception):
+    """
+    Raised instead of calling Stripe when the circuit breaker is open,
+    or when a call ran out of time or retries.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calling Stripe after `failure_threshold` consecutive failures.
+    After `reset_timeout` seconds one trial call is let through: if it
+    succeeds calls resume, otherwise the breaker stays open for another period.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = CIRCUIT_CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        STRIPE_CIRCUIT_STATE.set(0)
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == CIRCUIT_OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return CIRCUIT_HALF_OPEN
+            return self._state
+
+    def allow(self):
+        with self._lock:
+            if self._state == CIRCUIT_CLOSED:
+                return True
+            if self._state == CIRCUIT_OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._set_state(CIRCUIT_HALF_OPEN)
+            # Half-open: a single trial call at a time
+            if self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_running = False
+            if self._state != CIRCUIT_CLOSED:
+                logger.info("Stripe circuit breaker closed.")
+                self._set_state(CIRCUIT_CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._state == CIRCUIT_HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != CIRCUIT_OPEN:
+                    logger.warning("Stripe circuit breaker opened.", extra={'consecutive_failures': self._failures})
+                self._opened_at = time.monotonic()
+                self._set_state(CIRCUIT_OPEN)
+
+    def reset(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_running = False
+            self._set_state(CIRCUIT_CLOSED)
+
+    def _set_state(self, state):
+        self._state = state
+        STRIPE_CIRCUIT_STATE.set(CIRCUIT_STATE_VALUES[state])
+
+
+def _is_server_failure(error):
+    """Errors that mean Stripe (or the way to it) is unhealthy."""
+    import stripe
+
+    if isinstance(error, stripe.error.APIConnectionError):
+        return True
+    return isinstance(error, stripe.error.APIError) and (error.http_status or 500) >= 500
+
+
+def _is_conflict(error):
+    """A request with the same idempotency key is still in progress at Stripe."""
+    import stripe
+
+    return isinstance(error, stripe.error.APIError) and error.http_status == 409
+
+
+def _outcome(error):
+    import stripe
+
+    if isinstance(error, stripe.error.APIConnectionError):
+        return 'connection_error'
+    if isinstance(error, stripe.error.RateLimitError):
+        return 'rate_limited'
+    if _is_conflict(error):
+        return 'conflict'
+    if _is_server_failure(error):
+        return 'server_error'
+    return 'client_error'
+
+
+def _checkout_params(user_id, price_id, success_url, cancel_url):
+    return {
+        'payment_method_types': ['card'],
+        'line_items': [{'price': price_id, 'quantity': 1}],
+        'mode': 'subscription',
+        'success_url': success_url,
+        'cancel_url': cancel_url,
+        # CRITICAL: This securely links the Stripe session to our internal user ID
+        'client_reference_id': str(user_id),
+        # ...and the subscription, so reconciliation can find its user even
+        # if the checkout.session.completed webhook never arrived
+        'subscription_data': {'metadata': {'user_id': str(user_id)}},
+    }
+
+
+class StripeService:
+    """
+    The one way the app talks to Stripe.
+
+    Calls go through a pooled keep-alive HTTP session and a circuit breaker.
+    Every call has a deadline covering all of its attempts, and retries
+    connection errors, rate limiting, 5xx responses and idempotency
+    conflicts (409) with jittered exponential backoff. Creates carry an idempotency key, the same one
+    on every attempt, so a retry can never create a second object.
+
+    The async handlers use `call_async` and the `*_async` operations, which
+    apply the same policy over an httpx client on the event loop.
+    """
+
+    def __init__(self, app=None):
+        self.breaker = CircuitBreaker()
+        self._client = None
+        self._client_pid = None
+        self._client_lock = threading.Lock()
+        self._async_client = None
+        self._async_client_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        config.setdefault('STRIPE_API_KEY', os.environ.get('STRIPE_API_KEY'))
+        config.setdefault('STRIPE_API_BASE', None)
+        config.setdefault('STRIPE_CONNECT_TIMEOUT', 3.0)
+        config.setdefault('STRIPE_READ_TIMEOUT', 10.0)
+        config.setdefault('STRIPE_CALL_DEADLINE', 15.0)
+        config.setdefault('STRIPE_MAX_RETRIES', 2)
+        config.setdefault('STRIPE_RETRY_BASE_DELAY', 0.25)
+        config.setdefault('STRIPE_RETRY_MAX_DELAY', 2.0)
+        config.setdefault('STRIPE_POOL_SIZE', 10)
+        config.setdefault('STRIPE_CIRCUIT_FAILURE_THRESHOLD', 5)
+        config.setdefault('STRIPE_CIRCUIT_RESET_TIMEOUT', 30.0)
+
+        self.api_key = config['STRIPE_API_KEY']
+        self.api_base = config['STRIPE_API_BASE']
+        self.timeouts = (config['STRIPE_CONNECT_TIMEOUT'], config['STRIPE_READ_TIMEOUT'])
+        self.call_deadline = config['STRIPE_CALL_DEADLINE']
+        self.max_retries = config['STRIPE_MAX_RETRIES']
+        self.retry_base_delay = config['STRIPE_RETRY_BASE_DELAY']
+        self.retry_max_delay = config['STRIPE_RETRY_MAX_DELAY']
+        self.pool_size = config['STRIPE_POOL_SIZE']
+        self.breaker.failure_threshold = config['STRIPE_CIRCUIT_FAILURE_THRESHOLD']
+        self.breaker.reset_timeout = config['STRIPE_CIRCUIT_RESET_TIMEOUT']
+        self.breaker.reset()
+        self._client = None
+        self._async_client = None
+
+        app.extensions['stripe_service'] = self
+
+    @property
+    def client(self):
+        """
+        The StripeClient of this process, built on first use.
+        A forked worker builds its own, so sockets are never shared across processes.
+        """
+        if self._client is None or self._client_pid != os.getpid():
+            import requests
+            import stripe
+            from requests.adapters import HTTPAdapter
+
+            from .stripe_http import DeadlineRequestsClient
+
+            with self._client_lock:
+                if self._client is None or self._client_pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._client = stripe.StripeClient(
+                        self.api_key,
+                        base_addresses={'api': self.api_base} if self.api_base else {},
+                        # Retries are ours, so they respect the deadline and the breaker
+                        max_network_retries=0,
+                        http_client=DeadlineRequestsClient(timeout=self.timeouts, session=session),
+                    )
+                    self._client_pid = os.getpid()
+        return self._client
+
+    @property
+    def async_client(self):
+        """The StripeClient the `*_async` operations use, one per process like `client`."""
+        if self._async_client is None or self._async_client_pid != os.getpid():
+            import httpx
+            import stripe
+
+            self._async_client = stripe.StripeClient(
+                self.api_key,
+                base_addresses={'api': self.api_base} if self.api_base else {},
+                max_network_retries=0,
+                # Each attempt is also bounded by the call's deadline, see call_async
+                http_client=stripe.HTTPXClient(timeout=httpx.Timeout(self.timeouts[1], connect=self.timeouts[0])),
+            )
+            self._async_client_pid = os.getpid()
+        return self._async_client
+
+    def call(self, operation, method, params, idempotency_key=None, deadline=None):
+        """
+        Runs `method(params=..., options=...)` under the retry policy.
+        `operation` names the call in metrics and logs.
+        Raises StripeUnavailable when Stripe can't be reached in time,
+        and the original stripe error for anything retrying won't fix.
+        """
+        import stripe
+
+        deadline_at = time.monotonic() + (deadline or self.call_deadline)
+        options = {'idempotency_key': idempotency_key} if idempotency_key else {}
+        attempt = 0
+        call_started = time.perf_counter()
+        try:
+            while True:
+                self._before_attempt(operation)
+                started = time.perf_counter()
+                call_context.deadline = deadline_at
+                try:
+                    result = method(params=params, options=options)
+                except stripe.error.StripeError as e:
+                    delay = self._attempt_failed(operation, e, attempt, started, deadline_at)
+                    attempt += 1
+                    time.sleep(delay)
+                    continue
+                except Exception:
+                    # Anything else (e.g. an unreadable response) still ends a half-open trial
+                    self.breaker.record_failure()
+                    raise
+                finally:
+                    call_context.deadline = None
+
+                self._attempt_succeeded(operation, started)
+                return result
+        finally:
+            # Every attempt and backoff is time the request spent on Stripe
+            add_phase_time('stripe', time.perf_counter() - call_started)
+
+    async def call_async(self, operation, method, params, idempotency_key=None, deadline=None):
+        """`call` for an async `method`, e.g. `async_client.v1.checkout.sessions.create_async`."""
+        import stripe
+
+        deadline_at = time.monotonic() + (deadline or self.call_deadline)
+        options = {'idempotency_key': idempotency_key} if idempotency_key else {}
+        attempt = 0
+        call_started = time.perf_counter()
+        try:
+            while True:
+                self._before_attempt(operation)
+                started = time.perf_counter()
+                try:
+                    try:
+                        result = await asyncio.wait_for(
+                            method(params=params, options=options),
+                            max(0.001, deadline_at - time.monotonic())
+                        )
+                    except asyncio.TimeoutError:
+                        raise stripe.error.APIConnectionError(f'{operation} timed out')
+                except stripe.error.StripeError as e:
+                    delay = self._attempt_failed(operation, e, attempt, started, deadline_at)
+                    attempt += 1
+                    await asyncio.sleep(delay)
+                    continue
+                except Exception:
+                    self.breaker.record_failure()
+                    raise
+
+                self._attempt_succeeded(operation, started)
+                return result
+        finally:
+            add_phase_time('stripe', time.perf_counter() - call_started)
+
+    def _before_attempt(self, operation):
+        if not self.breaker.allow():
+            STRIPE_REQUESTS.labels(operation=operation, outcome='circuit_open').inc()
+            raise StripeUnavailable(f'{operation}: circuit breaker is open')
+
+    def _attempt_succeeded(self, operation, started):
+        STRIPE_REQUEST_SECONDS.labels(operation=operation).observe(time.perf_counter() - started)
+        STRIPE_REQUESTS.labels(operation=operation, outcome='success').inc()
+        self.breaker.record_success()
+
+    def _attempt_failed(self, operation, error, attempt, started, deadline_at):
+        """
+        Records a failed attempt and returns how long to back off before the next one.
+        Raises when the error isn't worth retrying or no retry is left.
+        """
+        import stripe
+
+        STRIPE_REQUEST_SECONDS.labels(operation=operation).observe(time.perf_counter() - started)
+        STRIPE_REQUESTS.labels(operation=operation, outcome=_outcome(error)).inc()
+        if _is_server_failure(error):
+            self.breaker.record_failure()
+        else:
+            # Stripe answered, so it is up even if it didn't like the request
+            self.breaker.record_success()
+        if not (_is_server_failure(error) or _is_conflict(error) or isinstance(error, stripe.error.RateLimitError)):
+            raise error
+
+        delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt))
+        # Waiting out a concurrent request with our idempotency key (a
+        # double-click) isn't a failure: only the deadline bounds it
+        out_of_retries = attempt >= self.max_retries and not _is_conflict(error)
+        if out_of_retries or time.monotonic() + delay >= deadline_at:
+            raise StripeUnavailable(f'{operation} failed after {attempt + 1} attempt(s): {error}') from error
+        logger.warning(
+            "Stripe call failed, retrying.",
+            extra={'operation': operation, 'attempt': attempt + 1, 'error_message': str(error)}
+        )
+        STRIPE_RETRIES.labels(operation=operation).inc()
+        return delay
+
+    # --- Operations ---
+
+    def create_checkout_session(self, user_id, price_id, success_url, cancel_url, idempotency_key=None):
+        """Creates a subscription Checkout session for one of our users."""
+        return self.call(
+            'checkout.sessions.create', self.client.v1.checkout.sessions.create,
+            _checkout_params(user_id, price_id, success_url, cancel_url),
+            idempotency_key=idempotency_key or str(uuid.uuid4())
+        )
+
+    async def create_checkout_session_async(self, user_id, price_id, success_url, cancel_url, idempotency_key=None):
+        return await self.call_async(
+            'checkout.sessions.create', self.async_client.v1.checkout.sessions.create_async,
+            _checkout_params(user_id, price_id, success_url, cancel_url),
+            idempotency_key=idempotency_key or str(uuid.uuid4())
+        )
+
+    def create_portal_session(self, customer_id, return_url, idempotency_key=None):
+        """Creates a Billing Portal session for an existing Stripe customer."""
+        return self.call(
+            'billing_portal.sessions.create', self.client.v1.billing_portal.sessions.create,
+            {'customer': customer_id, 'return_url': return_url},
+            idempotency_key=idempotency_key or str(uuid.uuid4())
+        )
+
+    async def create_portal_session_async(self, customer_id, return_url, idempotency_key=None):
+        return await self.call_async(
+            'billing_portal.sessions.create', self.async_client.v1.billing_portal.sessions.create_async,
+            {'customer': customer_id, 'return_url': return_url},
+            idempotency_key=idempotency_key or str(uuid.uuid4())
+        )
+
+    def list_subscriptions(self, params):
+        """
+        Iterates over every subscription matching `params`, fetching the
+        next page (with its own deadline and retries) as the iterator advances.
+        """
+        params = dict(params)
+        while True:
+            page = self.call('subscriptions.list', self.client.v1.subscriptions.list, params)
+            yield from page.data
+            if not page.has_more or not page.data:
+                return
+            params['starting_after'] = page.data[-1].id
+
+
+stripe_service = StripeService()
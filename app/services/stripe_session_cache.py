@@ -0,0 +1,209 @@
+# stripe_session_cache.py
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from flask import current_app
+from prometheus_client import Counter
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from ..extensions import db, metrics
+from ..models import StripeSessionCache
+from .stripe_service import stripe_service
+
+CHECKOUT = 'checkout'
+PORTAL = 'portal'
+
+# A cached URL is dropped this long before Stripe expires the session,
+# so a user is never sent to a page that dies while it loads
+EXPIRY_MARGIN_SECONDS = 60
+
+SESSION_CACHE_LOOKUPS = Counter(
+    'stripe_session_cache_lookups_total',
+    'Checkout / Billing Portal session URL lookups, by operation and result.',
+    ['operation', 'result'],
+    registry=metrics.registry
+)
+
+
+def _fingerprint(params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _cached_url(user_id, operation, fingerprint):
+    return db.session.execute(_cached_url_query(user_id, operation, fingerprint)).scalar()
+
+
+def _cached_url_query(user_id, operation, fingerprint):
+    return (
+        select(StripeSessionCache.url)
+        .where(
+            StripeSessionCache.user_id == user_id,
+            StripeSessionCache.operation == operation,
+            StripeSessionCache.fingerprint == fingerprint,
+            StripeSessionCache.expires_at > db.func.now()
+        )
+    )
+
+
+def _idempotency_key(user_id, operation, fingerprint, window):
+    """
+    The same for every request of a user for the same session within one
+    `window` of seconds, so Stripe creates one session for all of them.
+    """
+    bucket = int(time.time() // window)
+    return hashlib.sha256(f'{operation}:{user_id}:{fingerprint}:{bucket}'.encode('utf-8')).hexdigest()
+
+
+def _store_statement(user_id, operation, fingerprint, session, max_ttl):
+    """The upsert caching `session`, or None if it expires too soon to be worth caching."""
+    ttl = max_ttl
+    if getattr(session, 'expires_at', None):
+        ttl = min(ttl, session.expires_at - time.time() - EXPIRY_MARGIN_SECONDS)
+    if ttl <= 0:
+        return None
+    values = {
+        'user_id': user_id,
+        'operation': operation,
+        'fingerprint': fingerprint,
+        'session_id': session.id,
+        'url': session.url,
+        'expires_at': db.func.now() + timedelta(seconds=ttl),
+    }
+    statement = pg_insert(StripeSessionCache).values(**values)
+    return statement.on_conflict_do_update(
+        index_elements=[StripeSessionCache.user_id, StripeSessionCache.operation],
+        set_={key: statement.excluded[key] for key in values if key not in ('user_id', 'operation')}
+    )
+
+
+def _get_or_create(user_id, operation, params, create, max_ttl, window):
+    """
+    Returns the URL of the user's open session for `operation`, creating
+    one with `create(idempotency_key)` when there is none. No connection is
+    held while Stripe is called: a slow Stripe would otherwise take up the
+    whole pool. Concurrent misses (a double-click) send the same idempotency
+    key, so Stripe creates one session and returns it to both.
+    Commits the session.
+    """
+    fingerprint = _fingerprint(params)
+
+    try:
+        url = _cached_url(user_id, operation, fingerprint)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if url is not None:
+        SESSION_CACHE_LOOKUPS.labels(operation=operation, result='hit').inc()
+        return url
+
+    SESSION_CACHE_LOOKUPS.labels(operation=operation, result='miss').inc()
+    session = create(_idempotency_key(user_id, operation, fingerprint, window))
+
+    statement = _store_statement(user_id, operation, fingerprint, session, max_ttl)
+    if statement is not None:
+        try:
+            db.session.execute(statement)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    return session.url
+
+
+async def _get_or_create_async(db_session, user_id, operation, params, create, max_ttl, window):
+    """_get_or_create on an AsyncSession, awaiting `create()`. Commits `db_session`."""
+    fingerprint = _fingerprint(params)
+
+    try:
+        url = (await db_session.execute(_cached_url_query(user_id, operation, fingerprint))).scalar()
+        await db_session.commit()
+    except Exception:
+        await db_session.rollback()
+        raise
+    if url is not None:
+        SESSION_CACHE_LOOKUPS.labels(operation=operation, result='hit').inc()
+        return url
+
+    SESSION_CACHE_LOOKUPS.labels(operation=operation, result='miss').inc()
+    session = await create(_idempotency_key(user_id, operation, fingerprint, window))
+
+    statement = _store_statement(user_id, operation, fingerprint, session, max_ttl)
+    if statement is not None:
+        try:
+            await db_session.execute(statement)
+            await db_session.commit()
+        except Exception:
+            await db_session.rollback()
+            raise
+    return session.url
+
+
+def checkout_url(user, price_id, success_url, cancel_url):
+    """The URL of a subscription Checkout session for `user`, reused while it is open."""
+    params = {'price_id': price_id, 'success_url': success_url, 'cancel_url': cancel_url}
+    # Read before the commits below expire `user`: reloading it would
+    # check a connection out again for the length of the Stripe call
+    user_id = user.id
+    if not current_app.config['STRIPE_SESSION_CACHE_ENABLED']:
+        db.session.commit()
+        return stripe_service.create_checkout_session(user_id=user_id, **params).url
+    return _get_or_create(
+        user_id, CHECKOUT, params,
+        lambda key: stripe_service.create_checkout_session(user_id=user_id, idempotency_key=key, **params),
+        current_app.config['STRIPE_CHECKOUT_SESSION_CACHE_TTL'],
+        current_app.config['STRIPE_SESSION_IDEMPOTENCY_WINDOW']
+    )
+
+
+def portal_url(user, return_url):
+    """The URL of a Billing Portal session for `user`, reused while it is open."""
+    params = {'customer_id': user.stripe_customer_id, 'return_url': return_url}
+    if not current_app.config['STRIPE_SESSION_CACHE_ENABLED']:
+        db.session.commit()
+        return stripe_service.create_portal_session(**params).url
+    return _get_or_create(
+        user.id, PORTAL, params,
+        lambda key: stripe_service.create_portal_session(idempotency_key=key, **params),
+        current_app.config['STRIPE_PORTAL_SESSION_CACHE_TTL'],
+        current_app.config['STRIPE_SESSION_IDEMPOTENCY_WINDOW']
+    )
+
+
+async def checkout_url_async(db_session, user, price_id, success_url, cancel_url, config):
+    """checkout_url for the async handlers; `config` is the serving app's config."""
+    params = {'price_id': price_id, 'success_url': success_url, 'cancel_url': cancel_url}
+    if not config['STRIPE_SESSION_CACHE_ENABLED']:
+        await db_session.commit()
+        return (await stripe_service.create_checkout_session_async(user_id=user.id, **params)).url
+    return await _get_or_create_async(
+        db_session, user.id, CHECKOUT, params,
+        lambda key: stripe_service.create_checkout_session_async(user_id=user.id, idempotency_key=key, **params),
+        config['STRIPE_CHECKOUT_SESSION_CACHE_TTL'],
+        config['STRIPE_SESSION_IDEMPOTENCY_WINDOW']
+    )
+
+
+async def portal_url_async(db_session, user, return_url, config):
+    """portal_url for the async handlers; `config` is the serving app's config."""
+    params = {'customer_id': user.stripe_customer_id, 'return_url': return_url}
+    if not config['STRIPE_SESSION_CACHE_ENABLED']:
+        await db_session.commit()
+        return (await stripe_service.create_portal_session_async(**params)).url
+    return await _get_or_create_async(
+        db_session, user.id, PORTAL, params,
+        lambda key: stripe_service.create_portal_session_async(idempotency_key=key, **params),
+        config['STRIPE_PORTAL_SESSION_CACHE_TTL'],
+        config['STRIPE_SESSION_IDEMPOTENCY_WINDOW']
+    )
+
+
+def invalidate(user_id):
+    """
+    Forgets every cached session of a user, e.g. once their checkout completed.
+    Runs in the caller's transaction.
+    """
+    db.session.execute(delete(StripeSessionCache).where(StripeSessionCache.user_id == user_id))
@@ -0,0 +1,68 @@
+# stripe_webhooks.py
+import logging
+
+from ..audit import audit
+from ..extensions import db
+from .. import models
+from . import stripe_session_cache
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidEvent(Exception):
+    """An event that can never be applied, so retrying it is pointless."""
+
+
+def handle_checkout_completed(event):
+    """A checkout finished: upgrade the user it was started for to premium."""
+    session = event['data']['object']
+
+    # Retrieve our internal user ID from the session metadata
+    user_id = session.get('client_reference_id')
+    stripe_customer_id = session.get('customer')
+    if not user_id or not stripe_customer_id:
+        raise InvalidEvent("Missing required data in session.")
+
+    # Find the user and update their subscription status in our database
+    user = db.session.query(models.User).filter(models.User.id == user_id).first()
+    if user:
+        user.subscription_plan = 'premium'
+        user.stripe_customer_id = stripe_customer_id
+        # Their open checkout session is used up, and they can now open the portal
+        stripe_session_cache.invalidate(user.id)
+        # Written in the same transaction that marks the event as done
+        audit.record('subscription.activated', user_id=user.id, sync=True, details={
+            "stripe_event_id": event['id'],
+            "stripe_customer_id": stripe_customer_id,
+            "plan": "premium"
+        })
+        logger.info(f"User {user.email} subscription updated to premium.")
+
+
+def handle_subscription_deleted(event):
+    """A subscription was canceled: move its customer back to the free plan."""
+    subscription = event['data']['object']
+
+    stripe_customer_id = subscription.get('customer')
+    if not stripe_customer_id:
+        raise InvalidEvent("Missing required data in subscription.")
+
+    # Find the user and update their subscription status in our database
+    user = db.session.query(models.User).filter(models.User.stripe_customer_id == stripe_customer_id).first()
+    if user:
+        user.subscription_plan = 'free'
+        stripe_session_cache.invalidate(user.id)
+        audit.record('subscription.canceled', user_id=user.id, sync=True, details={
+            "stripe_event_id": event['id'],
+            "stripe_customer_id": stripe_customer_id,
+            "plan": "free"
+        })
+        logger.info(f"User {user.email} plan canceled, set to 'free'.")
+
+
+# Event types without a handler are marked as done and otherwise ignored.
+# Add handling for other event types here as needed.
+HANDLERS = {
+    'checkout.session.completed': handle_checkout_completed,
+    'customer.subscription.deleted': handle_subscription_deleted,
+}
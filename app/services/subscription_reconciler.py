@@ -0,0 +1,338 @@
+# subscription_reconciler.py
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import bindparam, func, insert, select, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from ..extensions import db
+from ..models import StripeSubscriptionSnapshot, SubscriptionSyncWindow, User
+from ..user_status_cache import NOTIFY_CHANNEL
+from .stripe_service import stripe_service
+
+logger = logging.getLogger(__name__)
+
+# Mirrors the webhooks: a checkout makes a customer premium, and only
+# customer.subscription.deleted (status 'canceled') takes it away again.
+PREMIUM_STATUSES = ('active', 'trialing', 'past_due', 'unpaid', 'paused')
+
+STRIPE_PAGE_SIZE = 100  # the most Stripe returns per list call
+
+# Diffs one range of users against the snapshot and fixes the ones that
+# drifted. Customers with a webhook received since the run started are
+# skipped: that event is newer than what we listed.
+DRIFTED_USERS = """
+    WITH expected AS (
+        SELECT u.id, u.stripe_customer_id, u.subscription_plan AS current_plan,
+               CASE WHEN bool_or(s.status IN :premium_statuses) THEN 'premium' ELSE 'free' END AS expected_plan
+        FROM users u
+        LEFT JOIN stripe_subscription_snapshot s ON s.customer_id = u.stripe_customer_id
+        WHERE u.stripe_customer_id > :after
+          AND (CAST(:upto AS varchar) IS NULL OR u.stripe_customer_id <= :upto)
+        GROUP BY u.id
+    ), drifted AS (
+        SELECT * FROM expected e
+        WHERE e.expected_plan <> e.current_plan
+          AND NOT EXISTS (
+              SELECT 1 FROM stripe_events ev
+              WHERE ev.customer_key = e.stripe_customer_id AND ev.received_at >= :run_started_at
+          )
+    )
+"""
+
+# Links users whose checkout.session.completed webhook never arrived, so
+# they never got a stripe_customer_id, to their Stripe customer: the
+# subscription's metadata.user_id names the user (set at checkout). The
+# plan is then fixed like any other drift, by DRIFTED_USERS.
+LINK_CUSTOMERS = text("""
+    WITH listed AS (
+        SELECT DISTINCT ON (user_id) user_id, customer_id
+        FROM stripe_subscription_snapshot
+        WHERE user_id IS NOT NULL
+        ORDER BY user_id, created DESC
+    ), linked AS (
+        UPDATE users u SET stripe_customer_id = l.customer_id
+        FROM listed l
+        WHERE CAST(u.id AS text) = l.user_id
+          AND u.stripe_customer_id IS NULL
+          AND NOT EXISTS (SELECT 1 FROM users o WHERE o.stripe_customer_id = l.customer_id)
+        RETURNING u.id, u.stripe_customer_id
+    ), logged AS (
+        INSERT INTO audit_logs (id, user_id, action, details)
+        SELECT gen_random_uuid(), id, 'subscription.customer_linked',
+               jsonb_build_object('stripe_customer_id', stripe_customer_id)
+        FROM linked
+    )
+    SELECT id, stripe_customer_id FROM linked
+""")
+
+SELECT_DRIFTED = text(DRIFTED_USERS + """
+    SELECT id, stripe_customer_id, current_plan, expected_plan FROM drifted
+""").bindparams(bindparam('premium_statuses', expanding=True))
+
+FIX_DRIFTED = text(DRIFTED_USERS + """
+    , fixed AS (
+        UPDATE users u SET subscription_plan = d.expected_plan
+        FROM drifted d
+        WHERE u.id = d.id AND u.subscription_plan = d.current_plan
+        RETURNING u.id, u.auth0_user_id, d.stripe_customer_id, d.current_plan, d.expected_plan
+    ), logged AS (
+        INSERT INTO audit_logs (id, user_id, action, details)
+        SELECT gen_random_uuid(), id, 'subscription.reconciled', jsonb_build_object(
+            'stripe_customer_id', stripe_customer_id, 'from', current_plan, 'to', expected_plan
+        )
+        FROM fixed
+    )
+    -- Tells the web workers to drop these users from their status caches (on commit)
+    SELECT id, stripe_customer_id, current_plan, expected_plan, pg_notify(:channel, auth0_user_id)
+    FROM fixed
+""").bindparams(bindparam('premium_statuses', expanding=True))
+
+
+class NothingToResume(Exception):
+    """Raised when --resume is given but no earlier run left any checkpoints."""
+
+
+def default_since():
+    """
+    Subscriptions are created at checkout, after the user signed up, so
+    nothing we care about is older than our oldest user. (Not our oldest
+    paying user: a user whose checkout webhook was missed has no
+    stripe_customer_id yet.)
+    """
+    oldest = db.session.execute(select(func.min(User.created_at))).scalar()
+    db.session.rollback()
+    if oldest is None:
+        return None
+    return oldest.replace(tzinfo=timezone.utc) - timedelta(days=1)
+
+
+def build_windows(since, until, window):
+    """Splits [since, until) into (created_from, created_to) unix-second ranges of `window` length."""
+    start, end, step = int(since.timestamp()), int(until.timestamp()), int(window.total_seconds())
+    return [(lower, min(lower + step, end)) for lower in range(start, end, step)]
+
+
+def start_run(windows):
+    """Forgets the previous run and records the windows of a new one."""
+    with db.engine.begin() as connection:
+        connection.execute(text(
+            f'TRUNCATE {StripeSubscriptionSnapshot.__tablename__}, {SubscriptionSyncWindow.__tablename__}'
+        ))
+        connection.execute(
+            insert(SubscriptionSyncWindow),
+            [{'created_from': lower, 'created_to': upper} for lower, upper in windows]
+        )
+
+
+def pending_windows():
+    """Returns (created_from, created_to, last_subscription_id) for every window not fetched yet."""
+    with db.engine.connect() as connection:
+        return connection.execute(
+            select(
+                SubscriptionSyncWindow.created_from,
+                SubscriptionSyncWindow.created_to,
+                SubscriptionSyncWindow.last_subscription_id
+            )
+            .where(SubscriptionSyncWindow.completed.is_(False))
+            .order_by(SubscriptionSyncWindow.created_from)
+        ).all()
+
+
+def run_started_at():
+    with db.engine.connect() as connection:
+        return connection.execute(select(func.min(SubscriptionSyncWindow.run_started_at))).scalar()
+
+
+def list_subscriptions(created_from, created_to, starting_after=None):
+    """
+    Iterates over every subscription created in [created_from, created_to),
+    newest first, resuming after `starting_after` if given.
+    The following pages are fetched as the iterator advances.
+    """
+    params = {
+        'status': 'all',
+        'limit': STRIPE_PAGE_SIZE,
+        'created': {'gte': created_from, 'lt': created_to},
+    }
+    if starting_after:
+        params['starting_after'] = starting_after
+    return stripe_service.list_subscriptions(params)
+
+
+def _store(created_from, rows, completed=False):
+    """
+    Upserts a batch of listed subscriptions and moves the window's checkpoint
+    past them, in one transaction, so a batch is never half-recorded.
+    """
+    with db.engine.begin() as connection:
+        if rows:
+            statement = pg_insert(StripeSubscriptionSnapshot)
+            connection.execute(
+                statement.on_conflict_do_update(
+                    index_elements=[StripeSubscriptionSnapshot.id],
+                    set_={key: statement.excluded[key] for key in ('customer_id', 'status', 'user_id')}
+                ),
+                rows
+            )
+        values = {'fetched': SubscriptionSyncWindow.fetched + len(rows), 'completed': completed}
+        if rows:
+            values['last_subscription_id'] = rows[-1]['id']
+        connection.execute(
+            update(SubscriptionSyncWindow)
+            .where(SubscriptionSyncWindow.created_from == created_from)
+            .values(**values)
+        )
+
+
+def fetch_window(app, window, batch_size):
+    """Lists one window into the snapshot table, checkpointing every `batch_size` subscriptions."""
+    created_from, created_to, starting_after = window
+    fetched = 0
+    with app.app_context():
+        rows = []
+        for subscription in list_subscriptions(created_from, created_to, starting_after):
+            customer = subscription['customer']
+            rows.append({
+                'id': subscription['id'],
+                'customer_id': customer if isinstance(customer, str) else customer['id'],
+                'status': subscription['status'],
+                'created': subscription['created'],
+                'user_id': (subscription.get('metadata') or {}).get('user_id'),
+            })
+            if len(rows) >= batch_size:
+                _store(created_from, rows)
+                fetched += len(rows)
+                rows = []
+        _store(created_from, rows, completed=True)
+    return fetched + len(rows)
+
+
+def fetch_all(app, windows, concurrency, batch_size):
+    """
+    Fetches the windows with at most `concurrency` Stripe list calls in flight.
+    If a window fails the others still finish, and the error is re-raised at
+    the end; the run can then be resumed.
+    """
+    fetched, first_error = 0, None
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='reconcile') as pool:
+        futures = {pool.submit(fetch_window, app, window, batch_size): window for window in windows}
+        for future in as_completed(futures):
+            try:
+                fetched += future.result()
+            except Exception as e:
+                logger.error("Listing Stripe subscriptions failed.",
+                             extra={'created_from': futures[future][0], 'error_message': str(e)})
+                first_error = first_error or e
+    if first_error:
+        raise first_error
+    return fetched
+
+
+def _batch_upper_bound(after, batch_size):
+    """The stripe_customer_id that ends the next batch of users, or None for the last batch."""
+    return db.session.execute(
+        select(User.stripe_customer_id)
+        .where(User.stripe_customer_id > after)
+        .order_by(User.stripe_customer_id)
+        .offset(batch_size - 1)
+        .limit(1)
+    ).scalar()
+
+
+def link_customers():
+    """
+    Sets stripe_customer_id on the users a listed subscription's metadata
+    names, if they have none. Runs in the session's transaction; returns
+    the links made.
+    """
+    rows = db.session.execute(LINK_CUSTOMERS).all()
+    return [{'user_id': str(row.id), 'stripe_customer_id': row.stripe_customer_id} for row in rows]
+
+
+def apply_snapshot(started_at, batch_size, dry_run=False):
+    """
+    Links users missing a stripe_customer_id (link_customers), then compares
+    users with the snapshot `batch_size` users at a time, keyed by
+    stripe_customer_id, and fixes each batch with one UPDATE (which also
+    writes the audit entries). Returns (links, changes).
+
+    With `dry_run` it all happens in one transaction that is rolled back,
+    so the changes reported include those of the users it would link.
+    """
+    statement = SELECT_DRIFTED if dry_run else FIX_DRIFTED
+    try:
+        links = link_customers()
+        if not dry_run:
+            db.session.commit()
+
+        changes, after = [], ''
+        while True:
+            upto = _batch_upper_bound(after, batch_size)
+            rows = db.session.execute(statement, {
+                'premium_statuses': PREMIUM_STATUSES,
+                'after': after,
+                'upto': upto,
+                'run_started_at': started_at,
+                'channel': NOTIFY_CHANNEL,
+            }).all()
+            if not dry_run:
+                db.session.commit()
+            changes.extend(
+                {'user_id': str(row.id), 'stripe_customer_id': row.stripe_customer_id,
+                 'from': row.current_plan, 'to': row.expected_plan}
+                for row in rows
+            )
+            if upto is None:
+                return links, changes
+            after = upto
+    finally:
+        # Undoes a dry run, and the batch an error interrupted
+        db.session.rollback()
+
+
+def reconcile(app, resume=False, since=None, window=timedelta(days=30), concurrency=4,
+              batch_size=1000, update_batch_size=5000, dry_run=False):
+    """
+    Brings users.subscription_plan in line with Stripe:
+
+    1. lists every subscription into stripe_subscription_snapshot, in windows
+       of creation time fetched `concurrency` at a time (skipped for windows
+       an interrupted run already finished when `resume` is set),
+    2. links users whose checkout webhook was missed to their customer, by
+       the user_id in the subscription's metadata,
+    3. diffs users against the snapshot and fixes them in set-based batches.
+
+    With `dry_run` nothing is changed in users; the changes are only reported.
+    Returns a summary dict.
+    """
+    started = time.perf_counter()
+
+    if resume:
+        windows = pending_windows()
+        if run_started_at() is None:
+            raise NothingToResume()
+    else:
+        since = since or default_since()
+        if since is None:
+            return {'windows': 0, 'fetched': 0, 'linked': 0, 'changes': [], 'dry_run': dry_run}
+        windows = build_windows(since, datetime.now(timezone.utc) + timedelta(hours=1), window)
+        start_run(windows)
+        windows = [(lower, upper, None) for lower, upper in windows]
+
+    logger.info("Reconciling subscriptions.", extra={'windows': len(windows), 'resume': resume})
+    fetched = fetch_all(app, windows, concurrency, batch_size)
+    links, changes = apply_snapshot(run_started_at(), update_batch_size, dry_run)
+
+    return {
+        'windows': len(windows),
+        'fetched': fetched,
+        'linked': len(links),
+        'upgraded': sum(1 for change in changes if change['to'] == 'premium'),
+        'downgraded': sum(1 for change in changes if change['to'] == 'free'),
+        'changes': changes,
+        'dry_run': dry_run,
+        'seconds': round(time.perf_counter() - started, 2),
+    }
@@ -0,0 +1,236 @@
+# user_import.py
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import time
+
+from sqlalchemy import func, select, text, update
+
+from ..extensions import db
+from ..models import UserImport
+from .user_service import ONBOARDING_AUDIT_DETAILS, get_default_role_id
+
+logger = logging.getLogger(__name__)
+
+# Longest auth0_user_id and email the users table takes
+MAX_FIELD_LENGTH = 255
+
+# Each batch of the export is copied in here, then merged. A temporary
+# table, so concurrent imports don't share it, and emptied by every commit.
+CREATE_STAGING = text("""
+    CREATE TEMPORARY TABLE IF NOT EXISTS user_import_staging (
+        line bigint NOT NULL,
+        auth0_user_id varchar(255) NOT NULL,
+        email varchar(255) NOT NULL
+    ) ON COMMIT DELETE ROWS
+""")
+COPY_STAGING = "COPY user_import_staging (line, auth0_user_id, email) FROM STDIN WITH (FORMAT csv)"
+
+# Onboards every staged user, in export order, as onboard_user does one at
+# a time: a user whose auth0_user_id is already taken is skipped, and each
+# new user gets the default role and a 'user.created' audit entry. users.email
+# is unique too, so a new user whose email belongs to another user (or to a
+# new user on an earlier line) can't be onboarded: those are left out and
+# their lines returned, rather than failing the batch.
+MERGE_STAGING = text("""
+    WITH batch AS (
+        SELECT DISTINCT ON (auth0_user_id) line, auth0_user_id, email
+        FROM user_import_staging
+        ORDER BY auth0_user_id, line
+    ), candidate AS (
+        SELECT line, auth0_user_id, email
+        FROM batch
+        WHERE NOT EXISTS (SELECT 1 FROM users WHERE users.auth0_user_id = batch.auth0_user_id)
+    ), accepted AS (
+        SELECT DISTINCT ON (email) line, auth0_user_id, email
+        FROM candidate
+        WHERE NOT EXISTS (SELECT 1 FROM users WHERE users.email = candidate.email)
+        ORDER BY email, line
+    ), new_user AS (
+        INSERT INTO users (id, auth0_user_id, email, subscription_plan)
+        SELECT gen_random_uuid(), auth0_user_id, email, 'free'
+        FROM accepted
+        ORDER BY line
+        ON CONFLICT (auth0_user_id) DO NOTHING
+        RETURNING id
+    ), assigned_role AS (
+        INSERT INTO user_roles (user_id, role_id)
+        SELECT id, :role_id FROM new_user
+    ), audit AS (
+        INSERT INTO audit_logs (id, user_id, action, details)
+        SELECT gen_random_uuid(), id, 'user.created', CAST(:details AS jsonb) FROM new_user
+    )
+    SELECT
+        (SELECT count(*) FROM new_user) AS created,
+        ARRAY(
+            SELECT line FROM candidate WHERE line NOT IN (SELECT line FROM accepted) ORDER BY line
+        ) AS email_conflicts
+""")
+
+
+class NothingToResume(Exception):
+    """Raised when --resume is given but no unfinished import of the file exists."""
+
+
+def open_export(path):
+    """Opens an Auth0 user export (JSON lines, gzipped or not) for reading bytes."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def parse_line(raw):
+    """Returns (auth0_user_id, email) from one line of the export, or None if it can't be imported."""
+    try:
+        record = json.loads(raw)
+    except ValueError:
+        return None
+    if not isinstance(record, dict):
+        return None
+    # Auth0 exports name the fields user_id and email unless told otherwise
+    auth0_user_id = record.get('user_id') or record.get('Id')
+    email = record.get('email') or record.get('Email')
+    if not isinstance(auth0_user_id, str) or not isinstance(email, str) or not auth0_user_id or not email:
+        return None
+    if len(auth0_user_id) > MAX_FIELD_LENGTH or len(email) > MAX_FIELD_LENGTH:
+        return None
+    return auth0_user_id, email
+
+
+def start_import(source):
+    """Records a new import of `source` and returns its id."""
+    with db.engine.begin() as connection:
+        return connection.execute(
+            UserImport.__table__.insert().values(source=source).returning(UserImport.id)
+        ).scalar()
+
+
+def unfinished_import(source):
+    """The latest unfinished import of `source` as a row, or None."""
+    with db.engine.connect() as connection:
+        return connection.execute(
+            select(UserImport.__table__)
+            .where(UserImport.source == source, UserImport.finished_at.is_(None))
+            .order_by(UserImport.id.desc())
+            .limit(1)
+        ).first()
+
+
+def _merge_batch(connection, import_id, rows, position, lines, invalid, role_id):
+    """
+    Copies one batch into the staging table, merges it and moves the
+    checkpoint, in one transaction. Returns (users created, lines of the
+    users left out for their email).
+    """
+    created, email_conflicts = 0, []
+    with connection.begin():
+        if rows:
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(rows)
+            buffer.seek(0)
+            with connection.connection.cursor() as cursor:
+                cursor.copy_expert(COPY_STAGING, buffer)
+            created, email_conflicts = connection.execute(MERGE_STAGING, {
+                'role_id': role_id, 'details': json.dumps(ONBOARDING_AUDIT_DETAILS),
+            }).one()
+        connection.execute(
+            update(UserImport)
+            .where(UserImport.id == import_id)
+            .values(
+                position=position,
+                lines=UserImport.lines + lines,
+                created=UserImport.created + created,
+                skipped=UserImport.skipped + (len(rows) - created - len(email_conflicts)),
+                email_conflicts=UserImport.email_conflicts + len(email_conflicts),
+                invalid=UserImport.invalid + invalid,
+                updated_at=func.now(),
+            )
+        )
+    if email_conflicts:
+        logger.warning("Users not imported: their email belongs to another user.",
+                       extra={'import_id': import_id, 'lines': email_conflicts})
+    return created, email_conflicts
+
+
+def import_users(path, batch_size=10000, resume=False, progress=None):
+    """
+    Onboards every user in an Auth0 user export, `batch_size` lines at a
+    time: each batch is COPYed into a staging table and merged into users,
+    user_roles and audit_logs with one set-based statement.
+
+    Only one batch is held in memory. Each batch commits together with the
+    import's checkpoint, so with `resume` an interrupted import of the same
+    file continues after the last committed batch. Importing a file again
+    is also safe: users that exist are skipped. New users whose email
+    belongs to another user are counted as email_conflicts and logged with
+    their line numbers.
+
+    `progress`, if given, is called with the running summary after every batch.
+    Returns the summary dict.
+    """
+    source = os.path.abspath(path)
+    if resume:
+        checkpoint = unfinished_import(source)
+        if checkpoint is None:
+            raise NothingToResume()
+        import_id, position = checkpoint.id, checkpoint.position
+        summary = {'lines': checkpoint.lines, 'created': checkpoint.created, 'skipped': checkpoint.skipped,
+                   'email_conflicts': checkpoint.email_conflicts, 'invalid': checkpoint.invalid}
+    else:
+        import_id, position = start_import(source), 0
+        summary = {'lines': 0, 'created': 0, 'skipped': 0, 'email_conflicts': 0, 'invalid': 0}
+
+    role_id = get_default_role_id()
+    db.session.rollback()
+    summary.update(import_id=import_id, source=source, resumed=resume)
+    logger.info("Importing users.", extra={'source': source, 'import_id': import_id, 'position': position})
+
+    started = time.perf_counter()
+    # One connection for the whole import, since the staging table is per session
+    with db.engine.connect() as connection, open_export(path) as export:
+        with connection.begin():
+            connection.execute(CREATE_STAGING)
+        export.seek(position)
+
+        rows, lines, invalid = [], 0, 0
+        line_number = summary['lines']
+        for raw in export:
+            position += len(raw)
+            lines += 1
+            line_number += 1
+            if raw.strip():
+                parsed = parse_line(raw)
+                if parsed is None:
+                    invalid += 1
+                else:
+                    rows.append((line_number, *parsed))
+            if lines >= batch_size:
+                created, email_conflicts = _merge_batch(connection, import_id, rows, position, lines, invalid,
+                                                        role_id)
+                _record(summary, created, email_conflicts, len(rows), lines, invalid, started, progress)
+                rows, lines, invalid = [], 0, 0
+        created, email_conflicts = _merge_batch(connection, import_id, rows, position, lines, invalid, role_id)
+        _record(summary, created, email_conflicts, len(rows), lines, invalid, started, progress)
+
+        with connection.begin():
+            connection.execute(
+                update(UserImport).where(UserImport.id == import_id).values(finished_at=func.now())
+            )
+
+    return summary
+
+
+def _record(summary, created, email_conflicts, staged, lines, invalid, started, progress):
+    summary['lines'] += lines
+    summary['created'] += created
+    summary['skipped'] += staged - created - len(email_conflicts)
+    summary['email_conflicts'] += len(email_conflicts)
+    summary['invalid'] += invalid
+    summary['seconds'] = round(time.perf_counter() - started, 2)
+    logger.info("Imported a batch of users.",
+                extra={key: summary[key] for key in ('lines', 'created', 'skipped', 'email_conflicts', 'invalid')})
+    if progress is not None:
+        progress(summary)
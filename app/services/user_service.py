@@ -0,0 +1,128 @@
+# user_service.py
+import threading
+import uuid
+
+from sqlalchemy import insert, literal, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from ..extensions import db
+from ..models import AuditLog, Role, User, user_roles
+
+DEFAULT_ROLE_NAME = 'user'
+# The details of the 'user.created' audit entry (also written by `flask users import`)
+ONBOARDING_AUDIT_DETAILS = {"source": "auth0_onboarding", "assigned_roles": [DEFAULT_ROLE_NAME]}
+
+
+class DefaultRoleMissing(Exception):
+    """Raised when the seeded default role can't be found in the database."""
+
+
+# The default role's id never changes once seeded, so it is looked up
+# once per process instead of on every onboarding request.
+_default_role_id = None
+_default_role_lock = threading.Lock()
+
+
+def get_default_role_id():
+    """Returns the id of the default role, querying for it only on first use."""
+    global _default_role_id
+    if _default_role_id is None:
+        with _default_role_lock:
+            if _default_role_id is None:
+                _default_role_id = _checked_role_id(db.session.execute(_default_role_query()).scalar())
+    return _default_role_id
+
+
+async def get_default_role_id_async(session):
+    """get_default_role_id for an AsyncSession (see app/async_database.py)."""
+    global _default_role_id
+    if _default_role_id is None:
+        # Concurrent first lookups all find the same id, so no lock is needed
+        _default_role_id = _checked_role_id((await session.execute(_default_role_query())).scalar())
+    return _default_role_id
+
+
+def _default_role_query():
+    return select(Role.id).where(Role.name == DEFAULT_ROLE_NAME)
+
+
+def _checked_role_id(role_id):
+    if role_id is None:
+        raise DefaultRoleMissing(DEFAULT_ROLE_NAME)
+    return role_id
+
+
+def reset_default_role_id():
+    """Forgets the cached default role id (e.g. after roles were reseeded)."""
+    global _default_role_id
+    with _default_role_lock:
+        _default_role_id = None
+
+
+def onboard_user(auth0_user_id, email):
+    """
+    Creates the user, assigns the default role and writes the 'user.created'
+    audit entry in a single statement:
+
+        WITH new_user AS (
+            INSERT INTO users ... ON CONFLICT (auth0_user_id) DO NOTHING RETURNING id
+        ), assigned_role AS (
+            INSERT INTO user_roles SELECT id, <default role> FROM new_user
+        ), audit AS (
+            INSERT INTO audit_logs SELECT ..., id, 'user.created', ... FROM new_user
+        )
+        SELECT id FROM new_user
+
+    If the user already exists, the INSERT is a no-op and so are the two
+    dependent INSERTs, which also makes concurrent onboards of the same user safe.
+
+    Returns the new user's id, or None if the user already existed.
+    The caller is responsible for committing the session.
+    """
+    return db.session.execute(_onboard_statement(auth0_user_id, email, get_default_role_id())).scalar()
+
+
+async def onboard_user_async(session, auth0_user_id, email):
+    """onboard_user on an AsyncSession, which the caller commits."""
+    role_id = await get_default_role_id_async(session)
+    return (await session.execute(_onboard_statement(auth0_user_id, email, role_id))).scalar()
+
+
+def _onboard_statement(auth0_user_id, email, role_id):
+    new_user = (
+        pg_insert(User)
+        .values(
+            id=uuid.uuid4(),
+            auth0_user_id=auth0_user_id,
+            email=email,
+            subscription_plan='free'
+        )
+        .on_conflict_do_nothing(index_elements=[User.auth0_user_id])
+        .returning(User.id)
+        .cte('new_user')
+    )
+
+    assigned_role = (
+        insert(user_roles)
+        .from_select(
+            ['user_id', 'role_id'],
+            select(new_user.c.id, literal(role_id))
+        )
+        .cte('assigned_role')
+    )
+
+    audit = (
+        insert(AuditLog)
+        .from_select(
+            ['id', 'user_id', 'action', 'details'],
+            select(
+                literal(uuid.uuid4(), AuditLog.id.type),
+                new_user.c.id,
+                literal('user.created'),
+                literal(ONBOARDING_AUDIT_DETAILS, AuditLog.details.type)
+            )
+        )
+        .cte('audit')
+    )
+
+    return select(new_user.c.id).add_cte(assigned_role, audit)
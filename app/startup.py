@@ -0,0 +1,112 @@
+# startup.py
+import importlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Modules the app imports on first use rather than in create_app, as each
+# adds tens to hundreds of milliseconds to every process start. Serving
+# processes import them before (gunicorn.conf.py) or right after they
+# start (warm_up), so requests rarely wait for them either.
+DEFERRED_IMPORTS = ('stripe', 'jose.jwt', 'jose.jwk', 'httpx', 'requests')
+
+
+def import_deferred():
+    for name in DEFERRED_IMPORTS:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            logger.warning(f"Could not import {name} ahead of use: {e}")
+
+
+def warm_up():
+    """Imports DEFERRED_IMPORTS on a background thread."""
+    threading.Thread(target=import_deferred, name='import-warm-up', daemon=True).start()
+
+
+# --- Import-time profile (flask startup profile) ---
+# Runs in a fresh interpreter under -X importtime, so nothing is imported yet
+_PROFILE_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+status = app.test_client().get(sys.argv[1]).status_code
+served = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (served - created) * 1000,
+    'first_request_status': status,
+}))
+"""
+
+
+def parse_importtime(lines):
+    """
+    The modules in `python -X importtime` output, as
+    {'module', 'self_ms', 'cumulative_ms', 'depth'} dicts in import order.
+    """
+    modules = []
+    for line in lines:
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        if not self_us.strip().isdigit():
+            continue  # the header
+        module = name.rstrip()
+        modules.append({
+            'module': module.strip(),
+            'self_ms': int(self_us) / 1000,
+            'cumulative_ms': int(cumulative_us) / 1000,
+            # Each level of nesting is indented by two more spaces
+            'depth': (len(module) - len(module.lstrip()) - 1) // 2,
+        })
+    return modules
+
+
+def by_package(modules):
+    """Self time summed per top-level package, most expensive first."""
+    packages = {}
+    for module in modules:
+        package = module['module'].split('.', 1)[0]
+        entry = packages.setdefault(package, {'package': package, 'self_ms': 0.0, 'modules': 0})
+        entry['self_ms'] += module['self_ms']
+        entry['modules'] += 1
+    return sorted(packages.values(), key=lambda entry: entry['self_ms'], reverse=True)
+
+
+def profile(path='/health', top=25, root=None):
+    """
+    Starts a new interpreter that imports the app, runs create_app and
+    serves one request to `path` through the test client, and reports
+    how long each step took and what the imports cost.
+    """
+    root = root or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', _PROFILE_SCRIPT, path],
+        cwd=root, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Profiling create_app failed:\n{result.stderr[-4000:]}")
+
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    modules = parse_importtime(result.stderr.splitlines())
+    timings['total_ms'] = timings['import_ms'] + timings['create_app_ms'] + timings['first_request_ms']
+    return {
+        **timings,
+        'modules_imported': len(modules),
+        'import_self_ms': sum(module['self_ms'] for module in modules),
+        'packages': by_package(modules)[:top],
+        'modules_by_self': sorted(modules, key=lambda m: m['self_ms'], reverse=True)[:top],
+        # Top-level imports only, so the cumulative times don't count a module twice
+        'modules_by_cumulative': sorted((m for m in modules if m['depth'] == 0),
+                                        key=lambda m: m['cumulative_ms'], reverse=True)[:top],
+    }
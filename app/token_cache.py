@@ -0,0 +1,148 @@
+# token_cache.py
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from .extensions import metrics
+from .jwks import key_store
+
+# --- Token Cache Metrics ---
+TOKEN_CACHE_LOOKUPS = Counter(
+    'token_cache_lookups_total',
+    'Verified-token cache lookups by result (hit or miss).',
+    ['result'],
+    registry=metrics.registry
+)
+TOKEN_CACHE_EVICTIONS = Counter(
+    'token_cache_evictions_total',
+    'Entries dropped from the verified-token cache by reason.',
+    ['reason'],
+    registry=metrics.registry
+)
+TOKEN_CACHE_ENTRIES = Gauge(
+    'token_cache_entries',
+    'Number of verified tokens currently cached by this worker.',
+    registry=metrics.registry,
+    multiprocess_mode='all'
+)
+TOKEN_VERIFICATION_SECONDS = Histogram(
+    'token_verification_seconds',
+    'Time spent authenticating a bearer token, by path (cached or full).',
+    ['path'],
+    registry=metrics.registry,
+    buckets=(.00001, .000025, .00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+)
+
+
+class VerifiedTokenCache:
+    """
+    A bounded LRU of payloads for tokens that already passed verify_decode_jwt.
+
+    - Entries are keyed by a SHA-256 digest of the token, so raw tokens are
+      never kept in memory.
+    - Each entry expires at the token's 'exp' claim, or after
+      TOKEN_CACHE_MAX_TTL seconds, whichever comes first.
+    - A hit is only served while the key that signed the token is still in
+      the JWKS key store, so a revoked signing key is honoured right away.
+    - Once TOKEN_CACHE_MAX_SIZE entries are cached, the least recently used
+      one is evicted.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.max_size = 10000
+        self.max_ttl = 600
+
+        self._entries = OrderedDict()  # digest -> (expires_at, kid, payload)
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Reads the cache settings from the app config."""
+        app.config.setdefault('TOKEN_CACHE_ENABLED', self.enabled)
+        app.config.setdefault('TOKEN_CACHE_MAX_SIZE', self.max_size)
+        app.config.setdefault('TOKEN_CACHE_MAX_TTL', self.max_ttl)
+
+        self.enabled = app.config['TOKEN_CACHE_ENABLED']
+        self.max_size = app.config['TOKEN_CACHE_MAX_SIZE']
+        self.max_ttl = app.config['TOKEN_CACHE_MAX_TTL']
+        self.clear()
+
+        app.extensions['token_cache'] = self
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        """
+        Returns a copy of the cached payload for the token,
+        or None if the token has to go through full verification.
+        """
+        if not self.enabled:
+            return None
+
+        digest = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                expires_at, kid, payload = entry
+                if time.time() >= expires_at:
+                    del self._entries[digest]
+                    TOKEN_CACHE_EVICTIONS.labels(reason='expired').inc()
+                    entry = None
+                elif not key_store.has_key(kid):
+                    del self._entries[digest]
+                    TOKEN_CACHE_EVICTIONS.labels(reason='key_removed').inc()
+                    entry = None
+                else:
+                    self._entries.move_to_end(digest)
+            TOKEN_CACHE_ENTRIES.set(len(self._entries))
+
+        if entry is None:
+            TOKEN_CACHE_LOOKUPS.labels(result='miss').inc()
+            return None
+
+        TOKEN_CACHE_LOOKUPS.labels(result='hit').inc()
+        # Hand out a copy so a route mutating g.current_user can't change the cache
+        return copy.deepcopy(payload)
+
+    def put(self, token, payload):
+        """Caches the payload of a token that verify_decode_jwt has just accepted."""
+        if not self.enabled or self.max_size <= 0:
+            return
+
+        expires_at = time.time() + self.max_ttl
+        exp = payload.get('exp')
+        if isinstance(exp, (int, float)):
+            expires_at = min(expires_at, exp)
+
+        from jose import jwt
+        kid = jwt.get_unverified_header(token).get('kid')
+        entry = (expires_at, kid, copy.deepcopy(payload))
+
+        digest = self._digest(token)
+        with self._lock:
+            self._entries[digest] = entry
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                TOKEN_CACHE_EVICTIONS.labels(reason='size').inc()
+            TOKEN_CACHE_ENTRIES.set(len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            TOKEN_CACHE_ENTRIES.set(0)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+token_cache = VerifiedTokenCache()
@@ -0,0 +1,232 @@
+# tracing.py
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+from flask import current_app
+from prometheus_client import Counter
+
+from .extensions import metrics
+
+# --- Tracing Metrics ---
+SENTRY_TRANSACTIONS = Counter(
+    'sentry_transactions_total',
+    'Sentry transactions by what the trace sampler did with them (sent, dropped, sent_as_message).',
+    ['decision', 'reason'],
+    registry=metrics.registry
+)
+
+
+def _timestamp(value):
+    """
+    An event timestamp as a datetime. The SDK hands before_send_transaction
+    datetimes; serialized events have ISO 8601 strings ending in 'Z'.
+    """
+    if isinstance(value, datetime):
+        return value
+    # datetime.fromisoformat() only reads a 'Z' suffix from Python 3.11 on
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+class RequestRate:
+    """This worker's request rate, as an exponentially weighted moving average per second."""
+
+    def __init__(self, half_life=10.0):
+        self.half_life = half_life
+        self.value = 0.0
+        self._count = 0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def tick(self):
+        with self._lock:
+            self._count += 1
+            now = time.monotonic()
+            elapsed = now - self._updated
+            if elapsed >= 1.0:
+                weight = 0.5 ** (elapsed / self.half_life)
+                self.value = self.value * weight + (self._count / elapsed) * (1 - weight)
+                self._count, self._updated = 0, now
+            return self.value
+
+
+class TraceSampler:
+    """
+    Decides which requests Sentry traces.
+
+    `traces_sampler` runs when a request starts. Probes are never traced,
+    and requests that continue a trace keep the upstream decision. Every
+    other request is recorded with its route's rate from `route_rates`
+    (else `sample_rate`), lowered so that about `send_per_second` are
+    recorded as this worker's request rate goes up. Requests that aren't
+    recorded cost next to nothing.
+
+    Whether a request fails or is slow isn't known yet at that point, so:
+    - failures of unrecorded requests still reach Sentry as error events
+      (the Flask integration and error logs);
+    - slow unrecorded requests are sent as a message (`report_slow`);
+    - `before_send_transaction` sends every recorded transaction, and
+      tells what made it keep them in the SENTRY_TRANSACTIONS metric.
+
+    With `record_all`, every request is recorded instead, and
+    `before_send_transaction` sends the failed (5xx) and slow ones and
+    samples the others at the head rates. Each request then pays for a
+    full transaction again, so only turn it on to see the spans of every
+    failure.
+
+    Routes are matched by URL rule, which the Flask integration also uses
+    as the transaction name. When the request starts, only its path is
+    known: none of our routes has variables, so the path is the rule.
+    """
+
+    def __init__(self, sample_rate=0.1, route_rates=None, ignored_routes=(), slow_threshold=1.0,
+                 send_per_second=2.0, record_all=False):
+        self.sample_rate = sample_rate
+        self.route_rates = route_rates or {}
+        self.ignored_routes = frozenset(ignored_routes)
+        self.slow_threshold = slow_threshold
+        self.send_per_second = send_per_second
+        self.record_all = record_all
+        self.request_rate = RequestRate()
+
+    def rate(self, route):
+        """The share of `route`'s ordinary requests to trace at this worker's current request rate."""
+        rate = self.route_rates.get(route, self.sample_rate)
+        requests_per_second = self.request_rate.value
+        if requests_per_second > 0:
+            rate = min(rate, self.send_per_second / requests_per_second)
+        return rate
+
+    def traces_sampler(self, sampling_context):
+        if 'asgi_scope' in sampling_context:
+            path = sampling_context['asgi_scope'].get('path')
+        else:
+            path = sampling_context.get('wsgi_environ', {}).get('PATH_INFO')
+        if path in self.ignored_routes:
+            return 0
+        self.request_rate.tick()
+        if sampling_context.get('parent_sampled') is not None:
+            return sampling_context['parent_sampled']
+        if self.record_all:
+            return 1.0
+        return self.rate(path)
+
+    def before_send_transaction(self, event, hint):
+        trace = event.get('contexts', {}).get('trace', {})
+        if trace.get('parent_span_id'):
+            # Continues a trace the caller already decided to keep
+            SENTRY_TRANSACTIONS.labels(decision='sent', reason='parent').inc()
+            return event
+        if trace.get('data', {}).get('http.response.status_code', 0) >= 500 \
+                or trace.get('status') == 'internal_error':
+            SENTRY_TRANSACTIONS.labels(decision='sent', reason='error').inc()
+            return event
+
+        duration = (_timestamp(event['timestamp']) - _timestamp(event['start_timestamp'])).total_seconds()
+        if duration >= self.slow_threshold:
+            SENTRY_TRANSACTIONS.labels(decision='sent', reason='slow').inc()
+            return event
+
+        if self.record_all and random.random() >= self.rate(event.get('transaction')):
+            SENTRY_TRANSACTIONS.labels(decision='dropped', reason='sampled').inc()
+            return None
+        SENTRY_TRANSACTIONS.labels(decision='sent', reason='sampled').inc()
+        return event
+
+    def report_slow(self, transaction, ended=None):
+        """
+        Sends a Sentry message for a request that took `slow_threshold`
+        seconds or more but isn't recorded as a transaction.
+        `transaction` is the request's, from the current scope.
+        """
+        if transaction is None or transaction.sampled is not False or transaction.name in self.ignored_routes:
+            return False
+        ended = ended or datetime.now(timezone.utc)
+        seconds = (ended - transaction.start_timestamp).total_seconds()
+        if seconds < self.slow_threshold:
+            return False
+
+        import sentry_sdk
+        sentry_sdk.capture_message(
+            f"Slow request: {transaction.name}",
+            level='warning',
+            tags={'route': transaction.name},
+            extras={'duration_seconds': round(seconds, 3)},
+            fingerprint=['slow-request', transaction.name],
+        )
+        SENTRY_TRANSACTIONS.labels(decision='sent_as_message', reason='slow').inc()
+        return True
+
+
+def _report_slow_request(exception=None):
+    import sentry_sdk
+    current_app.extensions['trace_sampler'].report_slow(sentry_sdk.get_current_scope().transaction)
+
+
+async def _report_slow_request_async(exception=None):
+    _report_slow_request(exception)
+
+
+def init_app(app, integrations=(), **options):
+    """
+    Initializes Sentry from the SENTRY_* settings in Config.
+    `integrations` are enabled next to the Flask and logging ones, and
+    `options` are passed on to sentry_sdk.init (the benchmarks pass a transport).
+    Without a SENTRY_DSN, sentry_sdk isn't imported at all.
+    Also registers the hook that reports slow requests that aren't traced.
+    """
+    config = app.config
+    config.setdefault('SENTRY_DSN', None)
+    config.setdefault('SENTRY_ENVIRONMENT', None)
+    config.setdefault('SENTRY_LOGS_LEVEL', 'WARNING')
+    config.setdefault('SENTRY_TRACING_ENABLED', True)
+    config.setdefault('SENTRY_TRACES_SAMPLE_RATE', 0.1)
+    config.setdefault('SENTRY_TRACES_ROUTE_RATES', {})
+    config.setdefault('SENTRY_TRACES_IGNORED_ROUTES', ('/health', '/health/live', '/health/ready', '/metrics'))
+    config.setdefault('SENTRY_TRACES_SLOW_THRESHOLD', 1.0)
+    config.setdefault('SENTRY_TRACES_SEND_PER_SECOND', 2.0)
+    config.setdefault('SENTRY_TRACES_RECORD_ALL', False)
+
+    sampler = TraceSampler(
+        sample_rate=config['SENTRY_TRACES_SAMPLE_RATE'],
+        route_rates=config['SENTRY_TRACES_ROUTE_RATES'],
+        ignored_routes=config['SENTRY_TRACES_IGNORED_ROUTES'],
+        slow_threshold=config['SENTRY_TRACES_SLOW_THRESHOLD'],
+        send_per_second=config['SENTRY_TRACES_SEND_PER_SECOND'],
+        record_all=config['SENTRY_TRACES_RECORD_ALL'],
+    )
+    app.extensions['trace_sampler'] = sampler
+    if not config['SENTRY_DSN']:
+        return
+    if config['SENTRY_TRACING_ENABLED']:
+        options.setdefault('traces_sampler', sampler.traces_sampler)
+        options.setdefault('before_send_transaction', sampler.before_send_transaction)
+        if not sampler.record_all:
+            # Quart runs sync hooks on a thread pool, so give it a coroutine
+            hook = _report_slow_request_async if hasattr(app, 'ensure_async') else _report_slow_request
+            if hook not in app.teardown_request_funcs.get(None, ()):
+                app.teardown_request(hook)
+
+    import sentry_sdk
+    from sentry_sdk.integrations.flask import FlaskIntegration
+    from sentry_sdk.integrations.logging import LoggingIntegration
+
+    sentry_sdk.init(
+        dsn=config['SENTRY_DSN'],
+        environment=config['SENTRY_ENVIRONMENT'],
+        integrations=[
+            # Transactions are named by URL rule, as the sampler's routes are
+            FlaskIntegration(transaction_style='url'),
+            # Sentry handles records on the thread that logs them, so only
+            # warnings and errors are sent as Sentry logs, not every INFO line
+            LoggingIntegration(sentry_logs_level=logging.getLevelName(config['SENTRY_LOGS_LEVEL'])),
+            *integrations,
+        ],
+        # Only the integrations listed above: the automatic ones would import
+        # every library they support that is installed (quart, asyncpg, httpx...)
+        auto_enabling_integrations=False,
+        enable_logs=True,
+        **options
+    )
@@ -0,0 +1,244 @@
+# user_status_cache.py
+import hashlib
+import json
+import logging
+import os
+import select as selectors
+import threading
+import time
+
+from prometheus_client import Counter, Gauge
+from sqlalchemy import event, inspect, select, text
+from sqlalchemy.orm import Session
+
+from .cache import TTLCache
+from .extensions import db, metrics
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+# Committed changes to a user's status are announced on this channel, with
+# the user's Auth0 sub as the payload, by whichever process made them
+NOTIFY_CHANNEL = 'user_status'
+
+# The User columns /api/user/status returns, or that decide what it returns
+STATUS_COLUMNS = ('email', 'subscription_plan', 'stripe_customer_id')
+
+# --- User Status Cache Metrics ---
+USER_STATUS_CACHE_LOOKUPS = Counter(
+    'user_status_cache_lookups_total',
+    '/api/user/status cache lookups by result (hit, miss or bypass).',
+    ['result'],
+    registry=metrics.registry
+)
+USER_STATUS_CACHE_INVALIDATIONS = Counter(
+    'user_status_cache_invalidations_total',
+    'User status cache entries dropped by reason.',
+    ['reason'],
+    registry=metrics.registry
+)
+USER_STATUS_LISTENER_CONNECTED = Gauge(
+    'user_status_listener_connected',
+    'Whether this worker is listening for user status changes (1) or not (0).',
+    registry=metrics.registry,
+    multiprocess_mode='max'
+)
+
+
+class UserStatusCache:
+    """
+    A per-worker read-through cache of the /api/user/status projection,
+    keyed by Auth0 sub and bounded by USER_STATUS_CACHE_SIZE and
+    USER_STATUS_CACHE_TTL.
+
+    Every worker runs a thread that LISTENs on NOTIFY_CHANNEL and drops the
+    entry of each user it hears about. Commits that change a user's status
+    send that NOTIFY (see the session events below), so the stripe-inbox
+    workers and CLI commands invalidate the web workers' caches as soon as
+    they commit. While the listener is disconnected the cache is bypassed,
+    since invalidations could be missed.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.ttl = 60
+        self.max_size = 10000
+        self._entries = TTLCache(self.max_size, self.ttl)
+        # Bumped by every invalidation, so a load that raced one isn't cached
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._listening = threading.Event()
+        self._pid = None
+        self._engine = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('USER_STATUS_CACHE_ENABLED', self.enabled)
+        app.config.setdefault('USER_STATUS_CACHE_TTL', self.ttl)
+        app.config.setdefault('USER_STATUS_CACHE_SIZE', self.max_size)
+
+        self.enabled = app.config['USER_STATUS_CACHE_ENABLED']
+        self.ttl = app.config['USER_STATUS_CACHE_TTL']
+        self.max_size = app.config['USER_STATUS_CACHE_SIZE']
+        self._entries = TTLCache(self.max_size, self.ttl)
+
+        app.extensions['user_status_cache'] = self
+
+    def get(self, auth0_user_id):
+        """
+        Returns (status dict, etag) for the user, or None if there is no such user.
+        Only found users are cached, so a user who onboards is seen right away.
+        """
+        entry, generation = self._lookup(auth0_user_id)
+        if entry is not None:
+            return entry
+        row = db.session.execute(self._query(auth0_user_id)).first()
+        return self._store(auth0_user_id, generation, self._entry(row))
+
+    async def get_async(self, auth0_user_id, session):
+        """get() for the async handlers, loading misses through an AsyncSession."""
+        entry, generation = self._lookup(auth0_user_id)
+        if entry is not None:
+            return entry
+        row = (await session.execute(self._query(auth0_user_id))).first()
+        return self._store(auth0_user_id, generation, self._entry(row))
+
+    def start(self):
+        """Starts this process's invalidation listener ahead of the first lookup."""
+        if self.enabled:
+            self._ensure_listening()
+
+    def _lookup(self, auth0_user_id):
+        """
+        Returns (cached entry, None) on a hit. On a miss, returns (None, generation)
+        to pass to _store, or (None, None) if what's loaded mustn't be cached.
+        """
+        if not self.enabled:
+            USER_STATUS_CACHE_LOOKUPS.labels(result='bypass').inc()
+            return None, None
+
+        self._ensure_listening()
+        if not self._listening.is_set():
+            USER_STATUS_CACHE_LOOKUPS.labels(result='bypass').inc()
+            return None, None
+
+        entry = self._entries.get(auth0_user_id)
+        if entry is not None:
+            USER_STATUS_CACHE_LOOKUPS.labels(result='hit').inc()
+            return entry, None
+
+        USER_STATUS_CACHE_LOOKUPS.labels(result='miss').inc()
+        return None, self._generation
+
+    def _store(self, auth0_user_id, generation, entry):
+        if entry is not None and generation is not None:
+            with self._lock:
+                if generation == self._generation:
+                    self._entries.set(auth0_user_id, entry)
+        return entry
+
+    def invalidate(self, auth0_user_id, reason='notify'):
+        with self._lock:
+            self._generation += 1
+            self._entries.delete(auth0_user_id)
+        USER_STATUS_CACHE_INVALIDATIONS.labels(reason=reason).inc()
+
+    def clear(self, reason='reset'):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+        USER_STATUS_CACHE_INVALIDATIONS.labels(reason=reason).inc()
+
+    @staticmethod
+    def _query(auth0_user_id):
+        return select(User.email, User.subscription_plan).where(User.auth0_user_id == auth0_user_id)
+
+    @staticmethod
+    def _entry(row):
+        if row is None:
+            return None
+        status = {'email': row.email, 'subscription_plan': row.subscription_plan}
+        body = json.dumps(status, sort_keys=True).encode('utf-8')
+        return status, hashlib.sha256(body).hexdigest()[:32]
+
+    # --- Invalidation listener ---
+
+    def _ensure_listening(self):
+        # Threads don't survive fork(), so every worker process starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._listening.clear()
+            self._entries.clear()
+            # The listener keeps its own connection, outside the request pool
+            self._engine = db.engine
+            thread = threading.Thread(target=self._listen, name='user-status-listener', daemon=True)
+            thread.start()
+            self._pid = os.getpid()
+        # Give the first request a moment to find the listener connected
+        self._listening.wait(0.5)
+
+    def _connect(self):
+        dialect = self._engine.dialect
+        cargs, cparams = dialect.create_connect_args(self._engine.url)
+        connection = dialect.connect(*cargs, **cparams)
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f'LISTEN {NOTIFY_CHANNEL}')
+        return connection
+
+    def _listen(self):
+        backoff = 1
+        while True:
+            connection = None
+            try:
+                connection = self._connect()
+                # Changes made while we weren't listening are unknown
+                self.clear(reason='listener_connected')
+                self._listening.set()
+                USER_STATUS_LISTENER_CONNECTED.set(1)
+                backoff = 1
+                while True:
+                    if selectors.select([connection], [], [], 30) == ([], [], []):
+                        # Idle; make sure the connection is still alive
+                        with connection.cursor() as cursor:
+                            cursor.execute('SELECT 1')
+                    connection.poll()
+                    while connection.notifies:
+                        self.invalidate(connection.notifies.pop(0).payload)
+            except Exception as e:
+                self._listening.clear()
+                USER_STATUS_LISTENER_CONNECTED.set(0)
+                logger.warning("User status listener disconnected.", extra={'error_message': str(e)})
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+            finally:
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+
+
+user_status_cache = UserStatusCache()
+
+
+@event.listens_for(Session, 'after_flush')
+def _notify_status_changes(session, flush_context):
+    """
+    Queues a NOTIFY for every flushed user whose status columns changed.
+    Postgres delivers it when the transaction commits, and drops it on rollback.
+    """
+    for obj in session.dirty:
+        if not isinstance(obj, User):
+            continue
+        state = inspect(obj)
+        if any(state.attrs[column].history.has_changes() for column in STATUS_COLUMNS):
+            session.connection().execute(
+                text('SELECT pg_notify(:channel, :auth0_user_id)'),
+                {'channel': NOTIFY_CHANNEL, 'auth0_user_id': obj.auth0_user_id}
+            )
@@ -1,15 +1,15 @@
-import os
+import time
 from functools import wraps
-import json
-from urllib.request import urlopen
 from flask import request, g, jsonify
-from jose import jwt
+from .jwks import key_store
+from .token_cache import token_cache, TOKEN_VERIFICATION_SECONDS
+from .rbac import rbac
+from .request_metrics import add_phase_time
 # from auth0.management import Auth0
 
 # --- CONFIGURE YOUR AUTH0 VARIABLES ---
-# You can find these in your Auth0 Dashboard
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN'] # e.g., 'dev-12345.us.auth0.com'
-API_AUDIENCE = os.environ['AUTH0_AUDIENCE'] # The identifier of your API in Auth0
+# AUTH0_DOMAIN and AUTH0_AUDIENCE are set in Config (you can find them in
+# your Auth0 Dashboard) and read by the key store when the app is created.
 ALGORITHMS = ['RS256']
 # ------------------------------------
 
@@ -59,7 +59,11 @@ class AuthError(Exception):
 
 def get_token_auth_header():
     """Obtains the Access Token from the Authorization Header"""
-    auth = request.headers.get('Authorization', None)
+    return parse_auth_header(request.headers.get('Authorization', None))
+
+
+def parse_auth_header(auth):
+    """Returns the bearer token from an Authorization header value"""
     if not auth:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -94,10 +98,17 @@ def verify_decode_jwt(token):
     Checks the signature using the public key from Auth0 (JWKS).
     Checks the claims (audience, issuer).
     """
-    # GET THE PUBLIC KEY FROM AUTH0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    
+    # The public keys from Auth0 (JWKS) are cached by the key store,
+    # so this only goes over the network when the cached keys are stale.
+    rsa_key = key_store.get_key(get_token_kid(token))
+    return decode_jwt(token, rsa_key)
+
+
+def get_token_kid(token):
+    """Returns the id of the key the JWT claims to be signed with"""
+    # python-jose is imported on first use, not when the app starts
+    from jose import jwt
+
     # GET THE DATA IN THE HEADER
     try:
         unverified_header = jwt.get_unverified_header(token)
@@ -108,33 +119,31 @@ def verify_decode_jwt(token):
         }, 401)
 
     # CHOOSE THE CORRECT KEY
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    
-    # Finally, verify the key
-    if rsa_key:
+    return unverified_header['kid']
+
+
+def decode_jwt(token, rsa_key):
+    """
+    Checks the JWT's signature against `rsa_key` (None if Auth0 has no key
+    with the token's kid) and its claims, and returns the payload.
+    """
+    from jose import jwt
+
+    if rsa_key is not None:
         try:
             # USE THE KEY TO VALIDATE THE JWT
             payload = jwt.decode(
                 token,
                 rsa_key,
                 algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer=f'https://{AUTH0_DOMAIN}/'
+                audience=key_store.audience,
+                issuer=key_store.issuer
             )
             return payload
 
@@ -169,7 +178,20 @@ def requires_auth(f):
     def decorated(*args, **kwargs):
         try:
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
+
+            # Tokens we have already verified are served from the cache,
+            # anything else goes through the full signature check.
+            started = time.perf_counter()
+            payload = token_cache.get(token)
+            if payload is not None:
+                TOKEN_VERIFICATION_SECONDS.labels(path='cached').observe(time.perf_counter() - started)
+            else:
+                try:
+                    payload = verify_decode_jwt(token)
+                finally:
+                    add_phase_time('auth', time.perf_counter() - started)
+                token_cache.put(token, payload)
+                TOKEN_VERIFICATION_SECONDS.labels(path='full').observe(time.perf_counter() - started)
             
             # Make the payload available to the decorated function
             # g is a context-local object in Flask for temporary storage during a request
@@ -181,4 +203,33 @@ def requires_auth(f):
             
         return f(*args, **kwargs)
 
-    return decorated
\ No newline at end of file
+    return decorated
+
+
+def requires_permission(permission):
+    """
+    Checks that the authenticated user holds the given permission,
+    e.g. @requires_permission('create:post'). Goes below @requires_auth,
+    which has to run first to set g.current_user.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            payload = g.get('current_user')
+            if not payload or not payload.get('sub'):
+                return jsonify({
+                    'code': 'authorization_required',
+                    'description': 'Authentication is required before checking permissions.'
+                }), 401
+
+            if not rbac.has_permission(payload['sub'], permission):
+                return jsonify({
+                    'code': 'forbidden',
+                    'description': f'Permission "{permission}" is required.'
+                }), 403
+
+            return f(*args, **kwargs)
+
+        return decorated
+
+    return decorator
\ No newline at end of file
@@ -0,0 +1,164 @@
+# webhook_inbox.py
+import json
+import logging
+import threading
+import time
+
+from prometheus_client import Counter, Histogram
+from sqlalchemy import text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from .extensions import db, metrics
+from .models import StripeEvent
+from .services.stripe_webhooks import HANDLERS, InvalidEvent
+
+logger = logging.getLogger(__name__)
+
+# --- Inbox Metrics ---
+WEBHOOK_EVENTS_RECEIVED = Counter(
+    'stripe_webhook_events_received_total',
+    'Stripe webhook deliveries stored in the inbox, by result (new or duplicate).',
+    ['result'],
+    registry=metrics.registry
+)
+INBOX_EVENTS_PROCESSED = Counter(
+    'stripe_inbox_events_processed_total',
+    'Inbox events handled by the workers, by event type and outcome.',
+    ['type', 'outcome'],
+    registry=metrics.registry
+)
+INBOX_PROCESSING_SECONDS = Histogram(
+    'stripe_inbox_processing_seconds',
+    'Time taken to apply one inbox event.',
+    registry=metrics.registry
+)
+INBOX_LAG_SECONDS = Histogram(
+    'stripe_inbox_lag_seconds',
+    'Time between receiving a webhook and applying it.',
+    registry=metrics.registry,
+    buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+)
+
+# Picks the oldest pending event that is due and whose customer has no
+# older pending event, and locks it. Rows locked by other workers are
+# skipped, and because a locked event still counts as pending, the next
+# event of the same customer can't be picked until it has been applied.
+CLAIM_NEXT_EVENT = text("""
+    SELECT e.id, e.type, e.payload, e.attempts, e.received_at
+    FROM stripe_events e
+    WHERE e.status = 'pending'
+      AND e.next_attempt_at <= now()
+      AND NOT EXISTS (
+          SELECT 1 FROM stripe_events earlier
+          WHERE earlier.customer_key = e.customer_key
+            AND earlier.status = 'pending'
+            AND (earlier.stripe_created, earlier.id) < (e.stripe_created, e.id)
+      )
+    ORDER BY e.stripe_created, e.id
+    LIMIT 1
+    FOR UPDATE OF e SKIP LOCKED
+""")
+
+
+def store_event(event, payload):
+    """
+    Inserts a verified webhook event into the inbox.
+    Redeliveries of an event we already have are no-ops.
+    Returns True if the event was new. The caller commits.
+    """
+    obj = event['data']['object']
+    customer = obj.get('customer') or (obj.get('id') if obj.get('object') == 'customer' else None)
+
+    statement = (
+        pg_insert(StripeEvent)
+        .values(
+            id=event['id'],
+            type=event['type'],
+            customer_key=customer or event['id'],
+            stripe_created=event['created'],
+            payload=json.loads(payload)
+        )
+        .on_conflict_do_nothing(index_elements=[StripeEvent.id])
+        .returning(StripeEvent.id)
+    )
+    is_new = db.session.execute(statement).scalar() is not None
+    WEBHOOK_EVENTS_RECEIVED.labels(result='new' if is_new else 'duplicate').inc()
+    return is_new
+
+
+def process_next_event(max_attempts, retry_base_delay, retry_max_delay):
+    """
+    Claims one event, applies it and records the outcome, all in one
+    transaction. Returns False when no event is ready.
+    """
+    row = db.session.execute(CLAIM_NEXT_EVENT).first()
+    if row is None:
+        db.session.rollback()
+        return False
+
+    handler = HANDLERS.get(row.type)
+    started = time.perf_counter()
+    values = {'attempts': row.attempts + 1}
+    try:
+        # A savepoint, so a failing handler doesn't release our lock on the event
+        with db.session.begin_nested():
+            if handler:
+                handler(row.payload)
+        values.update(status='done', processed_at=db.func.now(), last_error=None)
+        outcome = 'done' if handler else 'ignored'
+    except InvalidEvent as e:
+        values.update(status='failed', last_error=str(e))
+        outcome = 'invalid'
+    except Exception as e:
+        logger.warning(
+            "Stripe event failed, will retry.",
+            extra={'stripe_event_id': row.id, 'attempt': values['attempts'], 'error_message': str(e)}
+        )
+        if values['attempts'] >= max_attempts:
+            values.update(status='failed', last_error=str(e))
+            outcome = 'failed'
+        else:
+            delay = min(retry_max_delay, retry_base_delay * 2 ** row.attempts)
+            values.update(last_error=str(e), next_attempt_at=db.func.now() + text(f"interval '{delay} seconds'"))
+            outcome = 'retry'
+
+    db.session.execute(update(StripeEvent).where(StripeEvent.id == row.id).values(**values))
+    db.session.commit()
+
+    INBOX_EVENTS_PROCESSED.labels(type=row.type, outcome=outcome).inc()
+    INBOX_PROCESSING_SECONDS.observe(time.perf_counter() - started)
+    if outcome in ('done', 'ignored'):
+        INBOX_LAG_SECONDS.observe(max(0, time.time() - row.received_at.timestamp()))
+    return True
+
+
+def run_workers(app, threads, stop_event=None):
+    """
+    Runs `threads` inbox workers until `stop_event` is set.
+    Safe to run in several processes at once: workers coordinate through row locks.
+    """
+    stop_event = stop_event or threading.Event()
+    config = app.config
+
+    def work():
+        while not stop_event.is_set():
+            with app.app_context():
+                try:
+                    processed = process_next_event(
+                        config['STRIPE_INBOX_MAX_ATTEMPTS'],
+                        config['STRIPE_INBOX_RETRY_BASE_DELAY'],
+                        config['STRIPE_INBOX_RETRY_MAX_DELAY'],
+                    )
+                except Exception as e:
+                    # e.g. the database is unreachable; back off and try again
+                    db.session.rollback()
+                    logger.error("Stripe inbox worker error.", extra={'error_message': str(e)})
+                    processed = False
+            if not processed:
+                stop_event.wait(config['STRIPE_INBOX_POLL_INTERVAL'])
+
+    workers = [threading.Thread(target=work, name=f'stripe-inbox-{n}', daemon=True) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
@@ -0,0 +1,7 @@
+# asgi.py
+# The async serving mode, next to the WSGI app in run.py:
+#     hypercorn --bind 0.0.0.0:5000 asgi:app
+# The I/O-bound API routes run as coroutines, the rest on the Flask app.
+from app.async_app import create_async_app
+
+app = create_async_app()
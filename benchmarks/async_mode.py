@@ -0,0 +1,193 @@
+# async_mode.py
+"""
+Compares the WSGI app (run.py under gunicorn) with the async serving mode
+(asgi.py under hypercorn) by how many /api/user/status and
+/api/user/onboard requests one process can hold open at a time.
+
+Each mode runs as a single process: one gthread worker with
+`--threads` threads, or one hypercorn worker. Both get the same DB pool
+(`--pool-size` connections) and reach Postgres through a proxy that adds
+`--db-latency` seconds to every round trip, so requests spend their time
+waiting on the database, as they do when Postgres is across a network.
+The user status cache is off, so every status request goes to Postgres.
+
+For every concurrency level, that many keep-alive clients send requests
+back to back for `--duration` seconds. Next to the latency stats, the
+report has `concurrent_requests`: throughput times the latency of a
+request on an idle server, i.e. how many requests the process was
+working on at once (Little's law). A thread-per-request process levels
+off at its thread count; the async one at its pool size.
+
+Needs a migrated scratch database in DATABASE_URL: the benchmark inserts
+one user (auth0 id 'auth0|bench-async') and deletes it when it is done.
+
+Usage:
+    python -m benchmarks.async_mode --concurrency 1 8 32 128 --output async_mode.json
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from .support import (
+    BENCH_AUDIENCE, BENCH_AUTH0_DOMAIN, FakeJWKSServer, LatencyProxy, SigningKey,
+    mint_token, read_http_response, summarize, write_report,
+)
+from .workers import start_gunicorn, start_server
+
+BENCH_USER = 'auth0|bench-async'
+BENCH_EMAIL = 'bench-async@bench.local'
+ENDPOINTS = {
+    'status': ('GET', '/api/user/status'),
+    'onboard': ('POST', '/api/user/onboard'),
+}
+MODES = ('wsgi', 'asgi')
+
+
+def seed_user():
+    from sqlalchemy import text
+    from app.extensions import db
+
+    remove_user()
+    db.session.execute(text("""
+        INSERT INTO users (id, auth0_user_id, email, subscription_plan)
+        VALUES (gen_random_uuid(), :sub, :email, 'premium')
+    """), {'sub': BENCH_USER, 'email': BENCH_EMAIL})
+    db.session.commit()
+
+
+def remove_user():
+    from sqlalchemy import text
+    from app.extensions import db
+
+    user_ids = "(SELECT id FROM users WHERE auth0_user_id = :sub)"
+    for table in ('audit_logs', 'user_roles'):
+        db.session.execute(text(f"DELETE FROM {table} WHERE user_id IN {user_ids}"), {'sub': BENCH_USER})
+    db.session.execute(text("DELETE FROM users WHERE auth0_user_id = :sub"), {'sub': BENCH_USER})
+    db.session.commit()
+
+
+def start(mode, port, threads, env):
+    if mode == 'wsgi':
+        return start_gunicorn('gthread', 1, port, dict(env, GUNICORN_THREADS=str(threads)))
+    return start_server(['hypercorn', '--bind', f'127.0.0.1:{port}', '--workers', '1', 'asgi:app'],
+                        port, env, 'hypercorn')
+
+
+async def _load(port, request, concurrency, duration):
+    loop = asyncio.get_running_loop()
+    stop_at = loop.time() + duration
+    samples, statuses = [], {}
+
+    async def client():
+        connection = None
+        while loop.time() < stop_at:
+            started = time.perf_counter_ns()
+            try:
+                if connection is None:
+                    connection = await asyncio.open_connection('127.0.0.1', port)
+                reader, writer = connection
+                writer.write(request)
+                status = await asyncio.wait_for(read_http_response(reader), 60)
+            except (OSError, ValueError, IndexError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                if connection is not None:
+                    connection[1].close()
+                connection = None
+                status = 'error'
+            samples.append(time.perf_counter_ns() - started)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        if connection is not None:
+            connection[1].close()
+
+    wall_started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    stats = summarize(samples, time.perf_counter() - wall_started)
+    stats['status_counts'] = statuses
+    return stats
+
+
+def load(port, method, path, token, concurrency, duration):
+    """Runs `concurrency` keep-alive clients against one endpoint for `duration` seconds."""
+    request = (
+        f'{method} {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n'
+        f'Authorization: Bearer {token}\r\nContent-Length: 0\r\n\r\n'
+    ).encode('ascii')
+    return asyncio.run(_load(port, request, concurrency, duration))
+
+
+def run(modes, levels, duration, db_latency, threads, pool_size, port):
+    os.environ.setdefault('AUTH0_DOMAIN', BENCH_AUTH0_DOMAIN)
+    os.environ.setdefault('AUTH0_AUDIENCE', BENCH_AUDIENCE)
+    from app import create_app
+
+    key = SigningKey(kid='bench-async')
+    token = mint_token(key, sub=BENCH_USER, email=BENCH_EMAIL, expires_in=86400)
+    results = {}
+
+    app = create_app()
+    with app.app_context(), FakeJWKSServer([key]) as jwks, \
+            LatencyProxy.for_database(app.config['SQLALCHEMY_DATABASE_URI'], db_latency) as database, \
+            tempfile.TemporaryDirectory() as metrics_dir:
+        seed_user()
+        env = dict(
+            os.environ,
+            DATABASE_URL=database.database_url,
+            AUTH0_JWKS_URL=jwks.url,
+            DB_POOL_SIZE=str(pool_size),
+            DB_MAX_OVERFLOW='0',
+            USER_STATUS_CACHE_ENABLED='false',
+            GUNICORN_MAX_REQUESTS='0',
+            # gthread stops serving once it holds more keep-alive connections than this
+            GUNICORN_WORKER_CONNECTIONS=str(max(max(levels), pool_size) + 10),
+            LOG_FILE='',
+            LOG_LEVEL='WARNING',
+            PROMETHEUS_MULTIPROC_DIR=metrics_dir,
+        )
+        try:
+            for mode in modes:
+                process = start(mode, port, threads, env)
+                try:
+                    results[mode] = {}
+                    for name, (method, path) in ENDPOINTS.items():
+                        # Warm up the token cache and the pool, then time a request on an idle server
+                        load(port, method, path, token, pool_size, 1.0)
+                        idle = load(port, method, path, token, 1, 2.0)
+                        idle_seconds = idle['p50_us'] / 1e6
+                        results[mode][name] = {'idle': idle}
+                        for concurrency in levels:
+                            stats = load(port, method, path, token, concurrency, duration)
+                            stats['concurrent_requests'] = stats['throughput_per_s'] * idle_seconds
+                            results[mode][name][str(concurrency)] = stats
+                finally:
+                    process.terminate()
+                    process.wait(30)
+        finally:
+            remove_user()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 8, 32, 128],
+                        help='concurrent clients, one run per level')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per endpoint and level')
+    parser.add_argument('--db-latency', type=float, default=0.02, help='seconds added to every Postgres round trip')
+    parser.add_argument('--threads', type=int, default=8, help='threads of the WSGI worker')
+    parser.add_argument('--pool-size', type=int, default=40, help='DB connections per process, in both modes')
+    parser.add_argument('--port', type=int, default=5078)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    write_report(
+        'async_mode',
+        run(args.modes, args.concurrency, args.duration, args.db_latency, args.threads, args.pool_size, args.port),
+        args.output,
+        parameters={'concurrency': args.concurrency, 'duration': args.duration, 'db_latency': args.db_latency,
+                    'threads': args.threads, 'pool_size': args.pool_size, 'cpu_count': os.cpu_count()},
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+# auth.py
+"""
+Benchmarks the authentication path (requires_auth / verify_decode_jwt)
+without touching Auth0: RSA keys are generated locally and the JWKS
+document is served by an in-process HTTP stand-in.
+
+Usage:
+    python -m benchmarks.auth --iterations 2000 --output auth.json
+
+Scenarios:
+    cold_cache        every call starts with empty JWKS and token caches
+    warm_keys         JWKS cached, every token is new (full RS256 verification)
+    warm_cache        the same token over and over (verified-token cache hits)
+    key_rotation      every call presents a token signed by a newly published key
+    expired_token     tokens whose 'exp' is in the past
+    malformed_header  broken Authorization headers, rejected before any crypto
+
+The report also times signature verification with each python-jose
+RSA backend installed on this machine.
+"""
+import argparse
+import itertools
+import os
+import time
+
+from jose import jwk, jwt
+
+from .support import (
+    BENCH_AUDIENCE, BENCH_AUTH0_DOMAIN, FakeJWKSServer, SigningKey,
+    mint_token, summarize, write_report,
+)
+
+MALFORMED_HEADERS = [
+    None,
+    'Basic dXNlcjpwYXNzd29yZA==',
+    'Bearer',
+    'Bearer a b',
+    'Bearer not-a-jwt',
+    'Bearer eyJhbGciOiJSUzI1NiJ9.e30.c2ln',  # valid shape, but no 'kid'
+]
+
+
+def _time_calls(view, app, headers_for, iterations, before_each=None):
+    """Calls the decorated view once per iteration inside a request context."""
+    samples = []
+    statuses = {}
+    wall_started = time.perf_counter()
+    for i in range(iterations):
+        if before_each:
+            before_each(i)
+        headers = headers_for(i)
+        with app.test_request_context(headers=headers):
+            started = time.perf_counter_ns()
+            result = view()
+            samples.append(time.perf_counter_ns() - started)
+        status = result[1] if isinstance(result, tuple) else 200
+        statuses[status] = statuses.get(status, 0) + 1
+    stats = summarize(samples, time.perf_counter() - wall_started)
+    stats['status_counts'] = {str(k): v for k, v in sorted(statuses.items())}
+    return stats
+
+
+def _bearer(token):
+    return {'Authorization': f'Bearer {token}'}
+
+
+def run_decorator_scenarios(iterations, rotation_keys):
+    from flask import g
+
+    from app import create_app
+    from app.jwks import key_store
+    from app.token_cache import token_cache
+    from app.utils import requires_auth
+
+    app = create_app()
+
+    @requires_auth
+    def view():
+        return g.current_user['sub']
+
+    key = SigningKey(kid='bench-key-1')
+    server = FakeJWKSServer([key]).start()
+    key_store.jwks_url = server.url
+    results = {}
+
+    try:
+        # --- cold_cache ---
+        token = mint_token(key)
+
+        def reset_caches(_):
+            key_store.clear()
+            token_cache.clear()
+
+        fetches_before = server.fetches
+        results['cold_cache'] = _time_calls(view, app, lambda i: _bearer(token), iterations, reset_caches)
+        results['cold_cache']['jwks_fetches'] = server.fetches - fetches_before
+
+        # --- warm_keys ---
+        # Tokens are minted up front so signing isn't part of the measurement
+        tokens = [mint_token(key) for _ in range(iterations)]
+        token_cache.clear()
+        fetches_before = server.fetches
+        results['warm_keys'] = _time_calls(view, app, lambda i: _bearer(tokens[i]), iterations)
+        results['warm_keys']['jwks_fetches'] = server.fetches - fetches_before
+
+        # --- warm_cache ---
+        fetches_before = server.fetches
+        results['warm_cache'] = _time_calls(view, app, lambda i: _bearer(token), iterations)
+        results['warm_cache']['jwks_fetches'] = server.fetches - fetches_before
+
+        # --- key_rotation ---
+        # Generating RSA keys is slow, so a small pool of keys is rotated through.
+        keys = [SigningKey(kid=f'bench-rotated-{n}') for n in range(rotation_keys)]
+        rotated_tokens = [mint_token(k) for k in keys]
+        key_store.min_refetch_interval = 0
+        token_cache.clear()
+
+        def rotate(i):
+            server.publish([keys[i % len(keys)]])
+            token_cache.clear()
+
+        fetches_before = server.fetches
+        results['key_rotation'] = _time_calls(
+            view, app, lambda i: _bearer(rotated_tokens[i % len(keys)]), iterations, rotate
+        )
+        results['key_rotation']['jwks_fetches'] = server.fetches - fetches_before
+        key_store.min_refetch_interval = app.config['JWKS_MIN_REFETCH_INTERVAL']
+        server.publish([key])
+        key_store.clear()
+
+        # --- expired_token ---
+        expired = mint_token(key, expires_in=-60)
+        results['expired_token'] = _time_calls(view, app, lambda i: _bearer(expired), iterations)
+
+        # --- malformed_header ---
+        cycle = itertools.cycle(MALFORMED_HEADERS)
+
+        def malformed(_):
+            header = next(cycle)
+            return {'Authorization': header} if header else {}
+
+        results['malformed_header'] = _time_calls(view, app, malformed, iterations)
+    finally:
+        server.stop()
+
+    return results
+
+
+def _rsa_backends():
+    """Returns the python-jose RSA key classes that can be imported here."""
+    backends = {}
+    try:
+        from jose.backends.cryptography_backend import CryptographyRSAKey
+        backends['cryptography'] = CryptographyRSAKey
+    except ImportError:
+        pass
+    try:
+        from jose.backends.rsa_backend import RSAKey
+        backends['python-rsa'] = RSAKey
+    except ImportError:
+        pass
+    return backends
+
+
+def run_backend_comparison(iterations):
+    """Times jwt.decode with each RSA backend on the same token and key."""
+    key = SigningKey(kid='bench-backend')
+    token = mint_token(key)
+    results = {}
+    for name, key_class in _rsa_backends().items():
+        public_key = key_class(key.jwk, 'RS256')
+        samples = []
+        wall_started = time.perf_counter()
+        for _ in range(iterations):
+            started = time.perf_counter_ns()
+            jwt.decode(
+                token,
+                public_key,
+                algorithms=['RS256'],
+                audience=BENCH_AUDIENCE,
+                issuer=f'https://{BENCH_AUTH0_DOMAIN}/'
+            )
+            samples.append(time.perf_counter_ns() - started)
+        results[name] = summarize(samples, time.perf_counter() - wall_started)
+    results['default'] = type(jwk.construct(key.jwk, 'RS256')).__module__
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=1000, help='calls per scenario')
+    parser.add_argument('--rotation-keys', type=int, default=4, help='distinct keys used by key_rotation')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    # The app reads its Auth0 settings from the environment at import time
+    os.environ['AUTH0_DOMAIN'] = BENCH_AUTH0_DOMAIN
+    os.environ['AUTH0_AUDIENCE'] = BENCH_AUDIENCE
+
+    import jose
+    results = {
+        'requires_auth': run_decorator_scenarios(args.iterations, args.rotation_keys),
+        'jose_backends': run_backend_comparison(args.iterations),
+    }
+    write_report(
+        'auth',
+        results,
+        args.output,
+        parameters={'iterations': args.iterations, 'rotation_keys': args.rotation_keys},
+        versions={'python-jose': getattr(jose, '__version__', None)},
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+# loadtest.py
+"""
+End-to-end load test of the app with no external services: the app runs
+under gunicorn (or hypercorn, `--server asgi`) against a throwaway
+Postgres, a fake Auth0 JWKS endpoint and a fake Stripe, and keep-alive
+clients send it a weighted mix of requests:
+
+    onboard    POST /api/user/onboard           (`--new-users` of them sign up a new user)
+    status     GET  /api/user/status
+    checkout   POST /api/create-checkout-session
+    webhook    POST /stripe-webhook              (signed checkout.session.completed and
+                                                  customer.subscription.deleted events)
+
+Every user is onboarded before the measured run. Stripe answers after
+`--stripe-latency` seconds (plus up to `--stripe-jitter`) and fails
+`--stripe-error-rate` of its requests; `--db-latency` puts a round trip
+between the app and Postgres. A `flask stripe-inbox work` process applies
+the webhook events as they arrive, as in production.
+
+Without `--rate`, `--concurrency` clients send requests back to back.
+With it, requests start at that fixed total rate and latency is counted
+from when each one was due, so a server that falls behind shows it in
+the percentiles instead of quietly receiving fewer requests.
+
+The report has throughput and latency percentiles per route and overall.
+`--compare` adds the change against an earlier report of this suite.
+
+The database is created on `--postgres-url` (a server the benchmark may
+create and drop databases on) and dropped afterwards. Without it, a new
+cluster is set up with initdb and pg_ctl from PG_BIN or the PATH.
+
+Usage:
+    python -m benchmarks.loadtest --duration 30 --concurrency 32 --output loadtest.json
+    python -m benchmarks.loadtest --mix status=8 onboard=1 checkout=1 webhook=1 --stripe-error-rate 0.05
+    python -m benchmarks.loadtest --rate 200 --compare loadtest.json --output loadtest-new.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import ExitStack
+
+from .support import (
+    BENCH_AUDIENCE, BENCH_AUTH0_DOMAIN, ROOT, FakeJWKSServer, FakeStripeServer, LatencyProxy, SigningKey,
+    ThrowawayPostgres, mint_token, read_http_response, stripe_signature, summarize, write_report,
+)
+from .workers import start_gunicorn, start_server
+
+ROUTES = {
+    'onboard': ('POST', '/api/user/onboard'),
+    'status': ('GET', '/api/user/status'),
+    'checkout': ('POST', '/api/create-checkout-session'),
+    'webhook': ('POST', '/stripe-webhook'),
+}
+DEFAULT_MIX = ('status=6', 'onboard=2', 'checkout=1', 'webhook=1')
+WEBHOOK_SECRET = 'whsec_bench'
+# Compared by --compare, for every route and overall
+COMPARED_STATS = ('throughput_per_s', 'p50_us', 'p95_us', 'p99_us')
+
+
+def parse_mix(items):
+    """Turns ['status=6', 'onboard=1'] into {'status': 6.0, 'onboard': 1.0}."""
+    mix = {}
+    for item in items:
+        route, _, weight = item.partition('=')
+        if route not in ROUTES:
+            raise argparse.ArgumentTypeError(f'unknown route {route!r} (one of {", ".join(ROUTES)})')
+        mix[route] = float(weight or 1)
+    return mix
+
+
+class User:
+    def __init__(self, key, n):
+        self.sub = f'auth0|loadtest{n:08d}'
+        self.email = f'loadtest{n}@bench.local'
+        self.customer = f'cus_loadtest{n}'
+        self.token = mint_token(key, sub=self.sub, email=self.email, expires_in=86400)
+        self.id = None
+
+
+class Traffic:
+    """Builds the raw HTTP requests of the mix, each for a random user."""
+
+    def __init__(self, port, key, users, mix, new_users, seed=0):
+        self.port = port
+        self.key = key
+        self.users = users
+        self.routes = list(mix)
+        self.weights = [mix[route] for route in self.routes]
+        self.new_users = new_users
+        self.random = random.Random(seed)
+        self._signups = itertools.count(len(users))
+
+    def _request(self, route, token=None, body=b'', headers=()):
+        method, path = ROUTES[route]
+        lines = [f'{method} {path} HTTP/1.1', f'Host: 127.0.0.1:{self.port}', f'Content-Length: {len(body)}']
+        if token:
+            lines.append(f'Authorization: Bearer {token}')
+        lines.extend(headers)
+        return (('\r\n'.join(lines) + '\r\n\r\n').encode('ascii') + body)
+
+    def onboard(self, user):
+        return self._request('onboard', user.token)
+
+    def next(self):
+        """Returns (route, request bytes)."""
+        route = self.random.choices(self.routes, self.weights)[0]
+        user = self.random.choice(self.users)
+        if route == 'onboard' and self.random.random() < self.new_users:
+            user = User(self.key, next(self._signups))
+        if route != 'webhook':
+            return route, self._request(route, user.token)
+
+        if self.random.random() < 0.5:
+            obj = {'object': 'checkout.session', 'id': f'cs_{uuid.uuid4().hex}',
+                   'client_reference_id': user.id, 'customer': user.customer}
+            event_type = 'checkout.session.completed'
+        else:
+            obj = {'object': 'subscription', 'id': f'sub_{uuid.uuid4().hex}', 'customer': user.customer}
+            event_type = 'customer.subscription.deleted'
+        payload = json.dumps({
+            'id': f'evt_{uuid.uuid4().hex}', 'object': 'event', 'type': event_type,
+            'created': int(time.time()), 'data': {'object': obj},
+        }).encode('utf-8')
+        signature = stripe_signature(payload, WEBHOOK_SECRET)
+        return route, self._request(route, body=payload, headers=(
+            'Content-Type: application/json', f'Stripe-Signature: {signature}'))
+
+
+async def _drive(port, requests, concurrency, duration=None, rate=None):
+    """
+    Sends requests from `requests()` (which returns (route, bytes), or None
+    when there are no more) over `concurrency` keep-alive connections.
+    Returns ({route: latencies in ns}, {route: {status: count}}, wall seconds).
+    """
+    loop = asyncio.get_running_loop()
+    started_at = loop.time()
+    stop_at = started_at + duration if duration else None
+    slots = itertools.count()
+    samples, statuses = {}, {}
+
+    async def client():
+        connection = None
+        while True:
+            if rate:
+                due = started_at + next(slots) / rate
+                if due >= stop_at:
+                    break
+                if due > loop.time():
+                    await asyncio.sleep(due - loop.time())
+            elif stop_at is not None and loop.time() >= stop_at:
+                break
+            else:
+                due = loop.time()
+            item = requests()
+            if item is None:
+                break
+            route, request = item
+            try:
+                if connection is None:
+                    connection = await asyncio.open_connection('127.0.0.1', port)
+                reader, writer = connection
+                writer.write(request)
+                status = await asyncio.wait_for(read_http_response(reader), 60)
+            except (OSError, ValueError, IndexError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                if connection is not None:
+                    connection[1].close()
+                connection = None
+                status = 'error'
+            samples.setdefault(route, []).append(int((loop.time() - due) * 1e9))
+            counts = statuses.setdefault(route, {})
+            counts[str(status)] = counts.get(str(status), 0) + 1
+        if connection is not None:
+            connection[1].close()
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return samples, statuses, loop.time() - started_at
+
+
+def onboard_users(port, traffic, users, concurrency):
+    pending = iter(users)
+
+    def requests():
+        user = next(pending, None)
+        return None if user is None else ('onboard', traffic.onboard(user))
+
+    _, statuses, _ = asyncio.run(_drive(port, requests, concurrency))
+    if set(statuses.get('onboard', {})) - {'200', '201'}:
+        raise RuntimeError(f'Onboarding the load-test users failed: {statuses}')
+
+
+def load_user_ids(database_url, users):
+    from sqlalchemy import create_engine, text
+
+    engine = create_engine(database_url)
+    with engine.connect() as connection:
+        ids = dict(connection.execute(text(
+            "SELECT auth0_user_id, id::text FROM users WHERE auth0_user_id LIKE 'auth0|loadtest%'")).all())
+    engine.dispose()
+    for user in users:
+        user.id = ids[user.sub]
+
+
+def inbox_counts(database_url):
+    from sqlalchemy import create_engine, text
+
+    engine = create_engine(database_url)
+    with engine.connect() as connection:
+        counts = dict(connection.execute(text("SELECT status, count(*) FROM stripe_events GROUP BY status")).all())
+    engine.dispose()
+    return counts
+
+
+def compare(results, baseline_path):
+    """The change of COMPARED_STATS against the results of an earlier report."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    comparison = {}
+    for name in ['total', *results['routes']]:
+        current = results['total'] if name == 'total' else results['routes'][name]
+        before = baseline['total'] if name == 'total' else baseline.get('routes', {}).get(name)
+        if not before:
+            continue
+        comparison[name] = {}
+        for stat in COMPARED_STATS:
+            if current.get(stat) is None or not before.get(stat):
+                continue
+            comparison[name][stat] = {
+                'baseline': before[stat],
+                'current': current[stat],
+                'change': current[stat] / before[stat] - 1,
+            }
+    return comparison
+
+
+def start(server, port, workers, threads, env):
+    if server == 'gunicorn':
+        return start_gunicorn('gthread', workers, port, dict(env, GUNICORN_THREADS=str(threads)))
+    return start_server(['hypercorn', '--bind', f'127.0.0.1:{port}', '--workers', str(workers or 1), 'asgi:app'],
+                        port, env, 'hypercorn')
+
+
+def run(args):
+    mix = parse_mix(args.mix)
+    key = SigningKey(kid='bench-loadtest')
+    users = [User(key, n) for n in range(args.users)]
+
+    with ExitStack() as stack:
+        database = stack.enter_context(ThrowawayPostgres(args.postgres_url))
+        database_url = database.url
+        if args.db_latency:
+            database_url = stack.enter_context(LatencyProxy.for_database(database.url, args.db_latency)).database_url
+        jwks = stack.enter_context(FakeJWKSServer([key]))
+        stripe_server = stack.enter_context(FakeStripeServer(
+            latency=args.stripe_latency, latency_jitter=args.stripe_jitter,
+            error_rate=args.stripe_error_rate, error_status=args.stripe_error_status,
+        ))
+        metrics_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        env = dict(
+            os.environ,
+            DATABASE_URL=database_url,
+            AUTH0_DOMAIN=BENCH_AUTH0_DOMAIN,
+            AUTH0_AUDIENCE=BENCH_AUDIENCE,
+            AUTH0_JWKS_URL=jwks.url,
+            STRIPE_API_BASE=stripe_server.url,
+            STRIPE_API_KEY='sk_test_bench',
+            STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET,
+            STRIPE_PRICE_ID='price_bench',
+            NEXT_PUBLIC_APP_URL='https://app.bench.local',
+            GUNICORN_MAX_REQUESTS='0',
+            # gthread stops serving once it holds more keep-alive connections than this
+            GUNICORN_WORKER_CONNECTIONS=str(args.concurrency + 10),
+            LOG_FILE='',
+            LOG_LEVEL='WARNING',
+            PROMETHEUS_MULTIPROC_DIR=metrics_dir,
+        )
+
+        process = start(args.server, args.port, args.workers, args.threads, env)
+        stack.callback(process.wait, 30)
+        stack.callback(process.terminate)
+        inbox = None
+        if args.inbox_threads:
+            inbox = subprocess.Popen(
+                [sys.executable, '-m', 'flask', '--app', 'run', 'stripe-inbox', 'work',
+                 '--threads', str(args.inbox_threads)],
+                cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            stack.callback(inbox.wait, 30)
+            stack.callback(inbox.terminate)
+
+        traffic = Traffic(args.port, key, users, mix, args.new_users, seed=args.seed)
+        onboard_users(args.port, traffic, users, args.concurrency)
+        load_user_ids(database.url, users)
+        if args.warmup:
+            asyncio.run(_drive(args.port, traffic.next, args.concurrency, args.warmup))
+        stripe_server.requests = stripe_server.errors = 0
+
+        samples, statuses, wall = asyncio.run(
+            _drive(args.port, traffic.next, args.concurrency, args.duration, args.rate))
+
+        routes = {}
+        for route in mix:
+            routes[route] = summarize(samples.get(route, []), wall)
+            routes[route]['status_counts'] = statuses.get(route, {})
+        results = {
+            'routes': routes,
+            'total': summarize([sample for route in samples.values() for sample in route], wall),
+            'stripe': {'requests': stripe_server.requests, 'injected_errors': stripe_server.errors},
+            'inbox': inbox_counts(database.url),
+        }
+    if args.compare:
+        results['comparison'] = compare(results, args.compare)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mix', nargs='+', default=list(DEFAULT_MIX),
+                        help='route=weight pairs (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds of measured load')
+    parser.add_argument('--warmup', type=float, default=5.0, help='seconds of unmeasured load first')
+    parser.add_argument('--concurrency', type=int, default=32, help='client connections')
+    parser.add_argument('--rate', type=float, help='total requests per second to start (default: closed loop)')
+    parser.add_argument('--users', type=int, default=500, help='users onboarded before the run')
+    parser.add_argument('--new-users', type=float, default=0.1, help='share of onboard requests by new users')
+    parser.add_argument('--server', choices=('gunicorn', 'asgi'), default='gunicorn')
+    parser.add_argument('--workers', type=int, help='server processes (default: as gunicorn.conf.py sizes them)')
+    parser.add_argument('--threads', type=int, default=8, help='threads per gunicorn worker')
+    parser.add_argument('--inbox-threads', type=int, default=2, help='stripe-inbox worker threads (0: none)')
+    parser.add_argument('--stripe-latency', type=float, default=0.2, help='seconds per Stripe request')
+    parser.add_argument('--stripe-jitter', type=float, default=0.1, help='up to this many seconds more')
+    parser.add_argument('--stripe-error-rate', type=float, default=0.0, help='share of Stripe requests that fail')
+    parser.add_argument('--stripe-error-status', type=int, default=500, help='HTTP status of those failures')
+    parser.add_argument('--db-latency', type=float, default=0.0, help='seconds added to every Postgres round trip')
+    parser.add_argument('--postgres-url', help='server to create the throwaway database on (default: a new cluster)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the request mix')
+    parser.add_argument('--port', type=int, default=5079)
+    parser.add_argument('--compare', help='an earlier report of this suite to compare against')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    write_report(
+        'loadtest',
+        run(args),
+        args.output,
+        parameters={name: value for name, value in vars(args).items() if name not in ('output', 'compare', 'port', 'postgres_url')},
+    )
+
+
+if __name__ == '__main__':
+    main()
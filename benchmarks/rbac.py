@@ -0,0 +1,112 @@
+# rbac.py
+"""
+Benchmarks permission checks in app/rbac.py as the role -> permission
+graph grows. Everything runs in memory: the engine's loaders are replaced
+with synthetic data, so no database is needed.
+
+Usage:
+    python -m benchmarks.rbac --iterations 100000 --output rbac.json
+
+For every graph size the report has the latency of RBACEngine.has_permission
+for a granted permission, a missing permission and an unknown permission,
+all with warm caches. The numbers should stay flat from row to row.
+"""
+import argparse
+import random
+import time
+
+from .support import summarize, write_report
+
+# (roles, permissions, roles per user)
+GRAPH_SIZES = [
+    (5, 20, 1),
+    (50, 500, 3),
+    (500, 5000, 5),
+    (2000, 50000, 10),
+]
+USERS = 1000
+
+
+def build_engine(roles, permissions, roles_per_user, seed=0):
+    from app.rbac import PermissionGraph, RBACEngine
+
+    rng = random.Random(seed)
+    names = [f'action{n}:resource{n % 97}' for n in range(permissions)]
+    # Every role gets a random tenth of the permissions (at least one)
+    edges = [
+        (role_id, name)
+        for role_id in range(roles)
+        for name in rng.sample(names, max(1, permissions // 10))
+    ]
+    assignments = {
+        f'auth0|bench-{n}': frozenset(rng.sample(range(roles), min(roles, roles_per_user)))
+        for n in range(USERS)
+    }
+
+    class InMemoryRBACEngine(RBACEngine):
+        def load_graph(self):
+            return PermissionGraph(edges)
+
+        def load_user_roles(self, auth0_user_id):
+            return assignments.get(auth0_user_id, frozenset())
+
+    engine = InMemoryRBACEngine()
+    engine.graph_ttl = engine.user_cache_ttl = 3600
+    return engine, assignments
+
+
+def time_checks(engine, checks, iterations):
+    samples = []
+    wall_started = time.perf_counter()
+    for i in range(iterations):
+        sub, permission = checks[i % len(checks)]
+        started = time.perf_counter_ns()
+        engine.has_permission(sub, permission)
+        samples.append(time.perf_counter_ns() - started)
+    return summarize(samples, time.perf_counter() - wall_started)
+
+
+def run(iterations):
+    results = []
+    for roles, permissions, roles_per_user in GRAPH_SIZES:
+        engine, assignments = build_engine(roles, permissions, roles_per_user)
+        users = list(assignments)
+
+        granted, missing = [], []
+        for sub in users:
+            effective = engine.permissions_for(sub)  # also warms every cache
+            granted.append((sub, next(iter(effective))))
+            for role_permissions in engine.graph.role_permissions.values():
+                absent = next((name for name in role_permissions if name not in effective), None)
+                if absent:
+                    missing.append((sub, absent))
+                    break
+        unknown = [(sub, 'nonexistent:permission') for sub in users]
+
+        results.append({
+            'roles': roles,
+            'permissions': permissions,
+            'roles_per_user': roles_per_user,
+            'granted': time_checks(engine, granted, iterations),
+            'missing': time_checks(engine, missing, iterations) if missing else None,
+            'unknown': time_checks(engine, unknown, iterations),
+        })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=100000, help='checks per scenario')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    write_report(
+        'rbac',
+        run(args.iterations),
+        args.output,
+        parameters={'iterations': args.iterations, 'users': USERS},
+    )
+
+
+if __name__ == '__main__':
+    main()
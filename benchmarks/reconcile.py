@@ -0,0 +1,148 @@
+# reconcile.py
+"""
+Benchmarks `flask subscriptions reconcile` (app/services/subscription_reconciler.py)
+against an in-process stand-in for the Stripe list API.
+
+Needs a migrated scratch database in DATABASE_URL: the benchmark inserts
+its own users (auth0 ids starting with 'auth0|bench-reconcile-') and
+deletes them, with their audit entries, when it is done.
+
+Usage:
+    python -m benchmarks.reconcile --customers 200000 --latency 0.05 --output reconcile.json
+
+Every customer gets one subscription, some also an older canceled one,
+and a share of users is given the wrong plan. For each concurrency level
+the report has the time of a full run, the Stripe calls it made and
+whether every drifted user was fixed.
+"""
+import argparse
+import os
+import random
+import time
+
+from .support import BENCH_AUDIENCE, BENCH_AUTH0_DOMAIN, FakeStripeServer, write_report
+
+USER_PREFIX = 'auth0|bench-reconcile-'
+
+
+def build_subscriptions(customers, seed=0):
+    """Returns (subscriptions, expected plan per customer)."""
+    rng = random.Random(seed)
+    now = int(time.time())
+    subscriptions, expected = [], {}
+    for n in range(customers):
+        customer = f'cus_bench{n:08d}'
+        created = now - rng.randrange(2 * 365 * 86400)
+        status = rng.choices(['active', 'trialing', 'past_due', 'canceled'], [70, 5, 5, 20])[0]
+        subscriptions.append({'id': f'sub_bench{n:08d}', 'customer': customer, 'status': status, 'created': created})
+        if rng.random() < 0.1:
+            # An earlier subscription that was canceled before this one started
+            subscriptions.append({'id': f'sub_bench{n:08d}old', 'customer': customer,
+                                  'status': 'canceled', 'created': created - 86400 * rng.randrange(1, 90)})
+        expected[customer] = 'free' if status == 'canceled' else 'premium'
+    return subscriptions, expected
+
+
+def seed_users(expected, drift, seed=0):
+    """Inserts one user per customer; a `drift` share of them with the wrong plan."""
+    from sqlalchemy import text
+    from app.extensions import db
+
+    rng = random.Random(seed)
+    rows = []
+    for n, (customer, plan) in enumerate(expected.items()):
+        if rng.random() < drift:
+            plan = 'free' if plan == 'premium' else 'premium'
+        rows.append({'auth0_user_id': f'{USER_PREFIX}{n}', 'email': f'bench-reconcile-{n}@bench.local',
+                     'plan': plan, 'customer': customer})
+    # Backdated, so the reconciler's default window covers every subscription
+    db.session.execute(text("""
+        INSERT INTO users (id, auth0_user_id, email, subscription_plan, stripe_customer_id, created_at)
+        VALUES (gen_random_uuid(), :auth0_user_id, :email, :plan, :customer, now() - interval '3 years')
+    """), rows)
+    db.session.commit()
+
+
+def drifted_users(expected):
+    from sqlalchemy import text
+    from app.extensions import db
+
+    rows = db.session.execute(text(
+        "SELECT stripe_customer_id, subscription_plan FROM users WHERE auth0_user_id LIKE :prefix"
+    ), {'prefix': USER_PREFIX + '%'}).all()
+    db.session.rollback()
+    return sum(1 for customer, plan in rows if expected[customer] != plan)
+
+
+def remove_users():
+    from sqlalchemy import text
+    from app.extensions import db
+
+    bench_users = "SELECT id FROM users WHERE auth0_user_id LIKE :prefix"
+    params = {'prefix': USER_PREFIX + '%'}
+    db.session.execute(text(f"DELETE FROM audit_logs WHERE user_id IN ({bench_users})"), params)
+    db.session.execute(text("DELETE FROM users WHERE auth0_user_id LIKE :prefix"), params)
+    db.session.execute(text("TRUNCATE stripe_subscription_snapshot, subscription_sync_windows"))
+    db.session.commit()
+
+
+def run(customers, drift, latency, concurrency_levels):
+    os.environ.setdefault('AUTH0_DOMAIN', BENCH_AUTH0_DOMAIN)
+    os.environ.setdefault('AUTH0_AUDIENCE', BENCH_AUDIENCE)
+    subscriptions, expected = build_subscriptions(customers)
+    results = {}
+
+    with FakeStripeServer(subscriptions, latency=latency) as server:
+        # Config reads the environment when it is imported
+        os.environ['STRIPE_API_BASE'] = server.url
+        os.environ['STRIPE_API_KEY'] = 'sk_test_bench'
+        from app import create_app
+        from app.services import subscription_reconciler
+
+        app = create_app()
+        with app.app_context():
+            remove_users()
+            try:
+                for concurrency in concurrency_levels:
+                    seed_users(expected, drift)
+                    drifted_before = drifted_users(expected)
+                    server.requests = 0
+
+                    started = time.perf_counter()
+                    summary = subscription_reconciler.reconcile(app, concurrency=concurrency)
+                    seconds = time.perf_counter() - started
+
+                    results[f'concurrency_{concurrency}'] = {
+                        'seconds': seconds,
+                        'customers_per_s': customers / seconds,
+                        'stripe_requests': server.requests,
+                        'subscriptions_fetched': summary['fetched'],
+                        'drifted_before': drifted_before,
+                        'fixed': summary['upgraded'] + summary['downgraded'],
+                        'drifted_after': drifted_users(expected),
+                    }
+                    remove_users()
+            finally:
+                remove_users()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=50000, help='Stripe customers (and users)')
+    parser.add_argument('--drift', type=float, default=0.05, help='share of users with the wrong plan')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per Stripe list call')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8], help='levels to compare')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    write_report(
+        'reconcile',
+        run(args.customers, args.drift, args.latency, args.concurrency),
+        args.output,
+        parameters={'customers': args.customers, 'drift': args.drift, 'latency': args.latency},
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,620 @@
+# support.py
+"""
+Shared helpers for the benchmark suites: locally generated RSA keys,
+in-process stand-ins for the Auth0 JWKS endpoint and the Stripe API,
+a latency-adding proxy, throwaway Postgres databases, token minting,
+latency statistics and JSON reports.
+"""
+import asyncio
+import base64
+import bisect
+import collections
+import hashlib
+import hmac
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import rsa
+from jose import jwk, jwt
+
+# Auth0 settings the benchmarks run the app with.
+# The domain only has to match the issuer claim, it is never resolved.
+BENCH_AUTH0_DOMAIN = 'bench.auth0.local'
+BENCH_AUDIENCE = 'https://api.bench.local'
+EMAIL_CLAIM = 'https://my-template-app.com/email'
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _b64_uint(value):
+    """Encodes an integer as unpadded base64url, as JWKs expect."""
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _generate_rsa_key(bits):
+    """
+    Returns (n, e, private PEM) for a new RSA key.
+    Uses 'cryptography' when it is installed, since pure-Python
+    key generation takes seconds per key.
+    """
+    try:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa as crypto_rsa
+    except ImportError:
+        public_key, private_key = rsa.newkeys(bits)
+        return public_key.n, public_key.e, private_key.save_pkcs1().decode('ascii')
+
+    private_key = crypto_rsa.generate_private_key(public_exponent=65537, key_size=bits)
+    numbers = private_key.public_key().public_numbers()
+    pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.TraditionalOpenSSL,
+        serialization.NoEncryption(),
+    )
+    return numbers.n, numbers.e, pem.decode('ascii')
+
+
+class SigningKey:
+    """An RSA key pair together with its public JWK."""
+
+    def __init__(self, kid=None, bits=2048):
+        self.kid = kid or uuid.uuid4().hex
+        n, e, self.private_pem = _generate_rsa_key(bits)
+        # Parsing a PEM is expensive, so the signing key is built only once
+        self.signer = jwk.construct(self.private_pem, 'RS256')
+        self.jwk = {
+            'kty': 'RSA',
+            'kid': self.kid,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': _b64_uint(n),
+            'e': _b64_uint(e),
+        }
+
+
+def mint_token(key, sub=None, email=None, expires_in=3600, audience=BENCH_AUDIENCE,
+               domain=BENCH_AUTH0_DOMAIN, **extra_claims):
+    """Mints an RS256 access token shaped like the ones Auth0 issues for our SPA."""
+    now = int(time.time())
+    sub = sub or f'auth0|{uuid.uuid4().hex[:24]}'
+    claims = {
+        'iss': f'https://{domain}/',
+        'sub': sub,
+        'aud': [audience, f'https://{domain}/userinfo'],
+        'iat': now,
+        'exp': now + expires_in,
+        'azp': 'bench-spa-client-id',
+        'scope': 'openid profile email',
+        EMAIL_CLAIM: email or f'{sub.split("|")[-1]}@bench.local',
+    }
+    claims.update(extra_claims)
+    return jwt.encode(claims, key.signer, algorithm='RS256', headers={'kid': key.kid})
+
+
+class FakeJWKSServer:
+    """
+    Serves a JWKS document from a background thread on 127.0.0.1.
+
+    The published keys can be swapped at any time (see `publish`) to
+    simulate a key rotation, and every fetch is counted.
+    """
+
+    def __init__(self, keys=(), latency=0.0):
+        self.latency = latency
+        self.fetches = 0
+        self._document = b''
+        self.publish(keys)
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.fetches += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                body = server._document
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='fake-jwks', daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address
+        return f'http://{host}:{port}/.well-known/jwks.json'
+
+    def publish(self, keys):
+        self._document = json.dumps({'keys': [key.jwk for key in keys]}).encode('utf-8')
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+# POST path -> (object, id prefix) of the sessions FakeStripeServer creates
+SESSION_OBJECTS = {
+    '/v1/checkout/sessions': ('checkout.session', 'cs_test'),
+    '/v1/billing_portal/sessions': ('billing_portal.session', 'bps_test'),
+}
+
+
+class FakeStripeServer:
+    """
+    Serves GET /v1/subscriptions from a background thread on 127.0.0.1,
+    with Stripe's list semantics: newest first, `limit`, `starting_after`
+    and `created[gte]` / `created[lt]` filters. POST /v1/checkout/sessions
+    and /v1/billing_portal/sessions create (fake) sessions, replaying the
+    first response to a repeated Idempotency-Key (409 while it is in flight).
+
+    Every request waits `latency` seconds, plus up to `latency_jitter`
+    more, and fails with `error_status` at the rate `error_rate`.
+    Point the stripe library at it with `stripe.api_base = server.url`.
+    """
+
+    def __init__(self, subscriptions=(), latency=0.0, latency_jitter=0.0, error_rate=0.0, error_status=500):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.requests = 0
+        self.errors = 0
+        self.sessions_created = 0
+        self._idempotent = {}
+        self._idempotent_lock = threading.Lock()
+        self.load(subscriptions)
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                if server._delay_or_fail(self):
+                    return
+                url = urlparse(self.path)
+                if url.path != '/v1/subscriptions':
+                    return self._reply(404, {'error': {'message': f'Unknown path {url.path}'}})
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                self._reply(200, server.list_subscriptions(params))
+
+            def do_POST(self):
+                server.requests += 1
+                # The form body is read but not checked
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                path = urlparse(self.path).path
+                key = self.headers.get('Idempotency-Key')
+                replay = server._begin_idempotent(key)
+                if replay is not None:
+                    return self._reply(*replay)
+                if server._delay_or_fail(self):
+                    return server._end_idempotent(key, None)
+                if path not in SESSION_OBJECTS:
+                    server._end_idempotent(key, None)
+                    return self._reply(404, {'error': {'message': f'Unknown path {path}'}})
+                session = server.create_session(path)
+                server._end_idempotent(key, session)
+                self._reply(200, session)
+
+            def _reply(self, status, document):
+                body = json.dumps(document).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='fake-stripe', daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address
+        return f'http://{host}:{port}'
+
+    def _delay_or_fail(self, handler):
+        """Waits out the latency; returns True if it answered with an injected error instead."""
+        delay = self.latency + (random.uniform(0, self.latency_jitter) if self.latency_jitter else 0)
+        if delay:
+            time.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            handler._reply(self.error_status, {'error': {'type': 'api_error', 'message': 'Injected failure'}})
+            return True
+        return False
+
+    def load(self, subscriptions):
+        """Replaces the subscriptions served, given as dicts with id, customer, status and created."""
+        self._subscriptions = sorted(
+            ({'object': 'subscription', **subscription} for subscription in subscriptions),
+            key=lambda subscription: (-subscription['created'], subscription['id'])
+        )
+        self._created_keys = [-subscription['created'] for subscription in self._subscriptions]
+        self._positions = {subscription['id']: n for n, subscription in enumerate(self._subscriptions)}
+
+    def _begin_idempotent(self, key):
+        """(status, document) answering a repeated Idempotency-Key, or None to go ahead."""
+        if not key:
+            return None
+        with self._idempotent_lock:
+            if key not in self._idempotent:
+                self._idempotent[key] = None
+                return None
+            session = self._idempotent[key]
+        if session is None:
+            return 409, {'error': {'type': 'idempotency_error', 'message': 'A request with this key is in progress'}}
+        return 200, session
+
+    def _end_idempotent(self, key, session):
+        # A failed request isn't replayed, as with Stripe's 5xx responses
+        if key:
+            with self._idempotent_lock:
+                if session is None:
+                    self._idempotent.pop(key, None)
+                else:
+                    self._idempotent[key] = session
+
+    def create_session(self, path):
+        self.sessions_created += 1
+        session_id = f'{SESSION_OBJECTS[path][1]}_{uuid.uuid4().hex}'
+        return {
+            'id': session_id,
+            'object': SESSION_OBJECTS[path][0],
+            'url': f'{self.url}/pay/{session_id}',
+            'expires_at': int(time.time()) + 86400,
+        }
+
+    def list_subscriptions(self, params):
+        limit = min(100, int(params.get('limit', 10)))
+        # The list is sorted by created descending, so a created range is a slice of it
+        start = 0
+        end = len(self._subscriptions)
+        if 'created[lt]' in params:
+            start = bisect.bisect_right(self._created_keys, -int(params['created[lt]']))
+        if 'created[gte]' in params:
+            end = bisect.bisect_right(self._created_keys, -int(params['created[gte]']))
+        if params.get('starting_after') in self._positions:
+            start = max(start, self._positions[params['starting_after']] + 1)
+
+        data = self._subscriptions[start:min(end, start + limit)]
+        return {
+            'object': 'list',
+            'url': '/v1/subscriptions',
+            'data': data,
+            'has_more': start + limit < end,
+        }
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class ThrowawayPostgres:
+    """
+    A Postgres database that only lives for one run, migrated to head
+    with `flask db upgrade`; `url` is its DATABASE_URL.
+
+    With `server_url`, a database with a random name is created on that
+    server and dropped afterwards. Without, initdb and pg_ctl (from PG_BIN,
+    else the PATH) set up a new cluster in a temporary directory that only
+    listens on a Unix socket there, and remove it afterwards.
+    """
+
+    def __init__(self, server_url=None):
+        self.server_url = server_url
+        self.name = f'bench_{uuid.uuid4().hex[:12]}'
+        self.url = None
+        self._directory = None
+
+    def _bin(self, program):
+        path = os.path.join(os.environ['PG_BIN'], program) if os.environ.get('PG_BIN') else shutil.which(program)
+        if not path or not os.path.exists(path):
+            raise RuntimeError(f'{program} not found: put the Postgres binaries on the PATH or in PG_BIN, '
+                               'or use an existing server')
+        return path
+
+    def _admin(self, statement):
+        """Runs one statement on the server's maintenance database, outside a transaction."""
+        import psycopg2
+        from sqlalchemy.engine import make_url
+
+        url = make_url(self.server_url).set(drivername='postgresql', database='postgres')
+        connection = psycopg2.connect(url.render_as_string(hide_password=False))
+        connection.autocommit = True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(statement)
+        finally:
+            connection.close()
+
+    def start(self):
+        from sqlalchemy.engine import make_url
+
+        if self.server_url is None:
+            if hasattr(os, 'geteuid') and os.geteuid() == 0:
+                raise RuntimeError('Postgres refuses to run as root: use an existing server instead')
+            self._directory = tempfile.mkdtemp(prefix='bench-postgres-')
+            data = os.path.join(self._directory, 'data')
+            subprocess.run([self._bin('initdb'), '-D', data, '-U', 'postgres', '--auth=trust', '-E', 'UTF8'],
+                           check=True, capture_output=True)
+            # Durability doesn't matter for a throwaway database
+            options = f"-k {self._directory} -c listen_addresses='' -c fsync=off -c synchronous_commit=off"
+            subprocess.run([self._bin('pg_ctl'), '-D', data, '-l', os.path.join(self._directory, 'log'),
+                            '-o', options, '-w', 'start'], check=True, capture_output=True)
+            self.server_url = f'postgresql://postgres@/postgres?host={self._directory}'
+
+        self._admin(f'CREATE DATABASE {self.name}')
+        self.url = make_url(self.server_url).set(database=self.name).render_as_string(hide_password=False)
+        subprocess.run(
+            [sys.executable, '-m', 'flask', '--app', 'run', 'db', 'upgrade'],
+            cwd=ROOT, check=True, capture_output=True,
+            env=dict(os.environ, DATABASE_URL=self.url, LOG_FILE='', LOG_LEVEL='WARNING'),
+        )
+        return self
+
+    def stop(self):
+        if self._directory is not None:
+            subprocess.run([self._bin('pg_ctl'), '-D', os.path.join(self._directory, 'data'), '-m', 'immediate',
+                            'stop'], capture_output=True)
+            shutil.rmtree(self._directory, ignore_errors=True)
+        elif self.url is not None:
+            self._admin(f'DROP DATABASE IF EXISTS {self.name} WITH (FORCE)')
+
+    def __enter__(self):
+        try:
+            return self.start()
+        except BaseException:
+            self.stop()
+            raise
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class LatencyProxy:
+    """
+    A TCP proxy on 127.0.0.1 that holds back everything the target sends
+    for `latency` seconds, as if it were that much further away. Used to
+    put a network round trip between the app and a local Postgres.
+
+    `target` is a (host, port) pair or the path of a Unix socket.
+    """
+
+    def __init__(self, target, latency=0.0):
+        self.target = target
+        self.latency = latency
+        self.port = None
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        self._connections = {}  # handler task -> the writers of its two sockets
+        self._thread = threading.Thread(target=self._loop.run_forever, name='latency-proxy', daemon=True)
+
+    @classmethod
+    def for_database(cls, database_url, latency=0.0):
+        """A proxy in front of the Postgres at `database_url`; see `database_url`."""
+        from sqlalchemy.engine import make_url
+
+        url = make_url(database_url)
+        socket_dir = url.query.get('host')
+        if socket_dir or not url.host:
+            target = os.path.join(socket_dir or '/var/run/postgresql', f'.s.PGSQL.{url.port or 5432}')
+        else:
+            target = (url.host, url.port or 5432)
+        proxy = cls(target, latency)
+        proxy._url = url
+        return proxy
+
+    @property
+    def database_url(self):
+        """The URL of the proxied database, for a proxy made by `for_database`."""
+        url = self._url.difference_update_query(['host']).set(host='127.0.0.1', port=self.port)
+        return url.render_as_string(hide_password=False)
+
+    async def _open_target(self):
+        if isinstance(self.target, str):
+            return await asyncio.open_unix_connection(self.target)
+        return await asyncio.open_connection(*self.target)
+
+    async def _handle(self, client_reader, client_writer):
+        try:
+            target_reader, target_writer = await self._open_target()
+        except OSError:
+            client_writer.close()
+            return
+        task = asyncio.current_task()
+        self._connections[task] = (client_writer, target_writer)
+        try:
+            await asyncio.gather(
+                self._pipe(client_reader, target_writer, 0.0),
+                self._pipe(target_reader, client_writer, self.latency),
+                return_exceptions=True,
+            )
+        finally:
+            del self._connections[task]
+
+    async def _pipe(self, reader, writer, latency):
+        pending = collections.deque()
+        arrived = asyncio.Event()
+        done = False
+
+        async def deliver():
+            # Sends the chunks in order, each `latency` after it was read
+            while pending or not done:
+                if not pending:
+                    arrived.clear()
+                    await arrived.wait()
+                    continue
+                due, data = pending[0]
+                delay = due - self._loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                pending.popleft()
+                if data:
+                    writer.write(data)
+                    await writer.drain()
+            writer.close()
+
+        sender = asyncio.ensure_future(deliver())
+        try:
+            while True:
+                data = await reader.read(65536)
+                pending.append((self._loop.time() + latency, data))
+                arrived.set()
+                if not data:
+                    break
+        finally:
+            done = True
+            arrived.set()
+            await sender
+
+    def start(self):
+        self._thread.start()
+        self._server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._handle, '127.0.0.1', 0), self._loop
+        ).result()
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def stop(self):
+        async def close():
+            self._server.close()
+            # Closing both ends lets every connection's pipes run out
+            for writers in self._connections.values():
+                for writer in writers:
+                    writer.close()
+            if self._connections:
+                await asyncio.wait(list(self._connections), timeout=5)
+
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result(5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(5)
+        self._loop.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def stripe_signature(payload, secret, timestamp=None):
+    """The Stripe-Signature header Stripe would send with a webhook `payload` (bytes)."""
+    timestamp = int(timestamp or time.time())
+    signed = f'{timestamp}.'.encode('utf-8') + payload
+    digest = hmac.new(secret.encode('utf-8'), signed, hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={digest}'
+
+
+async def read_http_response(reader):
+    """Reads one HTTP/1.1 response from an asyncio stream and returns its status code."""
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+def summarize(samples_ns, wall_seconds=None):
+    """Turns a list of per-call latencies (in nanoseconds) into a stats dict in microseconds."""
+    if not samples_ns:
+        return {'count': 0}
+
+    ordered = sorted(samples_ns)
+
+    def percentile(p):
+        index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+        return ordered[index] / 1000
+
+    total_seconds = wall_seconds if wall_seconds is not None else sum(ordered) / 1e9
+    return {
+        'count': len(ordered),
+        'mean_us': statistics.fmean(ordered) / 1000,
+        'stdev_us': statistics.pstdev(ordered) / 1000,
+        'min_us': ordered[0] / 1000,
+        'p50_us': percentile(50),
+        'p90_us': percentile(90),
+        'p95_us': percentile(95),
+        'p99_us': percentile(99),
+        'max_us': ordered[-1] / 1000,
+        'throughput_per_s': len(ordered) / total_seconds if total_seconds else None,
+    }
+
+
+def environment_info():
+    """Describes the machine a report was produced on, so reports can be compared fairly."""
+    return {
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def write_report(name, results, output=None, **extra):
+    """
+    Writes a benchmark report as JSON.
+    Goes to stdout unless an output path is given.
+    """
+    report = {
+        'benchmark': name,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'environment': environment_info(),
+        **extra,
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return report
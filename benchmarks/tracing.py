@@ -0,0 +1,104 @@
+# tracing.py
+"""
+Benchmarks the per-request cost of Sentry tracing (app/tracing.py) with
+tracing off, with the adaptive trace sampler, with the sampler recording
+every request (SENTRY_TRACES_RECORD_ALL) and with every request traced.
+
+Sentry gets a DSN and a transport that serializes envelopes and counts
+them instead of sending them, so nothing leaves the machine. Requests go
+through the Flask test client, so no server and no database are needed.
+
+Usage:
+    python -m benchmarks.tracing --requests 20000 --output tracing.json
+
+For every mode the report has the latency of '/' (a traced route) and
+'/health' (a probe), and how many transactions were sent.
+"""
+import argparse
+import os
+import time
+
+from .support import BENCH_AUDIENCE, BENCH_AUTH0_DOMAIN, summarize, write_report
+
+BENCH_DSN = 'https://public@sentry.bench.local/1'
+ROUTES = ('/', '/health')
+
+
+def counting_transport():
+    from sentry_sdk.transport import Transport
+
+    class CountingTransport(Transport):
+        transactions = 0
+
+        def capture_envelope(self, envelope):
+            envelope.serialize()
+            if any(item.type == 'transaction' for item in envelope.items):
+                CountingTransport.transactions += 1
+
+    return CountingTransport
+
+
+def build_app(mode, transport):
+    from app import create_app, tracing
+    from config import Config
+
+    class BenchConfig(Config):
+        SENTRY_DSN = BENCH_DSN
+        SENTRY_TRACING_ENABLED = mode != 'off'
+        SENTRY_TRACES_RECORD_ALL = mode == 'record_all'
+
+    app = create_app(BenchConfig)
+    if mode == 'full':
+        # What the app did before the trace sampler: trace every request
+        tracing.init_app(app, transport=transport, traces_sample_rate=1.0,
+                         traces_sampler=None, before_send_transaction=None)
+    else:
+        tracing.init_app(app, transport=transport)
+    return app
+
+
+def time_route(client, path, requests):
+    samples = []
+    wall_started = time.perf_counter()
+    for _ in range(requests):
+        started = time.perf_counter_ns()
+        client.get(path)
+        samples.append(time.perf_counter_ns() - started)
+    return summarize(samples, time.perf_counter() - wall_started)
+
+
+def run(requests):
+    os.environ.setdefault('AUTH0_DOMAIN', BENCH_AUTH0_DOMAIN)
+    os.environ.setdefault('AUTH0_AUDIENCE', BENCH_AUDIENCE)
+    # Keep the log files out of the measurement
+    os.environ.setdefault('LOG_FILE', '')
+    import sentry_sdk
+
+    results = {}
+    for mode in ('off', 'sampled', 'record_all', 'full'):
+        transport = counting_transport()
+        app = build_app(mode, transport)
+        client = app.test_client()
+        # Warm up the app and the sampler's request rate
+        for _ in range(min(1000, requests)):
+            client.get(ROUTES[0])
+        sentry_sdk.flush()
+        transport.transactions = 0
+
+        results[mode] = {path: time_route(client, path, requests) for path in ROUTES}
+        sentry_sdk.flush()
+        results[mode]['transactions_sent'] = transport.transactions
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=10000, help='requests per route and mode')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    write_report('tracing', run(args.requests), args.output, parameters={'requests': args.requests})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+# workers.py
+"""
+Compares gunicorn worker models (gunicorn.conf.py) on our endpoints.
+
+For each worker class the app is started under gunicorn with the
+checked-in config, against a fake JWKS endpoint and a fake Stripe that
+answers after `--stripe-latency` seconds, and a fixed number of client
+threads hammer one endpoint at a time for `--duration` seconds.
+
+Needs a migrated scratch database in DATABASE_URL: the benchmark inserts
+one user (auth0 id 'auth0|bench-workers') and deletes it when it is done.
+
+Usage:
+    python -m benchmarks.workers --concurrency 32 --output workers.json
+    python -m benchmarks.workers --classes sync gevent
+
+gevent is only compared when the gevent extra is installed
+(poetry install --extras gevent).
+
+Endpoints:
+    health   GET /health, no I/O
+    status   GET /api/user/status, token check and (cached) Postgres read
+    portal   POST /api/create-portal-session, Postgres plus a Stripe call
+             (session reuse is turned off, so every request calls Stripe)
+"""
+import argparse
+import http.client
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from .support import (
+    BENCH_AUDIENCE, BENCH_AUTH0_DOMAIN, ROOT, FakeJWKSServer, FakeStripeServer, SigningKey,
+    mint_token, summarize, write_report,
+)
+
+BENCH_USER = 'auth0|bench-workers'
+ENDPOINTS = {
+    'health': ('GET', '/health'),
+    'status': ('GET', '/api/user/status'),
+    'portal': ('POST', '/api/create-portal-session'),
+}
+
+
+def seed_user():
+    from sqlalchemy import text
+    from app.extensions import db
+
+    remove_user()
+    db.session.execute(text("""
+        INSERT INTO users (id, auth0_user_id, email, subscription_plan, stripe_customer_id)
+        VALUES (gen_random_uuid(), :sub, 'bench-workers@bench.local', 'premium', 'cus_benchworkers')
+    """), {'sub': BENCH_USER})
+    db.session.commit()
+
+
+def remove_user():
+    from sqlalchemy import text
+    from app.extensions import db
+
+    db.session.execute(text("DELETE FROM stripe_session_cache WHERE user_id IN "
+                            "(SELECT id FROM users WHERE auth0_user_id = :sub)"), {'sub': BENCH_USER})
+    db.session.execute(text("DELETE FROM users WHERE auth0_user_id = :sub"), {'sub': BENCH_USER})
+    db.session.commit()
+
+
+def start_gunicorn(worker_class, workers, port, env):
+    env = dict(env, GUNICORN_WORKER_CLASS=worker_class, GUNICORN_BIND=f'127.0.0.1:{port}')
+    if workers:
+        env['GUNICORN_WORKERS'] = str(workers)
+    return start_server(['gunicorn', '--config', 'gunicorn.conf.py', 'run:app'], port, env, f'gunicorn ({worker_class})')
+
+
+def start_server(command, port, env, name):
+    """Runs `python -m <command>` from the repository root and waits until /health answers."""
+    process = subprocess.Popen(
+        [sys.executable, '-m', *command],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{name} exited with {process.returncode}')
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/health')
+            if connection.getresponse().status == 200:
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'{name} did not start')
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def load(port, method, path, headers, concurrency, duration):
+    """Runs `concurrency` keep-alive clients against one endpoint for `duration` seconds."""
+    samples, statuses, lock = [], {}, threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        mine, my_statuses = [], {}
+        while time.monotonic() < stop_at:
+            started = time.perf_counter_ns()
+            try:
+                connection.request(method, path, body=b'' if method == 'POST' else None, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                status = 'error'
+            mine.append(time.perf_counter_ns() - started)
+            my_statuses[status] = my_statuses.get(status, 0) + 1
+        # Open keep-alive connections would hold up the graceful shutdown of gevent workers
+        connection.close()
+        with lock:
+            samples.extend(mine)
+            for status, count in my_statuses.items():
+                statuses[str(status)] = statuses.get(str(status), 0) + count
+
+    wall_started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = summarize(samples, time.perf_counter() - wall_started)
+    stats['status_counts'] = statuses
+    return stats
+
+
+def run(classes, workers, concurrency, duration, stripe_latency, port):
+    os.environ.setdefault('AUTH0_DOMAIN', BENCH_AUTH0_DOMAIN)
+    os.environ.setdefault('AUTH0_AUDIENCE', BENCH_AUDIENCE)
+    from app import create_app
+
+    key = SigningKey(kid='bench-workers')
+    token = mint_token(key, sub=BENCH_USER, email='bench-workers@bench.local', expires_in=86400)
+    results = {}
+
+    app = create_app()
+    with app.app_context(), FakeJWKSServer([key]) as jwks, \
+            FakeStripeServer(latency=stripe_latency) as stripe_server, \
+            tempfile.TemporaryDirectory() as metrics_dir:
+        seed_user()
+        env = dict(
+            os.environ,
+            AUTH0_JWKS_URL=jwks.url,
+            STRIPE_API_BASE=stripe_server.url,
+            STRIPE_API_KEY='sk_test_bench',
+            STRIPE_SESSION_CACHE_ENABLED='false',
+            NEXT_PUBLIC_APP_URL='https://app.bench.local',
+            LOG_FILE='',
+            LOG_LEVEL='WARNING',
+            PROMETHEUS_MULTIPROC_DIR=metrics_dir,
+        )
+        try:
+            for worker_class in classes:
+                if worker_class == 'gevent' and importlib.util.find_spec('gevent') is None:
+                    print('Skipping gevent: it is not installed (poetry install --extras gevent).',
+                          file=sys.stderr)
+                    results[worker_class] = {'skipped': 'gevent is not installed'}
+                    continue
+                process = start_gunicorn(worker_class, workers, port, env)
+                try:
+                    results[worker_class] = {}
+                    for name, (method, path) in ENDPOINTS.items():
+                        headers = {'Authorization': f'Bearer {token}'}
+                        results[worker_class][name] = load(port, method, path, headers, concurrency, duration)
+                finally:
+                    stop_server(process)
+        finally:
+            remove_user()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--classes', nargs='+', default=['sync', 'gthread', 'gevent'],
+                        help='gunicorn worker classes to compare (gevent is skipped unless installed)')
+    parser.add_argument('--workers', type=int, help='workers per run (default: as gunicorn.conf.py sizes them)')
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per endpoint')
+    parser.add_argument('--stripe-latency', type=float, default=0.2, help='seconds per Stripe call')
+    parser.add_argument('--port', type=int, default=5077)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    write_report(
+        'workers',
+        run(args.classes, args.workers, args.concurrency, args.duration, args.stripe_latency, args.port),
+        args.output,
+        parameters={'workers': args.workers, 'concurrency': args.concurrency, 'duration': args.duration,
+                    'stripe_latency': args.stripe_latency, 'cpu_count': os.cpu_count()},
+    )
+
+
+if __name__ == '__main__':
+    main()
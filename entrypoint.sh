@@ -7,7 +7,20 @@ set -e
 echo "Applying database migrations..."
 flask db upgrade
 
-# Start the Flask application using gunicorn
+# Make sure upcoming audit_logs partitions exist
+flask audit create-partitions
+
+# Workers share their Prometheus metrics through this directory, which must
+# start out empty (see app/extensions.py)
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus_multiproc}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
 echo "Starting the application..."
-gunicorn --bind 0.0.0.0:5000 --timeout 240 run:app
+if [ "$SERVER_MODE" = "asgi" ]; then
+    # Async mode: the I/O-bound routes run as coroutines (see asgi.py)
+    exec hypercorn --bind "${HYPERCORN_BIND:-0.0.0.0:5000}" --workers "${HYPERCORN_WORKERS:-1}" asgi:app
+fi
+# Start the Flask application using gunicorn (configured by gunicorn.conf.py)
+exec gunicorn --config gunicorn.conf.py run:app
 
@@ -0,0 +1,117 @@
+# gunicorn.conf.py
+# Read by gunicorn from the working directory (see entrypoint.sh).
+# Every setting can be overridden with a GUNICORN_* environment variable.
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND') or '0.0.0.0:5000'
+
+# --- Worker model ---
+# gthread: every worker serves GUNICORN_THREADS requests at once on OS threads.
+# gevent: every worker serves up to GUNICORN_WORKER_CONNECTIONS requests on
+#         greenlets; blocking I/O (Auth0, Stripe, Postgres) yields instead.
+#         Needs the gevent extra (poetry install --extras gevent).
+# sync:   one request per worker, as before.
+# Each worker has its own DB pool of DB_POOL_SIZE + DB_MAX_OVERFLOW
+# connections; requests beyond that wait for a connection. The user status
+# cache's LISTEN connection and the readiness prober's come on top, for
+# DB_POOL_SIZE + DB_MAX_OVERFLOW + 2 per worker (see config.py).
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS') or 'gthread'
+
+cpus = multiprocessing.cpu_count()
+if worker_class == 'sync':
+    default_workers = cpus * 2 + 1
+else:
+    # Concurrency comes from threads or greenlets; one worker per CPU for Python code
+    default_workers = cpus
+workers = int(os.environ.get('GUNICORN_WORKERS') or default_workers)
+# gunicorn turns sync workers with more than one thread into gthread workers
+threads = int(os.environ.get('GUNICORN_THREADS') or (8 if worker_class == 'gthread' else 1))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS') or 100)
+
+# --- Lifecycle ---
+# Load the app once in the master, so workers share its memory copy-on-write
+# and start fast. post_fork below drops what mustn't be shared.
+preload_app = (os.environ.get('GUNICORN_PRELOAD') or 'true').lower() == 'true'
+timeout = int(os.environ.get('GUNICORN_TIMEOUT') or 240)
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT') or 30)
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE') or 5)
+# Restart each worker after this many requests (0 disables), staggered by the
+# jitter so they don't all restart at once. Bounds slow memory growth.
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS') or 10000)
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER') or max_requests // 10)
+
+if worker_class == 'gevent':
+    # Patch before the preloaded app imports socket, ssl and threading
+    try:
+        from gevent import monkey
+    except ImportError:
+        raise RuntimeError('GUNICORN_WORKER_CLASS=gevent needs the gevent extra: '
+                           'poetry install --extras gevent') from None
+    monkey.patch_all()
+
+    # stripe puts platform.uname() in its user agent, and the processor
+    # field runs `uname -p` on first use. gevent's subprocess forks the
+    # whole worker to run it, and until the child execs, the requests it
+    # inherited go on using the worker's Postgres sockets. Look it up here,
+    # once, so every worker inherits the answer.
+    import platform
+    platform.uname().processor
+
+    import psycopg2
+    from psycopg2 import extensions
+
+    def _gevent_wait_callback(connection, timeout=None):
+        """Lets psycopg2 wait for Postgres on the gevent hub instead of blocking the worker."""
+        from gevent.socket import wait_read, wait_write
+        while True:
+            state = connection.poll()
+            if state == extensions.POLL_OK:
+                return
+            if state == extensions.POLL_READ:
+                wait_read(connection.fileno(), timeout=timeout)
+            elif state == extensions.POLL_WRITE:
+                wait_write(connection.fileno(), timeout=timeout)
+            else:
+                raise psycopg2.OperationalError(f'Bad result from poll: {state}')
+
+    extensions.set_wait_callback(_gevent_wait_callback)
+
+
+def when_ready(server):
+    """
+    Runs in the master before the first workers start. With preload_app,
+    import what the app imports on first use (app/startup.py) here, so
+    every worker inherits it instead of importing it on its first requests.
+    """
+    if server.cfg.preload_app:
+        from app import startup
+        startup.import_deferred()
+
+
+def post_fork(server, worker):
+    """
+    Runs in every new worker. With preload_app the worker inherited the
+    master's app: DB connections opened there would be shared by both
+    processes, and Sentry and the metrics still belong to the master.
+    """
+    if not server.cfg.preload_app:
+        return
+    app = worker.app.wsgi()
+
+    from app import database, tracing
+    database.after_fork(app)
+    tracing.init_app(app)
+
+
+def post_worker_init(worker):
+    # Without preload_app every worker loaded the app itself; import the rest in the background
+    if not worker.cfg.preload_app:
+        from app import startup
+        startup.warm_up()
+
+
+def child_exit(server, worker):
+    # Drop the dead worker's live gauges from the multiprocess metrics
+    from prometheus_flask_exporter.multiprocess import GunicornInternalPrometheusMetrics
+    GunicornInternalPrometheusMetrics.mark_process_dead_on_child_exit(worker.pid)
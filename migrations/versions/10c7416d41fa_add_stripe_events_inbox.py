@@ -0,0 +1,45 @@
+"""add stripe_events inbox
+
+Revision ID: 10c7416d41fa
+Revises: 4b5c8234ada9
+Create Date: 2026-10-17 12:41:08.902153
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '10c7416d41fa'
+down_revision = '4b5c8234ada9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stripe_events',
+    sa.Column('id', sa.String(length=255), nullable=False),
+    sa.Column('type', sa.String(length=255), nullable=False),
+    sa.Column('customer_key', sa.String(length=255), nullable=False),
+    sa.Column('stripe_created', sa.BigInteger(), nullable=False),
+    sa.Column('payload', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.Column('status', sa.String(length=20), server_default='pending', nullable=False),
+    sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('received_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('next_attempt_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('processed_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    # Partial indexes: only pending events are ever looked up by the workers
+    op.create_index('ix_stripe_events_pending', 'stripe_events', ['stripe_created', 'id'],
+                    postgresql_where=sa.text("status = 'pending'"))
+    op.create_index('ix_stripe_events_pending_customer', 'stripe_events', ['customer_key', 'stripe_created', 'id'],
+                    postgresql_where=sa.text("status = 'pending'"))
+
+
+def downgrade():
+    op.drop_index('ix_stripe_events_pending_customer', table_name='stripe_events')
+    op.drop_index('ix_stripe_events_pending', table_name='stripe_events')
+    op.drop_table('stripe_events')
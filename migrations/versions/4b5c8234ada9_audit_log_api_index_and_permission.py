@@ -0,0 +1,49 @@
+"""audit log api index and permission
+
+Revision ID: 4b5c8234ada9
+Revises: 8cb2a65a8e40
+Create Date: 2026-10-17 11:03:27.540918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b5c8234ada9'
+down_revision = '8cb2a65a8e40'
+branch_labels = None
+depends_on = None
+
+
+permissions_table = sa.table('permissions',
+    sa.column('name', sa.String),
+    sa.column('description', sa.String)
+)
+
+
+def upgrade():
+    # Serves the audit log API, which pages by (created_at, id) cursors
+    op.create_index('ix_audit_logs_created_at_id', 'audit_logs', ['created_at', 'id'])
+
+    # The audit log API requires this permission; admins get it by default
+    op.bulk_insert(permissions_table,
+        [
+            {'name': 'read:audit_logs', 'description': 'Read and export the audit log.'}
+        ]
+    )
+    op.execute("""
+        INSERT INTO role_permissions (role_id, permission_id)
+        SELECT roles.id, permissions.id
+        FROM roles, permissions
+        WHERE roles.name = 'admin' AND permissions.name = 'read:audit_logs'
+    """)
+
+
+def downgrade():
+    op.execute("""
+        DELETE FROM role_permissions
+        WHERE permission_id IN (SELECT id FROM permissions WHERE name = 'read:audit_logs')
+    """)
+    op.execute("DELETE FROM permissions WHERE name = 'read:audit_logs'")
+    op.drop_index('ix_audit_logs_created_at_id', table_name='audit_logs')
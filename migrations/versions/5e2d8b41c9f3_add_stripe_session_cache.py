@@ -0,0 +1,34 @@
+"""add stripe_session_cache
+
+Revision ID: 5e2d8b41c9f3
+Revises: c3f1a9d27b64
+Create Date: 2026-10-17 15:22:47.114093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e2d8b41c9f3'
+down_revision = 'c3f1a9d27b64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stripe_session_cache',
+    sa.Column('user_id', sa.UUID(), nullable=False),
+    sa.Column('operation', sa.String(length=20), nullable=False),
+    sa.Column('fingerprint', sa.String(length=64), nullable=False),
+    sa.Column('session_id', sa.String(length=255), nullable=False),
+    sa.Column('url', sa.Text(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'operation'),
+    prefixes=['UNLOGGED']
+    )
+
+
+def downgrade():
+    op.drop_table('stripe_session_cache')
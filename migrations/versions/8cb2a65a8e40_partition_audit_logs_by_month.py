@@ -0,0 +1,96 @@
+"""partition audit_logs by month
+
+Revision ID: 8cb2a65a8e40
+Revises: 9a9dbc7292b8
+Create Date: 2026-10-17 09:12:44.318207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '8cb2a65a8e40'
+down_revision = '9a9dbc7292b8'
+branch_labels = None
+depends_on = None
+
+
+# Monthly partitions are named audit_logs_pYYYY_MM (see app/audit_partitions.py).
+# This creates one for every month that has data, plus the next few months.
+CREATE_PARTITIONS = """
+DO $$
+DECLARE
+    first_month timestamp := date_trunc('month', coalesce((SELECT min(created_at) FROM audit_logs_legacy), now()));
+    last_month timestamp := greatest(
+        date_trunc('month', (SELECT max(created_at) FROM audit_logs_legacy)),
+        date_trunc('month', now()) + interval '3 months'
+    );
+    part_month timestamp := first_month;
+BEGIN
+    WHILE part_month <= last_month LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF audit_logs FOR VALUES FROM (%L) TO (%L)',
+            'audit_logs_p' || to_char(part_month, 'YYYY_MM'), part_month, part_month + interval '1 month'
+        );
+        part_month := part_month + interval '1 month';
+    END LOOP;
+END $$;
+"""
+
+
+def upgrade():
+    # 1. Move the existing table out of the way
+    op.execute("ALTER TABLE audit_logs RENAME TO audit_logs_legacy")
+    op.execute("ALTER TABLE audit_logs_legacy RENAME CONSTRAINT audit_logs_pkey TO audit_logs_legacy_pkey")
+
+    # 2. Create the partitioned table. The partition key has to be part of the
+    # primary key, and created_at can no longer be NULL.
+    op.execute("""
+        CREATE TABLE audit_logs (
+            id UUID NOT NULL,
+            user_id UUID REFERENCES users (id),
+            action VARCHAR(255) NOT NULL,
+            details JSONB,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+            CONSTRAINT audit_logs_pkey PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+
+    # Created on the parent, so every partition gets its own copy
+    op.create_index('ix_audit_logs_user_id_created_at', 'audit_logs', ['user_id', 'created_at'])
+
+    # 3. Create the monthly partitions and copy the rows across
+    op.execute(CREATE_PARTITIONS)
+    op.execute("""
+        INSERT INTO audit_logs (id, user_id, action, details, created_at)
+        SELECT id, user_id, action, details, coalesce(created_at, now())
+        FROM audit_logs_legacy
+    """)
+
+    op.drop_table('audit_logs_legacy')
+
+
+def downgrade():
+    op.execute("ALTER TABLE audit_logs RENAME TO audit_logs_partitioned")
+    op.execute("ALTER TABLE audit_logs_partitioned RENAME CONSTRAINT audit_logs_pkey TO audit_logs_partitioned_pkey")
+    op.execute("ALTER INDEX ix_audit_logs_user_id_created_at RENAME TO ix_audit_logs_partitioned_user_id_created_at")
+
+    op.create_table('audit_logs',
+    sa.Column('id', sa.UUID(), nullable=False),
+    sa.Column('user_id', sa.UUID(), nullable=True),
+    sa.Column('action', sa.String(length=255), nullable=False),
+    sa.Column('details', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute("""
+        INSERT INTO audit_logs (id, user_id, action, details, created_at)
+        SELECT id, user_id, action, details, created_at
+        FROM audit_logs_partitioned
+    """)
+
+    # Dropping the parent drops every attached partition with it
+    op.execute("DROP TABLE audit_logs_partitioned")
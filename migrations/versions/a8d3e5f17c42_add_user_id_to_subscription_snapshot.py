@@ -0,0 +1,26 @@
+"""add user_id to stripe_subscription_snapshot
+
+Revision ID: a8d3e5f17c42
+Revises: f4a7c2e91d38
+Create Date: 2026-10-17 18:02:41.553210
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a8d3e5f17c42'
+down_revision = 'f4a7c2e91d38'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('stripe_subscription_snapshot', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('user_id', sa.String(length=255), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('stripe_subscription_snapshot', schema=None) as batch_op:
+        batch_op.drop_column('user_id')
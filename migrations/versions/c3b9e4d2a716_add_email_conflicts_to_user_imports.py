@@ -0,0 +1,26 @@
+"""add email_conflicts to user_imports
+
+Revision ID: c3b9e4d2a716
+Revises: a8d3e5f17c42
+Create Date: 2026-10-17 21:14:09.318842
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3b9e4d2a716'
+down_revision = 'a8d3e5f17c42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user_imports', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('email_conflicts', sa.BigInteger(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('user_imports', schema=None) as batch_op:
+        batch_op.drop_column('email_conflicts')
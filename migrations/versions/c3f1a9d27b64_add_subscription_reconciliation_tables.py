@@ -0,0 +1,42 @@
+"""add subscription reconciliation tables
+
+Revision ID: c3f1a9d27b64
+Revises: 10c7416d41fa
+Create Date: 2026-10-17 14:05:31.527640
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f1a9d27b64'
+down_revision = '10c7416d41fa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stripe_subscription_snapshot',
+    sa.Column('id', sa.String(length=255), nullable=False),
+    sa.Column('customer_id', sa.String(length=255), nullable=False),
+    sa.Column('status', sa.String(length=50), nullable=False),
+    sa.Column('created', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_stripe_subscription_snapshot_customer_id', 'stripe_subscription_snapshot', ['customer_id'])
+    op.create_table('subscription_sync_windows',
+    sa.Column('created_from', sa.BigInteger(), nullable=False),
+    sa.Column('created_to', sa.BigInteger(), nullable=False),
+    sa.Column('last_subscription_id', sa.String(length=255), nullable=True),
+    sa.Column('fetched', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('completed', sa.Boolean(), server_default=sa.false(), nullable=False),
+    sa.Column('run_started_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('created_from')
+    )
+
+
+def downgrade():
+    op.drop_table('subscription_sync_windows')
+    op.drop_index('ix_stripe_subscription_snapshot_customer_id', table_name='stripe_subscription_snapshot')
+    op.drop_table('stripe_subscription_snapshot')
@@ -0,0 +1,36 @@
+"""add user_imports
+
+Revision ID: f4a7c2e91d38
+Revises: 5e2d8b41c9f3
+Create Date: 2026-10-17 16:48:12.301877
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4a7c2e91d38'
+down_revision = '5e2d8b41c9f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('user_imports',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('source', sa.Text(), nullable=False),
+    sa.Column('position', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('lines', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('created', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('skipped', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('invalid', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('started_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('user_imports')
@@ -0,0 +1,110 @@
+# conftest.py
+import os
+import uuid
+
+import pytest
+from sqlalchemy import text
+
+from benchmarks.support import (
+    BENCH_AUDIENCE, BENCH_AUTH0_DOMAIN, FakeJWKSServer, FakeStripeServer, SigningKey, ThrowawayPostgres, mint_token
+)
+from config import Config
+
+# The tests that need a database create one on the server at TEST_POSTGRES_URL
+# (e.g. postgresql://postgres@localhost/postgres), else in a throwaway cluster
+# set up with initdb; they are skipped when neither is possible.
+TEST_POSTGRES_URL = os.environ.get('TEST_POSTGRES_URL') or None
+
+STRIPE_WEBHOOK_SECRET = 'whsec_test'
+
+
+@pytest.fixture(scope='session')
+def database_url():
+    postgres = ThrowawayPostgres(server_url=TEST_POSTGRES_URL)
+    try:
+        postgres.start()
+    except Exception as e:
+        postgres.stop()
+        pytest.skip(f'No Postgres for the database tests: {e}')
+    yield postgres.url
+    postgres.stop()
+
+
+@pytest.fixture(scope='session')
+def signing_key():
+    return SigningKey(kid='test-key')
+
+
+@pytest.fixture(scope='session')
+def jwks_server(signing_key):
+    with FakeJWKSServer([signing_key]) as server:
+        yield server
+
+
+@pytest.fixture(scope='session')
+def stripe_server():
+    with FakeStripeServer() as server:
+        yield server
+
+
+@pytest.fixture(scope='session')
+def make_app(database_url, jwks_server, stripe_server):
+    """Returns a factory for testing apps on the test database, with Auth0 and Stripe stand-ins."""
+    from app import create_app
+
+    class TestConfig(Config):
+        TESTING = True
+        SQLALCHEMY_DATABASE_URI = database_url
+        AUTH0_DOMAIN = BENCH_AUTH0_DOMAIN
+        AUTH0_AUDIENCE = BENCH_AUDIENCE
+        AUTH0_JWKS_URL = jwks_server.url
+        STRIPE_API_KEY = 'sk_test_123'
+        STRIPE_API_BASE = stripe_server.url
+        LOG_FILE = None
+        LOG_LEVEL = 'WARNING'
+        SENTRY_DSN = None
+
+    # The Stripe routes read these from the environment on every request
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv('STRIPE_PRICE_ID', 'price_test')
+        monkeypatch.setenv('STRIPE_WEBHOOK_SECRET', STRIPE_WEBHOOK_SECRET)
+        monkeypatch.setenv('NEXT_PUBLIC_APP_URL', 'https://app.test')
+        yield lambda: create_app(TestConfig)
+
+
+@pytest.fixture(scope='session')
+def app(make_app):
+    from app.audit import audit
+
+    yield make_app()
+    # Write the queued audit events while the test database is still there
+    audit.shutdown()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def new_user(signing_key):
+    """Returns a function giving (auth0_user_id, request headers) for a user that isn't onboarded yet."""
+    def make():
+        auth0_user_id = f'auth0|test-{uuid.uuid4().hex[:12]}'
+        token = mint_token(signing_key, sub=auth0_user_id)
+        return auth0_user_id, {'Authorization': f'Bearer {token}'}
+    return make
+
+
+@pytest.fixture
+def run_sql(app):
+    """Returns a function running one statement on the test database and committing it."""
+    from app import db
+
+    def run(statement, **parameters):
+        with app.app_context():
+            result = db.session.execute(text(statement), parameters)
+            rows = result.fetchall() if result.returns_rows else None
+            db.session.commit()
+        return rows
+    return run
@@ -0,0 +1,56 @@
+# test_audit.py
+import time
+
+import pytest
+
+from app.audit import audit
+
+
+@pytest.fixture
+def admin(client, new_user, run_sql):
+    auth0_user_id, headers = new_user()
+    assert client.post('/api/user/onboard', headers=headers).status_code == 201
+    run_sql("""
+        INSERT INTO user_roles (user_id, role_id)
+        SELECT users.id, roles.id FROM users, roles
+        WHERE users.auth0_user_id = :sub AND roles.name = 'admin'
+    """, sub=auth0_user_id)
+    return auth0_user_id, headers
+
+
+def exports_by(run_sql, auth0_user_id):
+    return run_sql("""
+        SELECT user_id, details->'filters' FROM audit_logs
+        WHERE action = 'audit_logs.exported' AND details->>'auth0_user_id' = :sub
+    """, sub=auth0_user_id)
+
+
+def export(client, headers, **filters):
+    response = client.get('/api/audit-logs/export', headers=headers, query_string=filters)
+    assert response.status_code == 200
+    response.get_data()
+
+
+def test_queued_events_are_written_within_the_flush_interval(app, client, admin, run_sql):
+    auth0_user_id, headers = admin
+    export(client, headers, action='user.created')
+
+    deadline = time.monotonic() + app.config['AUDIT_FLUSH_INTERVAL'] + 5
+    while not exports_by(run_sql, auth0_user_id) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert [tuple(row) for row in exports_by(run_sql, auth0_user_id)] == [(None, {'action': 'user.created'})]
+
+
+def test_queued_events_are_written_on_shutdown(app, client, admin, run_sql, monkeypatch):
+    auth0_user_id, headers = admin
+    # Only a batch this size, or shutdown, writes the queue now
+    monkeypatch.setattr(audit, 'flush_interval', 3600)
+    monkeypatch.setattr(audit, 'batch_size', 1000)
+    audit.shutdown()
+
+    for _ in range(3):
+        export(client, headers)
+    assert exports_by(run_sql, auth0_user_id) == []
+
+    audit.shutdown()
+    assert len(exports_by(run_sql, auth0_user_id)) == 3
@@ -0,0 +1,28 @@
+# test_jwks.py
+import asyncio
+
+from app.jwks import JWKSKeyStore
+
+
+def test_async_fetch_lock_belongs_to_the_running_loop():
+    store = JWKSKeyStore()
+    assert store._async_fetch_lock is None
+
+    async def hold(lock):
+        async with lock:
+            pass
+
+    async def fetch_under_contention():
+        lock = store._async_lock()
+        assert store._async_lock() is lock
+        async with lock:
+            # Waiting on the lock ties it to this loop
+            waiter = asyncio.ensure_future(hold(lock))
+            await asyncio.sleep(0)
+        await waiter
+        return lock
+
+    first = asyncio.run(fetch_under_contention())
+    # A lock tied to the first loop would raise on this one
+    second = asyncio.run(fetch_under_contention())
+    assert first is not second
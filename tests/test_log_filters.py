@@ -0,0 +1,113 @@
+# test_log_filters.py
+import logging
+import time
+
+from flask import Flask
+
+from app.log_filters import LogLimiter
+from app.logging_setup import LoggingPipeline
+
+
+def make_record(msg='Something happened.', level=logging.INFO):
+    return logging.LogRecord('tests', level, __file__, 1, msg, (), None)
+
+
+def test_rate_limits_each_message_to_its_burst():
+    emitted = []
+    limiter = LogLimiter(emitted.append, default_rate=0.0, default_burst=3)
+    kept = [limiter.filter(make_record()) for _ in range(5)]
+    assert kept == [True, True, True, False, False]
+    # Another message has its own bucket
+    assert limiter.filter(make_record('Something else happened.'))
+    assert emitted == []
+
+
+def test_refills_at_its_rate():
+    limiter = LogLimiter(lambda record: None, default_rate=1e6, default_burst=1)
+    assert all(limiter.filter(make_record()) for _ in range(3))
+
+
+def test_errors_always_pass():
+    limiter = LogLimiter(lambda record: None, default_rate=0.0, default_burst=0)
+    assert limiter.filter(make_record(level=logging.ERROR))
+    assert not limiter.filter(make_record(level=logging.WARNING))
+
+
+def test_reports_suppressed_records_once():
+    emitted = []
+    limiter = LogLimiter(emitted.append, default_rate=0.0, default_burst=1)
+    for _ in range(4):
+        limiter.filter(make_record())
+    limiter.report()
+    assert len(emitted) == 1
+    aggregate = emitted[0]
+    assert aggregate.getMessage() == 'Suppressed 3 similar log records.'
+    assert aggregate.suppressed == 3
+    assert aggregate.suppressed_message == 'Something happened.'
+    assert aggregate.levelno == logging.INFO
+
+    limiter.report()
+    assert len(emitted) == 1
+
+
+def test_level_rules_apply_to_every_endpoint():
+    limiter = LogLimiter(lambda record: None, rules={'*:INFO': {'sample': 0.0}})
+    assert not limiter.filter(make_record())
+    assert limiter.filter(make_record(level=logging.WARNING))
+
+
+def test_endpoint_rules_apply_within_requests():
+    app = Flask(__name__)
+    app.add_url_rule('/ping', 'ping', lambda: 'pong')
+    emitted = []
+    limiter = LogLimiter(emitted.append, rules={'ping:INFO': {'rate': 0.0, 'burst': 1}})
+
+    with app.test_request_context('/ping'):
+        assert limiter.filter(make_record())
+        assert not limiter.filter(make_record())
+    # The same message outside the request falls back to the default rule
+    assert limiter.filter(make_record())
+
+    limiter.report()
+    assert [aggregate.endpoint for aggregate in emitted] == ['ping']
+
+
+def test_evicted_keys_report_what_they_suppressed():
+    emitted = []
+    limiter = LogLimiter(emitted.append, default_rate=0.0, default_burst=1, max_keys=1)
+    limiter.filter(make_record('First.'))
+    limiter.filter(make_record('First.'))
+    limiter.filter(make_record('Second.'))
+    assert [aggregate.suppressed_message for aggregate in emitted] == ['First.']
+
+
+def test_reports_when_due_without_new_records():
+    emitted = []
+    limiter = LogLimiter(emitted.append, default_rate=0.0, default_burst=1, report_interval=3600)
+    for _ in range(3):
+        limiter.filter(make_record())
+    assert not limiter.report_due()
+
+    limiter.report_interval = 0.0
+    limiter._next_report = time.monotonic()
+    assert limiter.report_due()
+    assert [aggregate.suppressed for aggregate in emitted] == [2]
+
+
+def test_pipeline_reports_suppressed_records_while_idle(capsys, monkeypatch):
+    monkeypatch.setattr('app.logging_setup._Listener.idle_interval', 0.05)
+    pipeline = LoggingPipeline()
+    pipeline.configure(limits={'default_rate': 0.0, 'default_burst': 1, 'report_interval': 0.2})
+    logger = logging.getLogger('tests.idle')
+    try:
+        for _ in range(3):
+            logger.info("Something happened.")
+        # Nothing else is logged: the listener reports on its own
+        deadline = time.monotonic() + 5
+        output = ''
+        while 'Suppressed 2 similar log records.' not in output and time.monotonic() < deadline:
+            time.sleep(0.05)
+            output += capsys.readouterr().err
+    finally:
+        pipeline.shutdown()
+    assert 'Suppressed 2 similar log records.' in output
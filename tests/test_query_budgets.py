@@ -0,0 +1,133 @@
+# test_query_budgets.py
+import json
+import os
+import time
+import uuid
+
+import pytest
+
+from app import async_routes, request_metrics, routes
+from benchmarks.support import stripe_signature
+
+# Routes that don't touch the database (or, for /metrics, not the app's) and declare no budget
+UNBUDGETED = {'main.me', 'main.trigger_error', 'main.prometheus_metrics'}
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    """Records (endpoint, SQL statements run) for every request as it ends."""
+    seen = []
+    end_request = request_metrics.end_request
+
+    def record(endpoint):
+        phases = request_metrics._current.get()
+        if phases is not None:
+            seen.append((endpoint, phases.queries))
+        end_request(endpoint)
+
+    monkeypatch.setattr(request_metrics, 'end_request', record)
+    return seen
+
+
+def assert_within_budgets(app, queries):
+    # Under app.testing a route over its budget already fails the request with
+    # QueryBudgetExceeded; this also checks the requests were counted at all
+    assert queries
+    for endpoint, count in queries:
+        budget = app.view_functions[endpoint].query_budget
+        assert count <= budget, f'{endpoint} ran {count} SQL statements, over its budget of {budget}'
+
+
+@pytest.fixture
+def onboarded_user(client, new_user):
+    auth0_user_id, headers = new_user()
+    assert client.post('/api/user/onboard', headers=headers).status_code == 201
+    return auth0_user_id, headers
+
+
+def test_every_database_route_declares_a_budget(app):
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint.startswith('main.') and rule.endpoint not in UNBUDGETED:
+            assert hasattr(app.view_functions[rule.endpoint], 'query_budget'), rule.endpoint
+
+
+def test_async_routes_declare_the_same_budgets():
+    for name in ('health_check', 'readiness_check', 'sync_user', 'user_status',
+                 'create_checkout_session', 'create_portal_session'):
+        assert getattr(async_routes, name).query_budget == getattr(routes, name).query_budget, name
+
+
+def test_query_budgets_are_strict_when_testing(app):
+    assert request_metrics.query_budget_strict(app)
+
+
+def test_health_probes(app, client, queries):
+    assert client.get('/health').status_code == 200
+    assert client.get('/health/live').status_code == 200
+    assert client.get('/health/ready').status_code in (200, 503)
+    assert_within_budgets(app, queries)
+
+
+def test_onboard(app, client, new_user, queries):
+    _, headers = new_user()
+    assert client.post('/api/user/onboard', headers=headers).status_code == 201
+    assert client.post('/api/user/onboard', headers=headers).status_code == 200
+    assert_within_budgets(app, queries)
+
+
+def test_user_status(app, client, new_user, queries):
+    _, headers = new_user()
+    assert client.get('/api/user/status', headers=headers).status_code == 404
+    assert client.post('/api/user/onboard', headers=headers).status_code == 201
+    assert client.get('/api/user/status', headers=headers).status_code == 200
+    assert client.get('/api/user/status', headers=headers).status_code == 200
+    assert_within_budgets(app, queries)
+
+
+def test_checkout_session(app, client, onboarded_user, queries):
+    _, headers = onboarded_user
+    first = client.post('/api/create-checkout-session', headers=headers)
+    assert first.status_code == 200
+    # The open session is reused rather than created again
+    again = client.post('/api/create-checkout-session', headers=headers)
+    assert again.get_json() == first.get_json()
+    assert_within_budgets(app, queries)
+
+
+def test_portal_session(app, client, onboarded_user, run_sql, queries):
+    auth0_user_id, headers = onboarded_user
+    assert client.post('/api/create-portal-session', headers=headers).status_code == 404
+    run_sql("UPDATE users SET stripe_customer_id = :customer WHERE auth0_user_id = :sub",
+            customer=f'cus_{uuid.uuid4().hex[:14]}', sub=auth0_user_id)
+    assert client.post('/api/create-portal-session', headers=headers).status_code == 200
+    assert client.post('/api/create-portal-session', headers=headers).status_code == 200
+    assert_within_budgets(app, queries)
+
+
+def test_stripe_webhook(app, client, queries):
+    payload = json.dumps({
+        'id': f'evt_{uuid.uuid4().hex[:24]}',
+        'object': 'event',
+        'type': 'customer.subscription.updated',
+        'created': int(time.time()),
+        'data': {'object': {'id': f'sub_{uuid.uuid4().hex[:14]}', 'object': 'subscription',
+                            'customer': f'cus_{uuid.uuid4().hex[:14]}', 'status': 'active'}},
+    }).encode('utf-8')
+    signature = stripe_signature(payload, os.environ['STRIPE_WEBHOOK_SECRET'])
+    response = client.post('/stripe-webhook', data=payload, headers={'Stripe-Signature': signature})
+    assert response.status_code == 200
+    assert_within_budgets(app, queries)
+
+
+def test_audit_logs(app, client, onboarded_user, run_sql, queries):
+    auth0_user_id, headers = onboarded_user
+    run_sql("""
+        INSERT INTO user_roles (user_id, role_id)
+        SELECT users.id, roles.id FROM users, roles
+        WHERE users.auth0_user_id = :sub AND roles.name = 'admin'
+    """, sub=auth0_user_id)
+    assert client.get('/api/audit-logs', headers=headers).status_code == 200
+    export = client.get('/api/audit-logs/export', headers=headers)
+    assert export.status_code == 200
+    export.get_data()
+    assert_within_budgets(app, queries)
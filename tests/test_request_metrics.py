@@ -0,0 +1,76 @@
+# test_request_metrics.py
+import logging
+
+import pytest
+from flask import Blueprint, request
+
+from app import db, request_metrics
+from app.models import User
+from app.request_metrics import MAX_LOGGED_SQL, QueryBudgetExceeded, normalize_sql, parameters_shape
+
+nplus1 = Blueprint('nplus1', __name__)
+
+
+@nplus1.route('/test/roles')
+@request_metrics.query_budget(2)
+def roles_of_users():
+    users = db.session.query(User).filter(User.auth0_user_id.in_(request.args.getlist('user'))).all()
+    # Lazy-loads User.roles once per user
+    return {'roles': [len(user.roles) for user in users]}
+
+
+def test_normalize_sql_collapses_whitespace_and_literals():
+    statement = "SELECT *\n    FROM users\n   WHERE id = 42 AND email = 'it''s@example.com'"
+    assert normalize_sql(statement) == 'SELECT * FROM users WHERE id = ? AND email = ?'
+
+
+def test_normalize_sql_collapses_lists_of_parameters():
+    two = normalize_sql('SELECT * FROM roles WHERE roles.id IN (%(id_1)s, %(id_2)s)')
+    three = normalize_sql('SELECT * FROM roles WHERE roles.id IN (%(id_1)s, %(id_2)s, %(id_3)s)')
+    assert two == three == 'SELECT * FROM roles WHERE roles.id IN (...)'
+    assert normalize_sql('SELECT $1 WHERE id IN ($1, $2)') == 'SELECT $1 WHERE id IN (...)'
+
+
+def test_normalize_sql_keeps_names_and_placeholders():
+    statement = 'SELECT users2.id FROM users2 WHERE id = %(id_1)s AND email = $2'
+    assert normalize_sql(statement) == statement
+
+
+def test_normalize_sql_truncates_long_statements():
+    statement = normalize_sql('SELECT ' + ', '.join(f'column_{i}' for i in range(1000)))
+    assert len(statement) == MAX_LOGGED_SQL + 3
+    assert statement.endswith('...')
+
+
+def test_parameters_shape_has_types_not_values():
+    shape = parameters_shape({'id': 1, 'email': 'secret@example.com', 'deleted_at': None})
+    assert shape == {'id': 'int', 'email': 'str', 'deleted_at': 'NoneType'}
+    assert parameters_shape((1, 'secret', 2.5)) == ['int', 'str', 'float']
+
+
+def test_parameters_shape_of_executemany():
+    assert parameters_shape([{'id': 1}, {'id': 2}], executemany=True) == {'rows': 2, 'row': {'id': 'int'}}
+    assert parameters_shape([], executemany=True) == {'rows': 0, 'row': None}
+
+
+def test_nplus1_fails_its_query_budget_and_is_logged(make_app, new_user, caplog):
+    app = make_app()
+    app.register_blueprint(nplus1)
+    client = app.test_client()
+
+    users = []
+    for _ in range(request_metrics.settings['repeated_query_threshold'] + 1):
+        auth0_user_id, headers = new_user()
+        assert client.post('/api/user/onboard', headers=headers).status_code == 201
+        users.append(auth0_user_id)
+
+    with caplog.at_level(logging.WARNING, logger=request_metrics.logger.name):
+        with pytest.raises(QueryBudgetExceeded, match='over its budget of 2'):
+            client.get('/test/roles', query_string={'user': users})
+
+    repeated = [record for record in caplog.records
+                if record.getMessage() == "Repeated SQL statement, probably an N+1 query."]
+    assert len(repeated) == 1
+    assert repeated[0].endpoint == 'nplus1.roles_of_users'
+    assert repeated[0].executions == len(users)
+    assert 'user_roles' in repeated[0].sql
@@ -0,0 +1,97 @@
+# test_token_cache.py
+import importlib
+import time
+
+import pytest
+from jose import jwt
+
+from app.token_cache import VerifiedTokenCache
+
+# app exports the token_cache singleton under the module's name
+token_cache_module = importlib.import_module('app.token_cache')
+
+
+class FakeKeyStore:
+    def __init__(self, kids):
+        self.kids = set(kids)
+
+    def has_key(self, kid):
+        return kid in self.kids
+
+
+@pytest.fixture
+def keys(monkeypatch):
+    keys = FakeKeyStore({'key-1'})
+    monkeypatch.setattr(token_cache_module, 'key_store', keys)
+    return keys
+
+
+def make_token(kid='key-1', **claims):
+    payload = dict({'sub': 'auth0|user', 'exp': int(time.time()) + 3600}, **claims)
+    return jwt.encode(payload, 'secret', algorithm='HS256', headers={'kid': kid}), payload
+
+
+def test_returns_a_copy_of_the_cached_payload(keys):
+    cache = VerifiedTokenCache()
+    token, payload = make_token(permissions=['read:audit_logs'])
+    assert cache.get(token) is None
+    cache.put(token, payload)
+
+    cached = cache.get(token)
+    assert cached == payload
+    cached['permissions'].append('write:everything')
+    assert cache.get(token) == payload
+
+
+def test_keeps_no_raw_tokens(keys):
+    cache = VerifiedTokenCache()
+    token, payload = make_token()
+    cache.put(token, payload)
+    assert all(isinstance(digest, bytes) and token.encode('utf-8') != digest for digest in cache._entries)
+
+
+def test_expires_with_the_token(keys):
+    cache = VerifiedTokenCache()
+    token, payload = make_token(exp=int(time.time()) - 1)
+    cache.put(token, payload)
+    assert cache.get(token) is None
+    assert len(cache) == 0
+
+
+def test_expires_after_max_ttl(keys):
+    cache = VerifiedTokenCache()
+    cache.max_ttl = 0
+    token, payload = make_token()
+    cache.put(token, payload)
+    assert cache.get(token) is None
+
+
+def test_drops_tokens_of_removed_signing_keys(keys):
+    cache = VerifiedTokenCache()
+    token, payload = make_token()
+    cache.put(token, payload)
+    keys.kids.clear()
+    assert cache.get(token) is None
+    assert len(cache) == 0
+
+
+def test_evicts_the_least_recently_used(keys):
+    cache = VerifiedTokenCache()
+    cache.max_size = 2
+    (a, a_payload), (b, b_payload), (c, c_payload) = (make_token(sub=sub) for sub in 'abc')
+    cache.put(a, a_payload)
+    cache.put(b, b_payload)
+    cache.get(a)
+    cache.put(c, c_payload)
+    assert cache.get(b) is None
+    assert cache.get(a) == a_payload
+    assert cache.get(c) == c_payload
+
+
+def test_disabled_cache_keeps_nothing(keys):
+    cache = VerifiedTokenCache()
+    cache.enabled = False
+    token, payload = make_token()
+    cache.put(token, payload)
+    assert cache.get(token) is None
+    assert len(cache) == 0
@@ -0,0 +1,115 @@
+# test_tracing.py
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import sentry_sdk
+from sentry_sdk.tracing import Transaction
+from sentry_sdk.utils import format_timestamp
+
+from app.tracing import TraceSampler
+
+
+def make_event(transaction='/api/user/status', seconds=0.01, status_code=200, serialized=True, **trace):
+    """A transaction event, with timestamps as the SDK passes them (datetimes) or as it serializes them."""
+    started = datetime.now(timezone.utc)
+    ended = started + timedelta(seconds=seconds)
+    trace.setdefault('data', {'http.response.status_code': status_code})
+    return {
+        'transaction': transaction,
+        'start_timestamp': format_timestamp(started) if serialized else started,
+        'timestamp': format_timestamp(ended) if serialized else ended,
+        'contexts': {'trace': trace},
+    }
+
+
+def sampling_context(path='/api/user/status'):
+    return {'wsgi_environ': {'PATH_INFO': path}}
+
+
+def test_samples_requests_by_route_when_they_start():
+    sampler = TraceSampler(sample_rate=0.1, route_rates={'/': 0.01}, ignored_routes=('/health/live',))
+    assert sampler.traces_sampler(sampling_context()) == 0.1
+    assert sampler.traces_sampler(sampling_context('/')) == 0.01
+    assert sampler.traces_sampler(sampling_context('/health/live')) == 0
+    assert sampler.traces_sampler({'asgi_scope': {'path': '/health/live'}}) == 0
+
+
+def test_lowers_rates_as_requests_go_up():
+    sampler = TraceSampler(sample_rate=0.5, send_per_second=2.0)
+    sampler.request_rate.value = 100.0
+    assert sampler.traces_sampler(sampling_context()) == 0.02
+    sampler.request_rate.value = 1.0
+    assert sampler.traces_sampler(sampling_context()) == 0.5
+
+
+def test_records_every_request_when_asked_to():
+    sampler = TraceSampler(sample_rate=0.0, record_all=True, ignored_routes=('/health/live',))
+    assert sampler.traces_sampler(sampling_context()) == 1.0
+    assert sampler.traces_sampler(sampling_context('/health/live')) == 0
+
+
+def test_keeps_the_parent_decision():
+    sampler = TraceSampler()
+    context = {'wsgi_environ': {'PATH_INFO': '/api/user/status'}, 'parent_sampled': False}
+    assert sampler.traces_sampler(context) is False
+    event = make_event(parent_span_id='abc123')
+    assert TraceSampler(sample_rate=0.0).before_send_transaction(event, {}) is event
+
+
+def test_sends_every_recorded_transaction():
+    sampler = TraceSampler(sample_rate=0.0)
+    event = make_event()
+    assert sampler.before_send_transaction(event, {}) is event
+
+
+def test_always_sends_errors_and_slow_transactions():
+    sampler = TraceSampler(sample_rate=0.0, slow_threshold=1.0, record_all=True)
+    for event in (make_event(status_code=500), make_event(status='internal_error'),
+                  make_event(seconds=1.5), make_event(seconds=1.5, serialized=False)):
+        assert sampler.before_send_transaction(event, {}) is event
+    assert sampler.before_send_transaction(make_event(seconds=0.5, serialized=False), {}) is None
+
+
+def test_samples_ordinary_transactions_by_route_when_recording_all():
+    sampler = TraceSampler(sample_rate=0.0, route_rates={'/api/create-checkout-session': 1.0}, record_all=True)
+    assert sampler.before_send_transaction(make_event(), {}) is None
+    event = make_event('/api/create-checkout-session')
+    assert sampler.before_send_transaction(event, {}) is event
+
+
+def test_caps_ordinary_transactions_sent_per_second_when_recording_all():
+    sampler = TraceSampler(sample_rate=1.0, send_per_second=2.0, record_all=True)
+    sampler.request_rate.value = 4.0
+    sent = sum(sampler.before_send_transaction(make_event(), {}) is not None for _ in range(2000))
+    assert 800 < sent < 1200
+    # Shedding load never drops errors
+    event = make_event(status_code=503)
+    sampler.request_rate.value = 1e9
+    assert sampler.before_send_transaction(event, {}) is event
+
+
+@pytest.fixture
+def messages(monkeypatch):
+    sent = []
+    monkeypatch.setattr(sentry_sdk, 'capture_message', lambda message, **kwargs: sent.append((message, kwargs)))
+    return sent
+
+
+def make_transaction(name='/api/user/status', sampled=False, seconds=0.0):
+    transaction = Transaction(name=name, sampled=sampled)
+    return transaction, transaction.start_timestamp + timedelta(seconds=seconds)
+
+
+def test_reports_slow_requests_it_does_not_trace(messages):
+    sampler = TraceSampler(slow_threshold=1.0, ignored_routes=('/health',))
+    assert sampler.report_slow(*make_transaction(seconds=1.5))
+    (message, options), = messages
+    assert message == 'Slow request: /api/user/status'
+    assert options['extras'] == {'duration_seconds': 1.5}
+
+    # Fast requests, traced ones (their transaction is sent) and probes aren't reported
+    assert not sampler.report_slow(*make_transaction(seconds=0.5))
+    assert not sampler.report_slow(*make_transaction(sampled=True, seconds=1.5))
+    assert not sampler.report_slow(*make_transaction('/health', seconds=1.5))
+    assert not sampler.report_slow(None)
+    assert len(messages) == 1
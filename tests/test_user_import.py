@@ -0,0 +1,142 @@
+# test_user_import.py
+import json
+import uuid
+
+import pytest
+
+from app import db
+from app.services import user_import, user_service
+from app.services.user_import import MAX_FIELD_LENGTH, NothingToResume, import_users, parse_line
+
+
+def test_parses_exported_users():
+    line = json.dumps({'user_id': 'auth0|123', 'email': 'a@example.com', 'name': 'A'})
+    assert parse_line(line) == ('auth0|123', 'a@example.com')
+    assert parse_line(line.encode('utf-8') + b'\n') == ('auth0|123', 'a@example.com')
+
+
+def test_parses_renamed_fields():
+    assert parse_line(json.dumps({'Id': 'auth0|123', 'Email': 'a@example.com'})) == ('auth0|123', 'a@example.com')
+
+
+def test_skips_lines_it_cannot_import():
+    for line in (
+        '',
+        '{not json',
+        '["auth0|123", "a@example.com"]',
+        json.dumps({'user_id': 'auth0|123'}),
+        json.dumps({'email': 'a@example.com'}),
+        json.dumps({'user_id': 123, 'email': 'a@example.com'}),
+        json.dumps({'user_id': '', 'email': 'a@example.com'}),
+        json.dumps({'user_id': 'auth0|123', 'email': 'a' * MAX_FIELD_LENGTH + '@example.com'}),
+    ):
+        assert parse_line(line) is None, line
+
+
+@pytest.fixture
+def write_export(tmp_path):
+    """Returns a function writing an Auth0 export of (auth0_user_id, email) pairs, one user per line."""
+    def write(users, name='users.json'):
+        path = tmp_path / name
+        path.write_text(''.join(json.dumps({'user_id': user_id, 'email': email}) + '\n' for user_id, email in users))
+        return str(path)
+    return write
+
+
+def make_users(count, prefix='import'):
+    tag = uuid.uuid4().hex[:8]
+    return [(f'auth0|{prefix}-{tag}-{i}', f'{prefix}-{tag}-{i}@example.com') for i in range(count)]
+
+
+def onboarded_state(run_sql, users):
+    """Everything onboarding wrote for `users`, in their order, without ids, emails and timestamps."""
+    rows = run_sql("""
+        SELECT users.auth0_user_id, users.subscription_plan, users.stripe_customer_id,
+               (SELECT array_agg(roles.name ORDER BY roles.name) FROM user_roles
+                JOIN roles ON roles.id = user_roles.role_id WHERE user_roles.user_id = users.id),
+               (SELECT json_agg(json_build_object('action', action, 'details', details)) FROM audit_logs
+                WHERE audit_logs.user_id = users.id)
+        FROM users WHERE users.auth0_user_id = ANY(:ids)
+    """, ids=[user_id for user_id, _ in users])
+    by_id = {row[0]: row[1:] for row in rows}
+    return [by_id.get(user_id) for user_id, _ in users]
+
+
+def test_import_ends_as_onboarding_one_by_one(app, run_sql, write_export):
+    imported, onboarded = make_users(5), make_users(5, prefix='onboard')
+    with app.app_context():
+        summary = import_users(write_export(imported), batch_size=2)
+        for auth0_user_id, email in onboarded:
+            user_service.onboard_user(auth0_user_id, email)
+            db.session.commit()
+
+    assert summary['created'] == 5
+    state = onboarded_state(run_sql, imported)
+    assert None not in state
+    assert state == onboarded_state(run_sql, onboarded)
+
+
+def test_importing_again_changes_nothing(app, run_sql, write_export):
+    users = make_users(5)
+    path = write_export(users)
+    with app.app_context():
+        import_users(path, batch_size=2)
+    before = onboarded_state(run_sql, users)
+
+    with app.app_context():
+        summary = import_users(path, batch_size=2)
+    assert (summary['created'], summary['skipped']) == (0, 5)
+    assert onboarded_state(run_sql, users) == before
+
+
+def test_resumed_import_neither_duplicates_nor_drops_users(app, run_sql, write_export, monkeypatch):
+    users = make_users(10)
+    path = write_export(users)
+    update = user_import.update
+    checkpoints = []
+
+    def killed_at_third_checkpoint(*args):
+        # Dies after merging the third batch, before its transaction commits
+        checkpoints.append(args)
+        if len(checkpoints) == 3:
+            raise KeyboardInterrupt
+        return update(*args)
+
+    monkeypatch.setattr(user_import, 'update', killed_at_third_checkpoint)
+    with app.app_context(), pytest.raises(KeyboardInterrupt):
+        import_users(path, batch_size=3)
+    monkeypatch.setattr(user_import, 'update', update)
+    assert None in onboarded_state(run_sql, users)
+
+    with app.app_context():
+        summary = import_users(path, batch_size=3, resume=True)
+        with pytest.raises(NothingToResume):
+            import_users(path, resume=True)
+
+    assert (summary['lines'], summary['created'], summary['skipped']) == (10, 10, 0)
+    counts = run_sql("""
+        SELECT count(*), count(DISTINCT users.id), count(DISTINCT audit_logs.id)
+        FROM users
+        JOIN user_roles ON user_roles.user_id = users.id
+        JOIN audit_logs ON audit_logs.user_id = users.id
+        WHERE users.auth0_user_id = ANY(:ids)
+    """, ids=[user_id for user_id, _ in users])
+    assert tuple(counts[0]) == (10, 10, 10)
+
+
+def test_users_whose_email_is_taken_are_reported_not_skipped(app, run_sql, write_export):
+    existing, = make_users(1, prefix='existing')
+    new = make_users(3)
+    users = [
+        (new[0][0], existing[1]),   # email of an existing user
+        (new[1][0], new[1][1]),
+        (new[2][0], new[1][1]),     # email of the line before
+        existing,                   # already onboarded
+    ]
+    with app.app_context():
+        user_service.onboard_user(*existing)
+        db.session.commit()
+        summary = import_users(write_export(users))
+
+    assert (summary['created'], summary['email_conflicts'], summary['skipped']) == (1, 2, 1)
+    assert onboarded_state(run_sql, users)[:3] == [None, onboarded_state(run_sql, [new[1]])[0], None]